@@ -0,0 +1,181 @@
+import argparse
+import hashlib
+import mmap
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator
+
+from sqlalchemy import select
+
+from . import models
+from .config import get_settings
+from .crypto_utils import AES_GCM_TAG_SIZE, ATTACHMENT_FORMAT_SEGMENTED
+from .database import SessionLocal
+from .schema_upgrade import upgrade_schema
+
+
+class BlobWriter(ABC):
+    @abstractmethod
+    def write(self, data: bytes) -> None: ...
+
+    # Zapisuje blob i zwraca jego referencję.
+    @abstractmethod
+    def commit(self) -> str: ...
+
+    @abstractmethod
+    def abort(self) -> None: ...
+
+    def __enter__(self) -> "BlobWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.abort()
+
+
+class BlobStore(ABC):
+    @abstractmethod
+    def writer(self) -> BlobWriter: ...
+
+    # Context manager zwracający bufor tylko do odczytu, który obsługuje wycinki.
+    @abstractmethod
+    def open(self, ref: str): ...
+
+    @abstractmethod
+    def delete(self, ref: str) -> None: ...
+
+    def put(self, data: bytes) -> str:
+        with self.writer() as writer:
+            writer.write(data)
+            return writer.commit()
+
+    def read(self, ref: str) -> bytes:
+        with self.open(ref) as buffer:
+            return bytes(buffer[:])
+
+
+class _FilesystemBlobWriter(BlobWriter):
+    def __init__(self, store: "FilesystemBlobStore"):
+        self._store = store
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> None:
+        self._hash.update(data)
+        self._file.write(data)
+
+    def commit(self) -> str:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        ref = self._hash.hexdigest()
+        path = self._store.path_for(ref)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Ta sama treść daje tę samą ścieżkę, więc istniejący plik jest już poprawny.
+        os.replace(self._tmp_path, path)
+        return ref
+
+    def abort(self) -> None:
+        self._file.close()
+        try:
+            os.unlink(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class FilesystemBlobStore(BlobStore):
+    # Bloby adresowane treścią: <root>/<ab>/<cd>/<sha256>.
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path_for(self, ref: str) -> str:
+        if len(ref) != 64 or any(ch not in "0123456789abcdef" for ch in ref):
+            raise ValueError("invalid blob reference")
+        return os.path.join(self.root, ref[:2], ref[2:4], ref)
+
+    def writer(self) -> BlobWriter:
+        return _FilesystemBlobWriter(self)
+
+    @contextmanager
+    def open(self, ref: str) -> Iterator[bytes]:
+        with open(self.path_for(ref), "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                yield b""
+                return
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+    def delete(self, ref: str) -> None:
+        try:
+            os.unlink(self.path_for(ref))
+        except FileNotFoundError:
+            pass
+
+
+@lru_cache
+def get_blob_store() -> BlobStore:
+    settings = get_settings()
+    if settings.blob_store_backend == "filesystem":
+        return FilesystemBlobStore(settings.blob_store_path)
+    raise ValueError(f"Unknown blob store backend: {settings.blob_store_backend}")
+
+
+def migrate_attachments(batch_size: int) -> int:
+    # Baza sprzed magazynu blobów nie ma jeszcze kolumn blob_ref, size, digest itd.
+    for change in upgrade_schema():
+        print(change)
+    store = get_blob_store()
+    moved = 0
+    last_id = 0
+    while True:
+        with SessionLocal() as db:
+            batch = db.execute(
+                select(models.Attachment.id, models.Attachment.data, models.Attachment.size, models.Attachment.format_version)
+                .where(
+                    models.Attachment.id > last_id,
+                    models.Attachment.blob_ref.is_(None),
+                    models.Attachment.data.is_not(None),
+                )
+                .order_by(models.Attachment.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                return moved
+            for row in batch:
+                size = row.size
+                if size is None and row.format_version != ATTACHMENT_FORMAT_SEGMENTED:
+                    size = len(row.data) - AES_GCM_TAG_SIZE
+                ref = store.put(row.data)
+                db.query(models.Attachment).filter(models.Attachment.id == row.id).update(
+                    {
+                        models.Attachment.blob_ref: ref,
+                        models.Attachment.data: None,
+                        models.Attachment.size: size,
+                        models.Attachment.digest: bytes.fromhex(ref),
+                    },
+                    synchronize_session=False,
+                )
+            db.commit()
+            moved += len(batch)
+            last_id = batch[-1].id
+            print(f"przeniesiono {moved} załączników (ostatnie id {last_id})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Magazyn blobów załączników SecureMail")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="przenosi szyfrogramy z tabeli attachments do magazynu blobów")
+    migrate.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate_attachments(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
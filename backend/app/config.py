@@ -1,15 +1,76 @@
 import secrets
 from functools import lru_cache
+from typing import Literal
 
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+# Zestawy kluczy użytkowników (app.crypto_utils.KEY_SUITES); tu, bo typ waliduje też default_key_suite.
+KeySuite = Literal["rsa", "x25519-ed25519"]
+
 
 class Settings(BaseSettings):
     secret_key: str = Field(default_factory=lambda: secrets.token_urlsafe(32))
     access_token_expire_minutes: int = 60
     database_url: str = "sqlite:///./securemail.db"
+    # Puste = wyprowadzony z database_url (asyncpg dla Postgresa, aiosqlite dla SQLite).
+    async_database_url: str = ""
+    # Każdy worker ma dwie pule: asynchroniczną dla endpointów (db_pool_*) i synchroniczną dla doręczeń
+    # w tle i strumieniowania załączników (sync_db_pool_*); limit połączeń bazy to suma obu.
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    sync_db_pool_size: int = 5
+    sync_db_max_overflow: int = 5
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
     totp_issuer: str = "SecureMail"
+    message_key_cache_bytes: int = 8 * 1024 * 1024
+    session_store_backend: str = "memory"
+    session_store_socket: str = "/tmp/securemail-sessions.sock"
+    # Maksymalny czas oczekiwania workera na odpowiedź pomocnika sesji.
+    session_store_timeout_seconds: float = 5.0
+    session_store_shards: int = 16
+    session_max_count: int = 100_000
+    session_max_per_user: int = 10
+    session_sweep_interval_seconds: float = 30.0
+    rate_limit_max_keys: int = 100_000
+    # Liczba reverse proxy przed aplikacją; 0 = X-Forwarded-For jest ignorowany, liczy się adres połączenia.
+    trusted_proxy_count: int = 0
+    public_key_cache_size: int = 4096
+    inbox_page_size: int = 50
+    inbox_page_size_max: int = 200
+    mailbox_bulk_max: int = 500
+    notify_heartbeat_seconds: float = 15.0
+    notify_queue_max: int = 100
+    notify_max_connections_per_user: int = 5
+    search_index_batch_size: int = 200
+    # Nagłówek Server-Timing (db, crypto, serialize) w odpowiedziach; zdradza czasy operacji, więc domyślnie wyłączony.
+    server_timing_enabled: bool = False
+    # Token (nagłówek Authorization: Bearer) wymagany przez /metrics; pusty = metryki wyłączone (404).
+    metrics_token: str = ""
+    attachment_max_bytes: int = 100 * 1024 * 1024
+    attachment_staging_ttl_minutes: int = 24 * 60
+    attachment_verify_digest: bool = True
+    blob_store_backend: str = "filesystem"
+    blob_store_path: str = "./blobs"
+    # 0 = liczba rdzeni procesora
+    crypto_process_workers: int = 0
+    crypto_keygen_limit: int = 2
+    crypto_kdf_limit: int = 4
+    crypto_password_limit: int = 4
+    crypto_rsa_limit: int = 8
+    crypto_queue_max: int = 64
+    default_key_suite: KeySuite = "rsa"
+    # Doręczenie odroczone przechowuje klucz wiadomości zaszyfrowany kluczem z secret_key, więc wymaga
+    # stałego SECUREMAIL_SECRET_KEY; bez niego aplikacja nie wystartuje, chyba że tryb jest wyłączony.
+    deferred_delivery_enabled: bool = True
+    delivery_workers: int = 2
+    delivery_batch_size: int = 100
+    delivery_max_attempts: int = 5
+    keypair_pool_low: int = 4
+    keypair_pool_high: int = 16
+    keypair_pool_workers: int = 1
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -1,12 +1,58 @@
+import asyncio
+import hashlib
+import multiprocessing
 import os
-from typing import Tuple
+import time
+from dataclasses import dataclass
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
+from typing import Any, Callable, Iterable, Tuple, get_args
 
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, utils
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
+from .config import KeySuite, get_settings
+from .metrics import PHASE_CRYPTO, current_timings, timed
 
+
+AES_GCM_TAG_SIZE = 16
+
+# Format szyfrogramu załącznika: 1 = jeden blok AES-GCM, 2 = segmenty AES-GCM o stałym rozmiarze.
+ATTACHMENT_FORMAT_SINGLE = 1
+ATTACHMENT_FORMAT_SEGMENTED = 2
+ATTACHMENT_SEGMENT_SIZE = 64 * 1024
+_SEGMENT_NONCE_PREFIX_SIZE = 7
+
+SIGNATURE_ALGO_LEGACY = "RSA-PSS-SHA256"
+SIGNATURE_ALGO_MANIFEST = "RSA-PSS-SHA256-MANIFEST"
+SIGNATURE_ALGO_ED25519_MANIFEST = "ED25519-MANIFEST"
+MANIFEST_SIGNATURE_ALGOS = frozenset({SIGNATURE_ALGO_MANIFEST, SIGNATURE_ALGO_ED25519_MANIFEST})
+_MANIFEST_HEADER = b"securemail-manifest-v1\n"
+
+# Zestawy kluczy użytkownika: RSA-4096 (OAEP + PSS) albo X25519 (owijanie kluczy) + Ed25519 (podpisy).
+KEY_SUITES: tuple[str, ...] = get_args(KeySuite)
+KEY_SUITE_RSA, KEY_SUITE_EC = KEY_SUITES
+
+WRAP_ALGO_RSA_OAEP = "RSA-OAEP-SHA256"
+WRAP_ALGO_X25519 = "X25519-HKDF-SHA256-AESGCM"
+_X25519_WRAP_INFO = b"securemail-x25519-wrap-v1"
+_X25519_KEY_SIZE = 32
+_WRAP_NONCE_SIZE = 12
+
+
+@dataclass(frozen=True)
+class EcPrivateKeys:
+    exchange: X25519PrivateKey
+    signing: Ed25519PrivateKey
+
+
+@timed(PHASE_CRYPTO)
 def generate_rsa_keypair() -> Tuple[bytes, bytes]:
     private_key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
     private_pem = private_key.private_bytes(
@@ -21,11 +67,33 @@ def generate_rsa_keypair() -> Tuple[bytes, bytes]:
     return private_pem, public_pem
 
 
+@timed(PHASE_CRYPTO)
+def generate_ec_keypair() -> Tuple[bytes, bytes, bytes]:
+    # Zwraca (surowy materiał prywatny X25519 || Ed25519, PEM publiczny X25519, PEM publiczny Ed25519).
+    exchange = X25519PrivateKey.generate()
+    signing = Ed25519PrivateKey.generate()
+    public_format = (serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return (
+        exchange.private_bytes_raw() + signing.private_bytes_raw(),
+        exchange.public_key().public_bytes(*public_format),
+        signing.public_key().public_bytes(*public_format),
+    )
+
+
+@timed(PHASE_CRYPTO)
 def derive_key(password: str, salt: bytes) -> bytes:
     kdf = Scrypt(salt=salt, length=32, n=2**14, r=8, p=1)
     return kdf.derive(password.encode("utf-8"))
 
 
+@timed(PHASE_CRYPTO)
+def derive_server_key(secret: str, purpose: bytes) -> bytes:
+    # Klucz symetryczny serwera dla danego zastosowania, wyprowadzony z secret_key.
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=purpose)
+    return hkdf.derive(secret.encode("utf-8"))
+
+
+@timed(PHASE_CRYPTO)
 def encrypt_private_key(private_key_pem: bytes, password: str) -> tuple[bytes, bytes, bytes]:
     salt = os.urandom(16)
     key = derive_key(password, salt)
@@ -35,17 +103,51 @@ def encrypt_private_key(private_key_pem: bytes, password: str) -> tuple[bytes, b
     return ciphertext, salt, nonce
 
 
-def decrypt_private_key(ciphertext: bytes, salt: bytes, nonce: bytes, password: str):
+@timed(PHASE_CRYPTO)
+def decrypt_private_key_pem(ciphertext: bytes, salt: bytes, nonce: bytes, password: str) -> bytes:
     key = derive_key(password, salt)
     aesgcm = AESGCM(key)
-    private_pem = aesgcm.decrypt(nonce, ciphertext, None)
-    return serialization.load_pem_private_key(private_pem, password=None)
+    return aesgcm.decrypt(nonce, ciphertext, None)
+
+
+@timed(PHASE_CRYPTO)
+def load_private_key(private_pem: bytes, key_suite: str = KEY_SUITE_RSA):
+    if key_suite == KEY_SUITE_EC:
+        return EcPrivateKeys(
+            exchange=X25519PrivateKey.from_private_bytes(private_pem[:_X25519_KEY_SIZE]),
+            signing=Ed25519PrivateKey.from_private_bytes(private_pem[_X25519_KEY_SIZE:]),
+        )
+    # PEM przeszedł uwierzytelnienie AES-GCM kluczem z hasła, więc pomijamy kosztowną walidację klucza RSA.
+    return serialization.load_pem_private_key(private_pem, password=None, unsafe_skip_rsa_key_validation=True)
+
+
+@timed(PHASE_CRYPTO)
+def serialize_private_key(private_key) -> tuple[bytes, str]:
+    # Odwrotność load_private_key: (materiał, zestaw kluczy).
+    if isinstance(private_key, EcPrivateKeys):
+        return private_key.exchange.private_bytes_raw() + private_key.signing.private_bytes_raw(), KEY_SUITE_EC
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    return private_pem, KEY_SUITE_RSA
+
+
+@timed(PHASE_CRYPTO)
+def derive_search_key(private_key) -> bytes:
+    # Klucz HMAC indeksu wyszukiwania, wyprowadzony z klucza prywatnego użytkownika; bez jego sesji
+    # serwer nie policzy tokenów, więc nie sprawdzi, jakie słowa zawiera indeks.
+    material, _ = serialize_private_key(private_key)
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"securemail-search-index-v1")
+    return hkdf.derive(material)
 
 
 def generate_aes_key() -> bytes:
     return os.urandom(32)
 
 
+@timed(PHASE_CRYPTO)
 def encrypt_payload(data: bytes, key: bytes) -> tuple[bytes, bytes]:
     nonce = os.urandom(12)
     aesgcm = AESGCM(key)
@@ -53,27 +155,80 @@ def encrypt_payload(data: bytes, key: bytes) -> tuple[bytes, bytes]:
     return ciphertext, nonce
 
 
+@timed(PHASE_CRYPTO)
 def decrypt_payload(ciphertext: bytes, nonce: bytes, key: bytes) -> bytes:
     aesgcm = AESGCM(key)
     return aesgcm.decrypt(nonce, ciphertext, None)
 
 
-def wrap_aes_key_for_recipient(aes_key: bytes, public_key_pem: bytes) -> bytes:
-    public_key = serialization.load_pem_public_key(public_key_pem)
-    return public_key.encrypt(
+def _x25519_kek(shared_secret: bytes, ephemeral_public: bytes, recipient_public: bytes) -> bytes:
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=_X25519_WRAP_INFO + ephemeral_public + recipient_public)
+    return hkdf.derive(shared_secret)
+
+
+@timed(PHASE_CRYPTO)
+def load_public_key(public_key) -> Any:
+    # Przyjmuje PEM albo już wczytany obiekt klucza (np. z key_cache).
+    if isinstance(public_key, bytes):
+        return serialization.load_pem_public_key(public_key)
+    return public_key
+
+
+@timed(PHASE_CRYPTO)
+def wrap_aes_key(aes_key: bytes, public_key_pem) -> tuple[bytes, str]:
+    # Algorytm wynika z typu klucza odbiorcy; zwracamy go, żeby zapisać przy MessageRecipient.
+    public_key = load_public_key(public_key_pem)
+    if isinstance(public_key, X25519PublicKey):
+        # Efemeryczny klucz X25519 (32 B) || nonce (12 B) || klucz AES zaszyfrowany AES-GCM kluczem z HKDF.
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_public = ephemeral.public_key().public_bytes_raw()
+        kek = _x25519_kek(ephemeral.exchange(public_key), ephemeral_public, public_key.public_bytes_raw())
+        nonce = os.urandom(_WRAP_NONCE_SIZE)
+        return ephemeral_public + nonce + AESGCM(kek).encrypt(nonce, aes_key, None), WRAP_ALGO_X25519
+    wrapped = public_key.encrypt(
         aes_key,
         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None),
     )
+    return wrapped, WRAP_ALGO_RSA_OAEP
 
 
+@timed(PHASE_CRYPTO)
+def wrap_aes_key_for_recipient(aes_key: bytes, public_key_pem) -> bytes:
+    return wrap_aes_key(aes_key, public_key_pem)[0]
+
+
+@timed(PHASE_CRYPTO)
 def unwrap_aes_key(aes_key_enc: bytes, private_key) -> bytes:
+    if isinstance(private_key, EcPrivateKeys):
+        ephemeral_public = aes_key_enc[:_X25519_KEY_SIZE]
+        nonce = aes_key_enc[_X25519_KEY_SIZE : _X25519_KEY_SIZE + _WRAP_NONCE_SIZE]
+        shared_secret = private_key.exchange.exchange(X25519PublicKey.from_public_bytes(ephemeral_public))
+        kek = _x25519_kek(shared_secret, ephemeral_public, private_key.exchange.public_key().public_bytes_raw())
+        return AESGCM(kek).decrypt(nonce, aes_key_enc[_X25519_KEY_SIZE + _WRAP_NONCE_SIZE :], None)
     return private_key.decrypt(
         aes_key_enc,
         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None),
     )
 
 
+@timed(PHASE_CRYPTO)
+def wrap_aes_key_for_recipients(aes_key: bytes, public_key_pems: Iterable) -> list[tuple[bytes, str]]:
+    return [wrap_aes_key(aes_key, pem) for pem in public_key_pems]
+
+
+@timed(PHASE_CRYPTO)
+def unwrap_aes_keys(aes_keys_enc: Iterable[bytes], private_key) -> list[bytes]:
+    return [unwrap_aes_key(aes_key_enc, private_key) for aes_key_enc in aes_keys_enc]
+
+
+def manifest_signature_algo(private_key) -> str:
+    return SIGNATURE_ALGO_ED25519_MANIFEST if isinstance(private_key, EcPrivateKeys) else SIGNATURE_ALGO_MANIFEST
+
+
+@timed(PHASE_CRYPTO)
 def sign_payload(data: bytes, private_key) -> bytes:
+    if isinstance(private_key, EcPrivateKeys):
+        return private_key.signing.sign(data)
     return private_key.sign(
         data,
         padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
@@ -81,9 +236,13 @@ def sign_payload(data: bytes, private_key) -> bytes:
     )
 
 
-def verify_signature(data: bytes, signature: bytes, public_key_pem: bytes) -> bool:
-    public_key = serialization.load_pem_public_key(public_key_pem)
+@timed(PHASE_CRYPTO)
+def verify_signature(data: bytes, signature: bytes, public_key_pem) -> bool:
+    public_key = load_public_key(public_key_pem)
     try:
+        if isinstance(public_key, Ed25519PublicKey):
+            public_key.verify(signature, data)
+            return True
         public_key.verify(
             signature,
             data,
@@ -93,3 +252,177 @@ def verify_signature(data: bytes, signature: bytes, public_key_pem: bytes) -> bo
         return True
     except Exception:
         return False
+
+
+@timed(PHASE_CRYPTO)
+def verify_signature_digest(digest: bytes, signature: bytes, public_key_pem) -> bool:
+    # Weryfikacja RSA-PSS nad gotowym skrótem SHA-256, liczonym przyrostowo przez wywołującego.
+    public_key = load_public_key(public_key_pem)
+    try:
+        public_key.verify(
+            signature,
+            digest,
+            padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+            utils.Prehashed(hashes.SHA256()),
+        )
+        return True
+    except Exception:
+        return False
+
+
+def sha256_digest(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def key_fingerprint(public_key_pem: bytes) -> bytes:
+    return sha256_digest(public_key_pem)
+
+
+@timed(PHASE_CRYPTO)
+def build_signature_manifest(subject_enc: bytes, body_enc: bytes, attachment_digests: Iterable[bytes]) -> bytes:
+    # Podpisujemy skróty części zamiast samych szyfrogramów, więc weryfikacja nie wymaga treści załączników.
+    parts = [sha256_digest(subject_enc), sha256_digest(body_enc), *attachment_digests]
+    return _MANIFEST_HEADER + b"".join(parts)
+
+
+def _segment_nonce(nonce_prefix: bytes, index: int, final: bool) -> bytes:
+    # prefiks (7 B) || numer segmentu (4 B, big-endian) || znacznik ostatniego segmentu (1 B)
+    return nonce_prefix + index.to_bytes(4, "big") + (b"\x01" if final else b"\x00")
+
+
+class SegmentedEncryptor:
+    def __init__(self, key: bytes):
+        self.nonce_prefix = os.urandom(_SEGMENT_NONCE_PREFIX_SIZE)
+        self._aesgcm = AESGCM(key)
+        self._index = 0
+        self._buffer = bytearray()
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def _seal(self, chunk: bytes, final: bool) -> bytes:
+        ciphertext = self._aesgcm.encrypt(_segment_nonce(self.nonce_prefix, self._index, final), chunk, None)
+        self._index += 1
+        self._hash.update(ciphertext)
+        return ciphertext
+
+    def digest(self) -> bytes:
+        # SHA-256 całego szyfrogramu, liczony przyrostowo podczas szyfrowania
+        return self._hash.digest()
+
+    @timed(PHASE_CRYPTO)
+    def update(self, data: bytes) -> bytes:
+        self.size += len(data)
+        self._buffer += data
+        out = bytearray()
+        # Ostatni pełny segment zostaje w buforze, bo dopiero finalize() wie, że jest ostatni.
+        while len(self._buffer) > ATTACHMENT_SEGMENT_SIZE:
+            out += self._seal(bytes(self._buffer[:ATTACHMENT_SEGMENT_SIZE]), final=False)
+            del self._buffer[:ATTACHMENT_SEGMENT_SIZE]
+        return bytes(out)
+
+    @timed(PHASE_CRYPTO)
+    def finalize(self) -> bytes:
+        out = self._seal(bytes(self._buffer), final=True)
+        self._buffer.clear()
+        return out
+
+
+def segment_count(plaintext_size: int) -> int:
+    return max(1, -(-plaintext_size // ATTACHMENT_SEGMENT_SIZE))
+
+
+def segment_span(index: int, plaintext_size: int) -> tuple[int, int]:
+    # (przesunięcie, długość) segmentu w szyfrogramie
+    offset = index * (ATTACHMENT_SEGMENT_SIZE + AES_GCM_TAG_SIZE)
+    plain_len = min(ATTACHMENT_SEGMENT_SIZE, plaintext_size - index * ATTACHMENT_SEGMENT_SIZE)
+    return offset, plain_len + AES_GCM_TAG_SIZE
+
+
+@timed(PHASE_CRYPTO)
+def decrypt_segment(ciphertext: bytes, nonce_prefix: bytes, index: int, final: bool, key: bytes) -> bytes:
+    aesgcm = AESGCM(key)
+    return aesgcm.decrypt(_segment_nonce(nonce_prefix, index, final), ciphertext, None)
+
+
+# Klasy operacji executora kryptograficznego; każda ma własny limit równoległości i kolejkę.
+OP_KEYGEN = "keygen"
+OP_KDF = "kdf"
+OP_PASSWORD = "password"
+OP_RSA = "rsa"
+# Te klasy przyjmują i zwracają wyłącznie bajty/napisy, więc mogą działać w osobnych procesach.
+# Operacje na obiektach kluczy prywatnych RSA i EC (nie dają się serializować) idą do dedykowanej puli wątków,
+# oddzielonej od domyślnej puli AnyIO, z której korzystają tanie endpointy.
+_PROCESS_OPS = frozenset({OP_KEYGEN, OP_KDF, OP_PASSWORD})
+
+
+class CryptoBusyError(RuntimeError):
+    pass
+
+
+class CryptoExecutor:
+    def __init__(self, process_workers: int, limits: dict[str, int], queue_max: int):
+        self._process_workers = process_workers or None
+        self._process_pool: ProcessPoolExecutor | None = None
+        self._thread_pool = ThreadPoolExecutor(max_workers=max(limits[OP_RSA], 1), thread_name_prefix="crypto")
+        self._limits = limits
+        self._queue_max = queue_max
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        # Liczba operacji w toku (wykonywanych i oczekujących); zmieniana tylko w pętli zdarzeń.
+        self._pending: dict[str, int] = dict.fromkeys(limits, 0)
+
+    def _executor(self, op: str) -> Executor:
+        if op not in _PROCESS_OPS:
+            return self._thread_pool
+        if self._process_pool is None:
+            # spawn zamiast fork: procesy robocze nie dziedziczą pamięci z odszyfrowanymi kluczami sesji.
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self._process_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._process_pool
+
+    async def run(self, op: str, fn: Callable[..., Any], *args: Any) -> Any:
+        limit = self._limits[op]
+        if self._pending[op] >= limit + self._queue_max:
+            raise CryptoBusyError(op)
+        semaphore = self._semaphores.get(op)
+        if semaphore is None:
+            semaphore = self._semaphores[op] = asyncio.Semaphore(limit)
+        self._pending[op] += 1
+        # Czas w kolejce executora też należy do fazy crypto żądania: tyle żądanie czeka na kryptografię.
+        timings = current_timings()
+        started = time.perf_counter()
+        try:
+            async with semaphore:
+                executor = self._executor(op)
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args))
+                except BrokenProcessPool:
+                    # Zabity proces roboczy psuje całą pulę; następne wywołanie utworzy nową.
+                    if self._process_pool is executor:
+                        self._process_pool = None
+                    raise
+        finally:
+            self._pending[op] -= 1
+            if timings is not None:
+                timings.add(PHASE_CRYPTO, time.perf_counter() - started)
+
+    def shutdown(self) -> None:
+        self._thread_pool.shutdown(wait=False, cancel_futures=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+            self._process_pool = None
+
+
+@lru_cache
+def get_crypto_executor() -> CryptoExecutor:
+    settings = get_settings()
+    return CryptoExecutor(
+        process_workers=settings.crypto_process_workers,
+        limits={
+            OP_KEYGEN: settings.crypto_keygen_limit,
+            OP_KDF: settings.crypto_kdf_limit,
+            OP_PASSWORD: settings.crypto_password_limit,
+            OP_RSA: settings.crypto_rsa_limit,
+        },
+        queue_max=settings.crypto_queue_max,
+    )
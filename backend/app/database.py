@@ -1,20 +1,74 @@
-from sqlalchemy import create_engine
+import time
+from typing import AsyncIterator
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from .config import get_settings
+from .metrics import PHASE_DB, record
 
 settings = get_settings()
 
-connect_args = {"check_same_thread": False} if settings.database_url.startswith("sqlite") else {}
-engine = create_engine(settings.database_url, connect_args=connect_args)
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def _pool_args(url: str, pool_size: int, max_overflow: int) -> dict:
+    # SQLite nie ma serwera, więc rozmiar puli nie ogranicza współbieżności; zostają domyślne ustawienia.
+    if url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+
+
+def _async_url(url: str) -> str:
+    parsed = make_url(url)
+    return parsed.set(drivername=_ASYNC_DRIVERS.get(parsed.get_backend_name(), parsed.drivername)).render_as_string(
+        hide_password=False
+    )
+
+
+# Silnik synchroniczny obsługuje create_all, doręczenia w tle i strumieniowanie załączników z wątków.
+engine = create_engine(
+    settings.database_url,
+    **_pool_args(settings.database_url, settings.sync_db_pool_size, settings.sync_db_max_overflow),
+)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
+# Endpointy korzystają z silnika asynchronicznego: liczbę równoległych zapytań ogranicza pula połączeń, nie pula wątków.
+async_database_url = settings.async_database_url or _async_url(settings.database_url)
+async_engine = create_async_engine(
+    async_database_url, **_pool_args(async_database_url, settings.db_pool_size, settings.db_max_overflow)
+)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+def _time_queries(sync_engine) -> None:
+    # Czas wykonania zapytań doliczany do fazy db bieżącego żądania (Server-Timing, /metrics).
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        if context is not None:
+            context.securemail_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        started = getattr(context, "securemail_started", None)
+        if started is not None:
+            record(PHASE_DB, time.perf_counter() - started)
+
+
+_time_queries(engine)
+_time_queries(async_engine.sync_engine)
+
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
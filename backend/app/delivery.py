@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from functools import lru_cache
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . import key_cache, mailbox_stats, models
+from .notifications import EVENT_MESSAGE, get_notification_hub
+from .config import get_settings
+from .crypto_utils import (
+    OP_RSA,
+    decrypt_payload,
+    derive_server_key,
+    encrypt_payload,
+    get_crypto_executor,
+    wrap_aes_key_for_recipients,
+)
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+DELIVERY_PENDING = "pending"
+DELIVERY_RUNNING = "running"
+DELIVERY_DONE = "done"
+DELIVERY_FAILED = "failed"
+
+_DELIVERY_KEY_PURPOSE = b"securemail-delivery-key-v1"
+_RETRY_BASE_SECONDS = 2.0
+
+
+def wrap_for_recipients(aes_key: bytes, recipients: list) -> list[tuple[bytes, str]]:
+    public_keys = [key_cache.get_public_key(user.id, user.public_key_pem) for user in recipients]
+    return wrap_aes_key_for_recipients(aes_key, public_keys)
+
+
+# Klucz AES wiadomości czeka na doręczenie zaszyfrowany kluczem serwera (z secret_key), więc przerwane
+# doręczenie można wznowić po restarcie; po zakończeniu kolumny są czyszczone.
+def encrypt_delivery_key(aes_key: bytes) -> tuple[bytes, bytes]:
+    return encrypt_payload(aes_key, derive_server_key(settings.secret_key, _DELIVERY_KEY_PURPOSE))
+
+
+def _decrypt_delivery_key(key_enc: bytes, key_nonce: bytes) -> bytes:
+    return decrypt_payload(key_enc, key_nonce, derive_server_key(settings.secret_key, _DELIVERY_KEY_PURPOSE))
+
+
+def _insert_recipients_ignoring_duplicates(db, rows: list[dict]) -> list[int]:
+    # Ponowienie partii nie może zdublować odbiorcy; uix_message_recipient odrzuca duplikaty po stronie bazy.
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(models.MessageRecipient).on_conflict_do_nothing(
+            index_elements=["message_id", "recipient_id"]
+        )
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(models.MessageRecipient).on_conflict_do_nothing(
+            index_elements=["message_id", "recipient_id"]
+        )
+    else:
+        stmt = insert(models.MessageRecipient)
+    # Zwraca odbiorców faktycznie dopisanych w tej partii (bez pominiętych duplikatów).
+    return list(db.execute(stmt.returning(models.MessageRecipient.recipient_id), rows).scalars())
+
+
+def _unfinished_deliveries() -> list[int]:
+    with SessionLocal() as db:
+        return [
+            delivery_id
+            for (delivery_id,) in db.query(models.Delivery.id)
+            .filter(models.Delivery.status.in_([DELIVERY_PENDING, DELIVERY_RUNNING]))
+            .order_by(models.Delivery.id)
+        ]
+
+
+def _start_delivery(delivery_id: int) -> tuple[int, list[int], bytes, bytes, int] | None:
+    with SessionLocal() as db:
+        delivery = db.get(models.Delivery, delivery_id)
+        if delivery is None or delivery.status in (DELIVERY_DONE, DELIVERY_FAILED):
+            return None
+        delivery.status = DELIVERY_RUNNING
+        delivery.attempts += 1
+        delivery.updated_at = datetime.utcnow()
+        db.commit()
+        return delivery.message_id, json.loads(delivery.recipient_ids), delivery.key_enc, delivery.key_nonce, delivery.attempts
+
+
+def _pending_recipients(message_id: int, recipient_ids: list[int]) -> list:
+    with SessionLocal() as db:
+        delivered = {
+            recipient_id
+            for (recipient_id,) in db.query(models.MessageRecipient.recipient_id).filter(
+                models.MessageRecipient.message_id == message_id,
+                models.MessageRecipient.recipient_id.in_(recipient_ids),
+            )
+        }
+        pending = [recipient_id for recipient_id in recipient_ids if recipient_id not in delivered]
+        if not pending:
+            return []
+        return db.query(models.User.id, models.User.public_key_pem).filter(models.User.id.in_(pending)).all()
+
+
+def _delivered_count(db, message_id: int) -> int:
+    return db.query(func.count(models.MessageRecipient.id)).filter(
+        models.MessageRecipient.message_id == message_id
+    ).scalar()
+
+
+def _store_batch(
+    delivery_id: int, message_id: int, recipients: list, wrapped_keys: list[tuple[bytes, str]]
+) -> list[int]:
+    with SessionLocal() as db:
+        inserted = _insert_recipients_ignoring_duplicates(
+            db,
+            [
+                {"message_id": message_id, "recipient_id": user.id, "aes_key_enc": aes_key_enc, "wrap_algo": wrap_algo}
+                for user, (aes_key_enc, wrap_algo) in zip(recipients, wrapped_keys)
+            ],
+        )
+        if inserted:
+            size = db.scalar(select(mailbox_stats.message_bytes()).where(models.Message.id == message_id))
+            mailbox_stats.apply_deltas(db, {recipient_id: (1, 1, size) for recipient_id in inserted})
+        db.query(models.Delivery).filter(models.Delivery.id == delivery_id).update(
+            {
+                models.Delivery.delivered: _delivered_count(db, message_id),
+                models.Delivery.updated_at: datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        db.commit()
+    return inserted
+
+
+def _finish_delivery(delivery_id: int, status: str, error: str | None = None) -> None:
+    values = {models.Delivery.status: status, models.Delivery.error: error, models.Delivery.updated_at: datetime.utcnow()}
+    if status in (DELIVERY_DONE, DELIVERY_FAILED):
+        values[models.Delivery.key_enc] = None
+        values[models.Delivery.key_nonce] = None
+    with SessionLocal() as db:
+        db.query(models.Delivery).filter(models.Delivery.id == delivery_id).update(values, synchronize_session=False)
+        db.commit()
+
+
+class DeliveryQueue:
+    # Lokalna pula workerów doręczających wiadomości wysłane w trybie odroczonym.
+    def __init__(self, workers: int, batch_size: int, max_attempts: int):
+        self._workers = workers
+        self._batch_size = max(batch_size, 1)
+        self._max_attempts = max_attempts
+        self._queue: asyncio.Queue[int] | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._tasks or not settings.deferred_delivery_enabled:
+            return
+        if "secret_key" not in settings.model_fields_set:
+            # Losowy secret_key zmienia się przy restarcie, a z nim klucz czekających doręczeń.
+            raise RuntimeError(
+                "deferred delivery needs a fixed SECUREMAIL_SECRET_KEY "
+                "(or SECUREMAIL_DEFERRED_DELIVERY_ENABLED=false)"
+            )
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(max(self._workers, 1))]
+        self._tasks.append(asyncio.create_task(self._resume()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def enqueue(self, delivery_id: int) -> None:
+        # Bez uruchomionej kolejki doręczenie zostaje w bazie jako pending i zostanie wznowione przy starcie.
+        if self._queue is not None:
+            self._queue.put_nowait(delivery_id)
+
+    async def _resume(self) -> None:
+        for delivery_id in await run_in_threadpool(_unfinished_deliveries):
+            self.enqueue(delivery_id)
+
+    async def _worker(self) -> None:
+        while True:
+            delivery_id = await self._queue.get()
+            try:
+                await self._deliver(delivery_id)
+            except Exception:
+                logger.exception("delivery %s failed", delivery_id)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, delivery_id: int) -> None:
+        attempts = 0
+        try:
+            job = await run_in_threadpool(_start_delivery, delivery_id)
+            if job is None:
+                return
+            message_id, recipient_ids, key_enc, key_nonce, attempts = job
+            aes_key = _decrypt_delivery_key(key_enc, key_nonce)
+            crypto = get_crypto_executor()
+            for offset in range(0, len(recipient_ids), self._batch_size):
+                batch_ids = recipient_ids[offset : offset + self._batch_size]
+                recipients = await run_in_threadpool(_pending_recipients, message_id, batch_ids)
+                if not recipients:
+                    continue
+                wrapped_keys = await crypto.run(OP_RSA, wrap_for_recipients, aes_key, recipients)
+                inserted = await run_in_threadpool(_store_batch, delivery_id, message_id, recipients, wrapped_keys)
+                get_notification_hub().publish(inserted, {"type": EVENT_MESSAGE, "id": message_id})
+        except Exception as exc:
+            # attempts == 0: nie udało się nawet rozpocząć próby (transakcja wycofana), więc ponawiamy.
+            final = attempts >= self._max_attempts
+            await run_in_threadpool(
+                _finish_delivery, delivery_id, DELIVERY_FAILED if final else DELIVERY_PENDING, str(exc) or type(exc).__name__
+            )
+            if not final:
+                delay = _RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0)
+                asyncio.get_running_loop().call_later(delay, self.enqueue, delivery_id)
+            return
+        await run_in_threadpool(_finish_delivery, delivery_id, DELIVERY_DONE)
+
+
+@lru_cache
+def get_delivery_queue() -> DeliveryQueue:
+    return DeliveryQueue(
+        workers=settings.delivery_workers,
+        batch_size=settings.delivery_batch_size,
+        max_attempts=settings.delivery_max_attempts,
+    )
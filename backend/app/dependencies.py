@@ -1,14 +1,22 @@
+import secrets
 from dataclasses import dataclass
+from typing import Any, Iterable
 
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, load_only
 
 from . import models, session_store
+from .config import get_settings
+from .crypto_utils import OP_RSA, get_crypto_executor, unwrap_aes_keys
 from .database import get_db
 from .security import JWTError, decode_access_token
+from .session_store import Principal
 
 bearer_scheme = HTTPBearer(auto_error=False)
+settings = get_settings()
 
 
 @dataclass
@@ -17,6 +25,29 @@ class TokenData:
     jti: str
 
 
+@dataclass
+class SessionKeys:
+    jti: str
+    private_key: Any
+
+    async def message_keys(self, links: Iterable[tuple[int, bytes]]) -> dict[int, bytes]:
+        links = list(links)
+        keys = await run_in_threadpool(session_store.get_message_keys, self.jti, [link_id for link_id, _ in links])
+        missing = [(link_id, aes_key_enc) for link_id, aes_key_enc in links if link_id not in keys]
+        if missing:
+            # Wszystkie brakujące klucze odpakowujemy jednym zadaniem executora.
+            unwrapped = await get_crypto_executor().run(
+                OP_RSA, unwrap_aes_keys, [aes_key_enc for _, aes_key_enc in missing], self.private_key
+            )
+            fresh = {link_id: aes_key for (link_id, _), aes_key in zip(missing, unwrapped)}
+            await run_in_threadpool(session_store.store_message_keys, self.jti, fresh)
+            keys.update(fresh)
+        return keys
+
+    async def message_key(self, link_id: int, aes_key_enc: bytes) -> bytes:
+        return (await self.message_keys([(link_id, aes_key_enc)]))[link_id]
+
+
 def get_token_data(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)) -> TokenData:
     if credentials is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Brak uwierzytelnienia")
@@ -32,11 +63,28 @@ def get_token_data(credentials: HTTPAuthorizationCredentials = Depends(bearer_sc
     return TokenData(user_id=user_id, jti=jti)
 
 
-def get_current_user(token_data: TokenData = Depends(get_token_data), db: Session = Depends(get_db)) -> models.User:
-    user = db.get(models.User, token_data.user_id)
-    if user is None:
+def _load_principal(db: Session, user_id: int) -> Principal | None:
+    user = db.get(models.User, user_id, options=[load_only(models.User.id, models.User.email)])
+    return Principal(id=user.id, email=user.email) if user else None
+
+
+async def get_current_user(token_data: TokenData = Depends(get_token_data), db: AsyncSession = Depends(get_db)) -> Principal:
+    # Principal zapisany przy logowaniu żyje tyle co sesja; baza tylko gdy sesji już nie ma (np. po restarcie).
+    # Magazyn sesji może być zdalny (pomocnik na gnieździe), więc wołamy go poza pętlą zdarzeń.
+    principal = await run_in_threadpool(session_store.get_principal, token_data.jti)
+    if principal is None or principal.id != token_data.user_id:
+        principal = await db.run_sync(_load_principal, token_data.user_id)
+    if principal is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Nieprawidłowy token")
-    return user
+    return principal
+
+
+def get_session_principal(token_data: TokenData = Depends(get_token_data)) -> Principal:
+    # Dla długotrwałych połączeń: wymaga aktywnej sesji i nie otwiera sesji bazy.
+    principal = session_store.get_principal(token_data.jti)
+    if principal is None or principal.id != token_data.user_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Sesja wygasła")
+    return principal
 
 
 def get_current_private_key(token_data: TokenData = Depends(get_token_data)) -> bytes:
@@ -44,3 +92,18 @@ def get_current_private_key(token_data: TokenData = Depends(get_token_data)) ->
     if private_key is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Sesja wygasła")
     return private_key
+
+
+def get_session_keys(
+    token_data: TokenData = Depends(get_token_data),
+    private_key=Depends(get_current_private_key),
+) -> SessionKeys:
+    return SessionKeys(jti=token_data.jti, private_key=private_key)
+
+
+def require_metrics_token(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)) -> None:
+    # Metryki zdradzają czasy operacji i liczbę sesji, więc bez skonfigurowanego tokenu ich nie ma.
+    if not settings.metrics_token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if credentials is None or not secrets.compare_digest(credentials.credentials, settings.metrics_token):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Brak uwierzytelnienia")
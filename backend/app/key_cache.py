@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from .config import get_settings
+from .crypto_utils import key_fingerprint, load_public_key
+
+settings = get_settings()
+
+# Wczytane obiekty kluczy publicznych (LRU), kluczowane (user_id, odcisk PEM). Odcisk w kluczu sprawia,
+# że po zmianie klucza użytkownika stary wpis nigdy nie zostanie użyty, nawet bez jawnego unieważnienia.
+_keys: "OrderedDict[tuple[int, bytes], Any]" = OrderedDict()
+_keys_by_user: dict[int, set[bytes]] = {}
+_lock = threading.Lock()
+_hits = 0
+_misses = 0
+
+
+def _forget(user_id: int, fingerprint: bytes) -> None:
+    fingerprints = _keys_by_user.get(user_id)
+    if fingerprints is not None:
+        fingerprints.discard(fingerprint)
+        if not fingerprints:
+            _keys_by_user.pop(user_id, None)
+
+
+def get_public_key(user_id: int, public_key_pem: bytes) -> Any:
+    global _hits, _misses
+    entry = (user_id, key_fingerprint(public_key_pem))
+    with _lock:
+        public_key = _keys.get(entry)
+        if public_key is not None:
+            _keys.move_to_end(entry)
+            _hits += 1
+            return public_key
+        _misses += 1
+
+    # Parsowanie poza blokadą; równoległe chybienia dla tego samego klucza dają ten sam wynik.
+    public_key = load_public_key(public_key_pem)
+    limit = settings.public_key_cache_size
+    if limit <= 0:
+        return public_key
+    with _lock:
+        _keys[entry] = public_key
+        _keys.move_to_end(entry)
+        _keys_by_user.setdefault(user_id, set()).add(entry[1])
+        while len(_keys) > limit:
+            (old_user_id, old_fingerprint), _ = _keys.popitem(last=False)
+            _forget(old_user_id, old_fingerprint)
+    return public_key
+
+
+def invalidate_user(user_id: int) -> None:
+    # Wywoływać po zmianie kluczy użytkownika, żeby od razu zwolnić nieaktualne wpisy.
+    with _lock:
+        for fingerprint in _keys_by_user.pop(user_id, ()):
+            _keys.pop((user_id, fingerprint), None)
+
+
+def stats() -> dict:
+    with _lock:
+        return {"size": len(_keys), "capacity": settings.public_key_cache_size, "hits": _hits, "misses": _misses}
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import lru_cache
+
+from .config import get_settings
+from .crypto_utils import OP_KEYGEN, CryptoBusyError, generate_rsa_keypair, get_crypto_executor
+
+logger = logging.getLogger(__name__)
+
+# Okno, z którego liczymy tempo uzupełniania puli.
+_RATE_WINDOW_SECONDS = 60.0
+# Przerwa po nieudanej generacji (przepełniona kolejka executora, zepsuta pula procesów).
+_RETRY_DELAY_SECONDS = 1.0
+
+
+class KeypairPool:
+    # Gotowe pary kluczy RSA w pamięci procesu. Uzupełnianie rusza, gdy liczba kluczy spadnie
+    # poniżej low, i trwa aż do high; stan zmieniany jest wyłącznie w pętli zdarzeń.
+    def __init__(self, low: int, high: int, workers: int):
+        self.low = low
+        self.high = high
+        self._workers = workers
+        self._keys: deque[tuple[bytes, bytes]] = deque()
+        self._in_flight = 0
+        self._wakeup: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._generated_at: deque[float] = deque()
+        self.generated_total = 0
+        self.taken_total = 0
+        self.fallback_total = 0
+
+    def start(self) -> None:
+        if self.high <= 0 or self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._tasks = [asyncio.create_task(self._refill_loop()) for _ in range(max(self._workers, 1))]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._keys.clear()
+
+    async def _refill_loop(self) -> None:
+        crypto = get_crypto_executor()
+        while True:
+            await self._wakeup.wait()
+            if len(self._keys) + self._in_flight >= self.high:
+                self._wakeup.clear()
+                continue
+            self._in_flight += 1
+            try:
+                keypair = await crypto.run(OP_KEYGEN, generate_rsa_keypair)
+            except CryptoBusyError:
+                await asyncio.sleep(_RETRY_DELAY_SECONDS)
+                continue
+            except Exception:
+                logger.exception("keypair pool refill failed")
+                await asyncio.sleep(_RETRY_DELAY_SECONDS)
+                continue
+            finally:
+                self._in_flight -= 1
+            self._keys.append(keypair)
+            self.generated_total += 1
+            self._generated_at.append(time.monotonic())
+
+    def take(self) -> tuple[bytes, bytes] | None:
+        keypair = self._keys.popleft() if self._keys else None
+        if keypair is not None:
+            self.taken_total += 1
+        if self._wakeup is not None and len(self._keys) < self.low:
+            self._wakeup.set()
+        return keypair
+
+    async def acquire(self) -> tuple[bytes, bytes]:
+        keypair = self.take()
+        if keypair is None:
+            self.fallback_total += 1
+            keypair = await get_crypto_executor().run(OP_KEYGEN, generate_rsa_keypair)
+        return keypair
+
+    def stats(self) -> dict:
+        cutoff = time.monotonic() - _RATE_WINDOW_SECONDS
+        while self._generated_at and self._generated_at[0] < cutoff:
+            self._generated_at.popleft()
+        return {
+            "depth": len(self._keys),
+            "low_watermark": self.low,
+            "high_watermark": self.high,
+            "in_flight": self._in_flight,
+            "generated_total": self.generated_total,
+            "taken_total": self.taken_total,
+            "fallback_total": self.fallback_total,
+            "refill_per_minute": len(self._generated_at) * 60.0 / _RATE_WINDOW_SECONDS,
+        }
+
+
+@lru_cache
+def get_keypair_pool() -> KeypairPool:
+    settings = get_settings()
+    return KeypairPool(
+        low=settings.keypair_pool_low,
+        high=settings.keypair_pool_high,
+        workers=settings.keypair_pool_workers,
+    )
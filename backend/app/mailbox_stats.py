@@ -0,0 +1,120 @@
+import argparse
+
+from sqlalchemy import case, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import models
+from .crypto_utils import AES_GCM_TAG_SIZE
+from .database import SessionLocal
+
+
+def message_bytes():
+    # Rozmiar wiadomości w skrzynce: zaszyfrowany temat i treść plus rozmiar załączników.
+    attachment_bytes = (
+        select(
+            func.coalesce(
+                func.sum(
+                    func.coalesce(models.Attachment.size, func.length(models.Attachment.data) - AES_GCM_TAG_SIZE)
+                ),
+                0,
+            )
+        )
+        .where(models.Attachment.message_id == models.Message.id)
+        .correlate(models.Message)
+        .scalar_subquery()
+    )
+    return func.length(models.Message.subject_enc) + func.length(models.Message.body_enc) + attachment_bytes
+
+
+def _upsert(db: Session, rows: list[dict], increment: bool) -> None:
+    stats = models.MailboxStats
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert(stats)
+        columns = ("total", "unread", "storage_bytes")
+        if increment:
+            set_ = {name: getattr(stats, name) + getattr(stmt.excluded, name) for name in columns}
+        else:
+            set_ = {name: getattr(stmt.excluded, name) for name in columns}
+        db.execute(stmt.on_conflict_do_update(index_elements=["user_id"], set_=set_), rows)
+        return
+    for row in rows:
+        values = {name: value for name, value in row.items() if name != "user_id"}
+        if increment:
+            values = {name: getattr(stats, name) + value for name, value in values.items()}
+        updated = db.execute(update(stats).where(stats.user_id == row["user_id"]).values(values)).rowcount
+        if not updated:
+            db.add(stats(**row))
+    db.flush()
+
+
+def apply_deltas(db: Session, deltas: dict[int, tuple[int, int, int]]) -> None:
+    # Dodaje (total, unread, storage_bytes) do liczników użytkowników w bieżącej transakcji.
+    rows = [
+        {"user_id": user_id, "total": total, "unread": unread, "storage_bytes": storage_bytes}
+        for user_id, (total, unread, storage_bytes) in deltas.items()
+        if total or unread or storage_bytes
+    ]
+    if rows:
+        _upsert(db, rows, increment=True)
+
+
+def reconcile(batch_size: int) -> int:
+    # Odbudowuje liczniki z message_recipients partiami użytkowników, np. po wdrożeniu tabeli
+    # na istniejącej bazie albo po ręcznych zmianach w danych.
+    link = models.MessageRecipient
+    rebuilt = 0
+    last_id = 0
+    while True:
+        with SessionLocal() as db:
+            user_ids = db.scalars(
+                select(models.User.id).where(models.User.id > last_id).order_by(models.User.id).limit(batch_size)
+            ).all()
+            if not user_ids:
+                return rebuilt
+            counts = {
+                row.recipient_id: row
+                for row in db.execute(
+                    select(
+                        link.recipient_id,
+                        func.count(link.id).label("total"),
+                        func.sum(case((link.read_at.is_(None), 1), else_=0)).label("unread"),
+                        func.coalesce(func.sum(message_bytes()), 0).label("storage_bytes"),
+                    )
+                    .join(models.Message, models.Message.id == link.message_id)
+                    .where(link.recipient_id.in_(user_ids), link.deleted_at.is_(None))
+                    .group_by(link.recipient_id)
+                )
+            }
+            rows = []
+            for user_id in user_ids:
+                row = counts.get(user_id)
+                rows.append(
+                    {
+                        "user_id": user_id,
+                        "total": row.total if row else 0,
+                        "unread": row.unread if row else 0,
+                        "storage_bytes": row.storage_bytes if row else 0,
+                    }
+                )
+            _upsert(db, rows, increment=False)
+            db.commit()
+            rebuilt += len(user_ids)
+            last_id = user_ids[-1]
+            print(f"przeliczono liczniki {rebuilt} skrzynek (ostatnie id {last_id})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Liczniki skrzynek SecureMail")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("reconcile", help="przelicza liczniki skrzynek z tabel źródłowych")
+    rebuild.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    if args.command == "reconcile":
+        reconcile(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
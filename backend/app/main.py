@@ -1,11 +1,48 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
 
-from .database import Base, engine
+from fastapi import APIRouter, Depends, FastAPI, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from .config import get_settings
+from .crypto_utils import CryptoBusyError, get_crypto_executor
+from . import key_cache, metrics, schema_upgrade, search_index, session_store
+from .delivery import get_delivery_queue
+from .dependencies import require_metrics_token
+from .keypair_pool import get_keypair_pool
+from .notifications import get_notification_hub
+from .rate_limiter import get_rate_limiter
 from .routers import auth, attachments, messages
 
-Base.metadata.create_all(bind=engine)
+settings = get_settings()
+
+schema_upgrade.upgrade_schema()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    session_store.get_backend().start()
+    get_keypair_pool().start()
+    get_delivery_queue().start()
+    yield
+    await search_index.stop_backfills()
+    await get_delivery_queue().stop()
+    session_store.get_backend().stop()
+    await get_keypair_pool().stop()
+    get_crypto_executor().shutdown()
+
 
-app = FastAPI(title="SecureMail API")
+app = FastAPI(title="SecureMail API", lifespan=lifespan)
+app.add_middleware(metrics.TimingMiddleware, server_timing=settings.server_timing_enabled)
+
+
+@app.exception_handler(CryptoBusyError)
+async def crypto_busy_handler(request: Request, exc: CryptoBusyError) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Serwer jest przeciążony, spróbuj później"},
+        headers={"Retry-After": "1"},
+    )
 
 
 @app.get("/health")
@@ -13,6 +50,40 @@ def health() -> dict:
     return {"status": "ok"}
 
 
+metrics_router = APIRouter(prefix="/metrics", tags=["metrics"], dependencies=[Depends(require_metrics_token)])
+
+
+@metrics_router.get("", response_class=PlainTextResponse)
+async def prometheus_metrics() -> PlainTextResponse:
+    # Przy backendzie socket liczniki sesji i limitów zwraca pomocnik sesji, więc pytamy go poza pętlą zdarzeń.
+    sessions = await run_in_threadpool(session_store.get_backend().session_count)
+    rate_limit_keys = await run_in_threadpool(len, get_rate_limiter())
+    gauges = {
+        "securemail_sessions": ("Sesje w magazynie sesji.", sessions),
+        "securemail_rate_limiter_keys": ("Klucze śledzone przez limity żądań.", rate_limit_keys),
+        **metrics.stats_gauges("securemail_public_key_cache", "Pamięć podręczna kluczy publicznych", key_cache.stats()),
+        **metrics.stats_gauges("securemail_keypair_pool", "Pula par kluczy", get_keypair_pool().stats()),
+        **metrics.stats_gauges("securemail_notifications", "Połączenia SSE", get_notification_hub().stats()),
+    }
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+
+@metrics_router.get("/public-key-cache")
+def public_key_cache_metrics() -> dict:
+    return key_cache.stats()
+
+
+@metrics_router.get("/keypair-pool")
+async def keypair_pool_metrics() -> dict:
+    return get_keypair_pool().stats()
+
+
+@metrics_router.get("/notifications")
+async def notification_metrics() -> dict:
+    return get_notification_hub().stats()
+
+
+app.include_router(metrics_router)
 app.include_router(auth.router)
 app.include_router(messages.router)
 app.include_router(attachments.router)
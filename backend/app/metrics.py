@@ -0,0 +1,234 @@
+import asyncio
+import math
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Iterable
+
+from fastapi.routing import APIRoute
+from starlette.datastructures import MutableHeaders
+
+PHASE_DB = "db"
+PHASE_CRYPTO = "crypto"
+PHASE_SERIALIZE = "serialize"
+PHASES = (PHASE_DB, PHASE_CRYPTO, PHASE_SERIALIZE)
+
+# Granice kubełków histogramów w sekundach.
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_UNMATCHED_ROUTE = "<unmatched>"
+
+
+class RequestTimings:
+    # Czas żądania rozbity na fazy. Obiekt jest wspólny dla kontekstu żądania i jego kopii w pulach
+    # wątków (run_in_threadpool kopiuje kontekst), więc dopisywanie chroni blokada.
+    __slots__ = ("phases", "endpoint_done", "_lock")
+
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.endpoint_done: float | None = None
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[phase] += seconds
+
+    def server_timing(self, total: float) -> str:
+        parts = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.phases.items()]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: ContextVar[RequestTimings | None] = ContextVar("securemail_request_timings", default=None)
+# Ustawiona w trakcie mierzonej fazy, żeby zagnieżdżone prymitywy (np. unwrap_aes_keys -> unwrap_aes_key)
+# nie były liczone podwójnie.
+_in_phase: ContextVar[bool] = ContextVar("securemail_in_phase", default=False)
+
+
+def current_timings() -> RequestTimings | None:
+    return _current.get()
+
+
+def record(phase: str, seconds: float) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+def timed(phase: str) -> Callable:
+    # Dekorator doliczający czas wywołania do fazy bieżącego żądania; poza żądaniem tylko wywołuje funkcję.
+
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            timings = _current.get()
+            if timings is None or _in_phase.get():
+                return fn(*args, **kwargs)
+            token = _in_phase.set(True)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings.add(phase, time.perf_counter() - started)
+                _in_phase.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...], buckets: tuple[float, ...] = _BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # etykiety -> [liczniki kubełków..., suma, liczba]
+        self._series: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, labels: tuple[str, ...], value: float) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            base = _labels(zip(self.label_names, labels))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{{{base},le=\"{bound}\"}} {count}")
+            lines.append(f"{self.name}_bucket{{{base},le=\"+Inf\"}} {series[-1]}")
+            lines.append(f"{self.name}_sum{{{base}}} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{base}}} {series[-1]}")
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "securemail_request_duration_seconds", "Czas obsługi żądania HTTP.", ("method", "route", "status")
+)
+REQUEST_PHASE = Histogram(
+    "securemail_request_phase_seconds",
+    "Czas żądania spędzony w bazie (db), kryptografii (crypto) i serializacji odpowiedzi (serialize).",
+    ("method", "route", "phase"),
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs: Iterable[tuple[str, str]]) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+
+
+def render(gauges: dict[str, tuple[str, float]]) -> str:
+    # Metryki w formacie tekstowym Prometheusa: histogramy żądań i podane wartości (nazwa -> (opis, wartość)).
+    lines = REQUEST_DURATION.render() + REQUEST_PHASE.render()
+    for name, (help_text, value) in sorted(gauges.items()):
+        kind = "counter" if name.endswith("_total") else "gauge"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {_number(value)}"]
+    return "\n".join(lines) + "\n"
+
+
+def _number(value: float) -> str:
+    if isinstance(value, bool) or isinstance(value, int):
+        return str(int(value))
+    return "NaN" if math.isnan(value) else f"{value:.6g}"
+
+
+def stats_gauges(prefix: str, help_text: str, stats: dict) -> dict[str, tuple[str, float]]:
+    # Liczbowe pola słowników z /metrics/* jako osobne metryki.
+    return {
+        f"{prefix}_{key}": (f"{help_text}: {key}.", value)
+        for key, value in stats.items()
+        if isinstance(value, (int, float))
+    }
+
+
+class TimedRoute(APIRoute):
+    # Serializacja to czas od powrotu endpointu do gotowej odpowiedzi: walidacja response_model i JSON.
+    def get_route_handler(self) -> Callable:
+        endpoint = self.dependant.call
+        if asyncio.iscoroutinefunction(endpoint):
+
+            @wraps(endpoint)
+            async def call(*args: Any, **kwargs: Any) -> Any:
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    _mark_endpoint_done()
+
+        else:
+
+            @wraps(endpoint)
+            def call(*args: Any, **kwargs: Any) -> Any:
+                try:
+                    return endpoint(*args, **kwargs)
+                finally:
+                    _mark_endpoint_done()
+
+        self.dependant.call = call
+        handler = super().get_route_handler()
+
+        async def timed_handler(request) -> Any:
+            response = await handler(request)
+            timings = _current.get()
+            if timings is not None and timings.endpoint_done is not None:
+                timings.add(PHASE_SERIALIZE, time.perf_counter() - timings.endpoint_done)
+            return response
+
+        return timed_handler
+
+
+def _mark_endpoint_done() -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.endpoint_done = time.perf_counter()
+
+
+class TimingMiddleware:
+    # Zbiera fazy żądania do histogramów per trasa; z server_timing dopisuje też nagłówek Server-Timing.
+    # Nagłówek powstaje na początku odpowiedzi, więc dla strumieni (pobieranie załączników) obejmuje
+    # tylko pracę przed pierwszym bajtem; histogramy obejmują całe żądanie.
+    def __init__(self, app, server_timing: bool = False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.server_timing:
+                    MutableHeaders(scope=message).append(
+                        "Server-Timing", timings.server_timing(time.perf_counter() - started)
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", _UNMATCHED_ROUTE)
+            method = scope["method"]
+            REQUEST_DURATION.observe((method, path, str(status_code)), time.perf_counter() - started)
+            for phase, seconds in timings.phases.items():
+                REQUEST_PHASE.observe((method, path, phase), seconds)
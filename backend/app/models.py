@@ -1,18 +1,30 @@
 from sqlalchemy import (
+    BigInteger,
+    Boolean,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     LargeBinary,
     String,
     Text,
     UniqueConstraint,
+    false,
     func,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import deferred, relationship
 
 from .database import Base
 
+# SQLite zapisuje CURRENT_TIMESTAMP z dokładnością do sekundy; parametry porównań (kursory)
+# muszą mieć ten sam format tekstowy, inaczej porównania leksykalne są błędne.
+ServerTimestamp = DateTime().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
 
 class User(Base):
     __tablename__ = "users"
@@ -21,11 +33,17 @@ class User(Base):
     email = Column(String, unique=True, index=True, nullable=False)
     password_hash = Column(String, nullable=False)
     totp_secret = Column(String, nullable=False)
+    # Zestaw kluczy: "rsa" (public_key_pem to RSA) albo "x25519-ed25519" (public_key_pem to X25519,
+    # signing_public_key_pem to Ed25519); private_key_enc szyfruje odpowiednio PEM RSA albo surowe klucze EC.
+    key_suite = Column(String, nullable=False, server_default="rsa")
     public_key_pem = Column(LargeBinary, nullable=False)
+    signing_public_key_pem = Column(LargeBinary, nullable=True)
     private_key_enc = Column(LargeBinary, nullable=False)
     private_key_salt = Column(LargeBinary, nullable=False)
     private_key_nonce = Column(LargeBinary, nullable=False)
-    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    # Opcjonalny indeks wyszukiwania (search_tokens) dla skrzynki odbiorczej.
+    search_enabled = Column(Boolean, nullable=False, server_default=false())
+    created_at = Column(ServerTimestamp, server_default=func.now(), nullable=False)
 
     messages_sent = relationship("Message", back_populates="sender", cascade="all, delete-orphan")
     inbox = relationship("MessageRecipient", back_populates="recipient", cascade="all, delete-orphan")
@@ -42,7 +60,11 @@ class Message(Base):
     body_nonce = Column(LargeBinary, nullable=False)
     signature = Column(LargeBinary, nullable=False)
     signature_algo = Column(String, nullable=False)
-    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    # Wynik weryfikacji podpisu i odcisk klucza nadawcy, którym go sprawdzono; wiadomość jest niezmienna,
+    # więc wynik jest ważny, dopóki nadawca ma ten sam klucz.
+    signature_verified = Column(Boolean, nullable=True)
+    signature_key_fingerprint = Column(LargeBinary, nullable=True)
+    created_at = Column(ServerTimestamp, server_default=func.now(), nullable=False, index=True)
 
     sender = relationship("User", back_populates="messages_sent")
     recipients = relationship("MessageRecipient", back_populates="message", cascade="all, delete-orphan")
@@ -51,12 +73,16 @@ class Message(Base):
 
 class MessageRecipient(Base):
     __tablename__ = "message_recipients"
-    __table_args__ = (UniqueConstraint("message_id", "recipient_id", name="uix_message_recipient"),)
+    __table_args__ = (
+        UniqueConstraint("message_id", "recipient_id", name="uix_message_recipient"),
+        Index("ix_message_recipients_inbox", "recipient_id", "deleted_at", "message_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
     recipient_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     aes_key_enc = Column(LargeBinary, nullable=False)
+    wrap_algo = Column(String, nullable=False, server_default="RSA-OAEP-SHA256")
     read_at = Column(DateTime, nullable=True)
     deleted_at = Column(DateTime, nullable=True)
 
@@ -64,15 +90,72 @@ class MessageRecipient(Base):
     recipient = relationship("User", back_populates="inbox")
 
 
+class SearchToken(Base):
+    # Ślepy indeks: HMAC słów tematu i adresu nadawcy kluczem wyprowadzonym z klucza prywatnego odbiorcy.
+    __tablename__ = "search_tokens"
+    __table_args__ = (
+        Index("ix_search_tokens_lookup", "recipient_id", "token", "link_id"),
+        UniqueConstraint("link_id", "token", name="uix_search_token"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    recipient_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    link_id = Column(Integer, ForeignKey("message_recipients.id"), nullable=False)
+    token = Column(LargeBinary, nullable=False)
+
+
+class MailboxStats(Base):
+    # Liczniki skrzynki odbiorczej aktualizowane w tej samej transakcji co message_recipients;
+    # odbudowa: python -m app.mailbox_stats reconcile.
+    __tablename__ = "mailbox_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    total = Column(Integer, nullable=False, server_default="0")
+    unread = Column(Integer, nullable=False, server_default="0")
+    storage_bytes = Column(BigInteger, nullable=False, server_default="0")
+
+
+class Delivery(Base):
+    __tablename__ = "deliveries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    sender_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    status = Column(String, nullable=False, server_default="pending")
+    # Lista id odbiorców (JSON) w kolejności doręczania.
+    recipient_ids = Column(Text, nullable=False)
+    total = Column(Integer, nullable=False)
+    delivered = Column(Integer, nullable=False, server_default="0")
+    attempts = Column(Integer, nullable=False, server_default="0")
+    error = Column(String, nullable=True)
+    # Klucz AES wiadomości zaszyfrowany kluczem serwera; NULL po zakończeniu doręczania.
+    key_enc = Column(LargeBinary, nullable=True)
+    key_nonce = Column(LargeBinary, nullable=True)
+    created_at = Column(ServerTimestamp, server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime, nullable=True)
+
+
 class Attachment(Base):
     __tablename__ = "attachments"
 
     id = Column(Integer, primary_key=True, index=True)
-    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    # NULL dopóki załącznik jest tylko przesłany (staged) i nie został dołączony do wiadomości
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
+    uploader_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     filename = Column(String, nullable=False)
     content_type = Column(String, nullable=False)
-    data = Column(LargeBinary, nullable=False)
+    # Szyfrogram trzymany w magazynie blobów (blob_ref); kolumna data tylko dla starszych wierszy.
+    data = deferred(Column(LargeBinary, nullable=True))
+    blob_ref = Column(String, nullable=True)
     nonce = Column(LargeBinary, nullable=False)
-    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    size = Column(BigInteger, nullable=True)
+    digest = Column(LargeBinary, nullable=True)
+    format_version = Column(Integer, nullable=False, server_default="1")
+    # Klucz pliku: przed wysłaniem zaszyfrowany kluczem publicznym uploadera,
+    # po wysłaniu kluczem AES wiadomości. Starsze załączniki używają bezpośrednio klucza wiadomości.
+    staged_key_enc = Column(LargeBinary, nullable=True)
+    key_wrap = Column(LargeBinary, nullable=True)
+    key_wrap_nonce = Column(LargeBinary, nullable=True)
+    created_at = Column(ServerTimestamp, server_default=func.now(), nullable=False)
 
     message = relationship("Message", back_populates="attachments")
@@ -0,0 +1,89 @@
+import asyncio
+from collections import deque
+from functools import lru_cache
+from typing import Iterable
+
+from .config import get_settings
+
+settings = get_settings()
+
+EVENT_MESSAGE = "message"
+EVENT_STATE = "state"
+# Wysyłane zamiast zgubionych zdarzeń: klient powinien pobrać skrzynkę od nowa.
+EVENT_RESYNC = "resync"
+
+
+class Subscription:
+    # Ograniczona kolejka zdarzeń jednego połączenia. Gdy klient nie nadąża, porzucamy zaległe
+    # zdarzenia i wysyłamy jedno EVENT_RESYNC, więc pamięć połączenia nie rośnie ponad max_events.
+    def __init__(self, user_id: int, max_events: int):
+        self.user_id = user_id
+        self._events: deque[dict] = deque()
+        self._max_events = max(max_events, 1)
+        self._overflowed = False
+        self._wakeup = asyncio.Event()
+
+    def push(self, event: dict) -> None:
+        if self._overflowed:
+            return
+        if len(self._events) >= self._max_events:
+            self._events.clear()
+            self._overflowed = True
+        else:
+            self._events.append(event)
+        self._wakeup.set()
+
+    async def get(self) -> dict:
+        while not self._events and not self._overflowed:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        if self._overflowed:
+            self._overflowed = False
+            return {"type": EVENT_RESYNC}
+        return self._events.popleft()
+
+
+class NotificationHub:
+    # Zdarzenia skrzynki dla połączeń w tym procesie; używany wyłącznie z pętli zdarzeń.
+    def __init__(self, max_connections_per_user: int, max_events: int):
+        self._max_connections_per_user = max_connections_per_user
+        self._max_events = max_events
+        self._subscribers: dict[int, set[Subscription]] = {}
+
+    def has_capacity(self, user_id: int) -> bool:
+        return len(self._subscribers.get(user_id, ())) < self._max_connections_per_user
+
+    def subscribe(self, user_id: int) -> Subscription | None:
+        if not self.has_capacity(user_id):
+            return None
+        subscribers = self._subscribers.setdefault(user_id, set())
+        subscription = Subscription(user_id, self._max_events)
+        subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[subscription.user_id]
+
+    def publish(self, user_ids: Iterable[int], event: dict) -> None:
+        for user_id in user_ids:
+            for subscription in self._subscribers.get(user_id, ()):
+                subscription.push(event)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._subscribers),
+            "connections": sum(len(subscribers) for subscribers in self._subscribers.values()),
+        }
+
+
+@lru_cache
+def get_notification_hub() -> NotificationHub:
+    return NotificationHub(
+        max_connections_per_user=settings.notify_max_connections_per_user,
+        max_events=settings.notify_queue_max,
+    )
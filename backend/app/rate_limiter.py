@@ -1,28 +1,137 @@
-import time
+import math
 import threading
-from collections import deque
-from typing import Deque, Dict
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable
+
+from fastapi import Depends, HTTPException, Request, status
+
+from . import session_store
+from .config import get_settings
+from .dependencies import TokenData, get_token_data
 
+settings = get_settings()
+
+# per "ip": przed uwierzytelnieniem liczymy adres klienta; per "user": zalogowanego użytkownika, więc
+# użytkownicy za jednym NAT-em lub proxy firmowym nie dzielą limitu.
 RateLimitConfig = {
-    "login": {"limit": 5, "window": 60},  # 5 prób na 60 sekund na IP
+    "login": {"limit": 5, "window": 60, "per": "ip"},  # 5 prób na 60 sekund na IP
+    "register": {"limit": 10, "window": 3600, "per": "ip"},
+    "send": {"limit": 60, "window": 60, "per": "user"},
+    "list": {"limit": 120, "window": 60, "per": "user"},
+    "download": {"limit": 120, "window": 60, "per": "user"},
+    "upload": {"limit": 30, "window": 60, "per": "user"},
 }
 
-_lock = threading.Lock()
-_buckets: Dict[str, Dict[str, Deque[float]]] = {"login": {}}
-
-
-def check_rate_limit(kind: str, key: str) -> bool:
-    cfg = RateLimitConfig.get(kind)
-    if not cfg:
-        return True
-    limit = cfg["limit"]
-    window = cfg["window"]
-    now = time.time()
-    with _lock:
-        bucket = _buckets.setdefault(kind, {}).setdefault(key, deque())
-        while bucket and now - bucket[0] > window:
-            bucket.popleft()
-        if len(bucket) >= limit:
-            return False
-        bucket.append(now)
-        return True
+
+class RateLimiter:
+    # Licznik z przesuwnym oknem: dla każdego klucza tylko początek okna i liczniki bieżącego
+    # oraz poprzedniego okna. Każda polityka ma własny słownik w kolejności ostatniego użycia; okno
+    # jest w nim wspólne, więc bezczynne (dłużej niż dwa okna) wpisy są na jego początku.
+    # Nadmiarowe ponad max_keys usuwamy z najliczniejszej polityki.
+    def __init__(self, max_keys: int):
+        self._max_keys = max(max_keys, 1)
+        self._lock = threading.Lock()
+        self._policies: "dict[str, OrderedDict[str, list[float]]]" = {}
+
+    def hit(self, kind: str, key: str) -> float:
+        # Rejestruje żądanie; zwraca 0, gdy jest dozwolone, inaczej liczbę sekund do ponowienia.
+        cfg = RateLimitConfig.get(kind)
+        if not cfg:
+            return 0.0
+        limit = cfg["limit"]
+        window = float(cfg["window"])
+        now = time.time()
+        with self._lock:
+            entries = self._policies.setdefault(kind, OrderedDict())
+            entry = entries.get(key)
+            if entry is None:
+                # [początek okna, bieżące, poprzednie]
+                entry = entries[key] = [now, 0, 0]
+            else:
+                entries.move_to_end(key)
+                elapsed = now - entry[0]
+                if elapsed >= window:
+                    entry[2] = entry[1] if elapsed < 2 * window else 0
+                    entry[1] = 0
+                    entry[0] += window * math.floor(elapsed / window)
+            self._evict(now)
+
+            weight = 1.0 - (now - entry[0]) / window
+            if entry[2] * weight + entry[1] + 1 <= limit:
+                entry[1] += 1
+                return 0.0
+            if entry[1] + 1 > limit:
+                return entry[0] + window - now
+            # Czekamy, aż udział poprzedniego okna spadnie na tyle, by zmieścić jeszcze jedno żądanie.
+            return max(entry[0] + window * (1.0 - (limit - 1 - entry[1]) / entry[2]) - now, 0.001)
+
+    def _evict(self, now: float) -> None:
+        for kind, entries in self._policies.items():
+            window = float(RateLimitConfig[kind]["window"])
+            while entries:
+                start = next(iter(entries.values()))[0]
+                if now - start < 2 * window:
+                    break
+                entries.popitem(last=False)
+        while len(self) > self._max_keys:
+            max(self._policies.values(), key=len).popitem(last=False)
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._policies.values())
+
+
+class SocketRateLimiter:
+    # Liczniki trzymane przez pomocnika sesji, wspólne dla wszystkich workerów hosta.
+    def __init__(self, client: session_store.SocketClient):
+        self._call = client.call
+
+    def hit(self, kind: str, key: str) -> float:
+        return self._call("rate_limit_hit", kind, key)
+
+    def __len__(self) -> int:
+        return self._call("rate_limit_key_count")
+
+
+@lru_cache
+def get_rate_limiter() -> RateLimiter | SocketRateLimiter:
+    if settings.session_store_backend == "socket":
+        return SocketRateLimiter(session_store.get_shared_client())
+    return RateLimiter(settings.rate_limit_max_keys)
+
+
+def client_ip(request: Request) -> str:
+    # Pierwsze wpisy X-Forwarded-For ustawia klient, więc ufamy tylko wpisom dopisanym przez nasze proxy:
+    # przy N zaufanych proxy adres klienta to N-ty wpis od końca.
+    peer = request.client.host if request.client else "unknown"
+    if settings.trusted_proxy_count <= 0:
+        return peer
+    forwarded = [part.strip() for part in request.headers.get("x-forwarded-for", "").split(",") if part.strip()]
+    if len(forwarded) < settings.trusted_proxy_count:
+        return peer
+    return forwarded[-settings.trusted_proxy_count]
+
+
+def _enforce(kind: str, key: str) -> None:
+    retry_after = get_rate_limiter().hit(kind, key)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Zbyt wiele prób, spróbuj później",
+            headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+        )
+
+
+def rate_limit(kind: str) -> Callable[..., None]:
+    if RateLimitConfig[kind]["per"] == "user":
+
+        def user_dependency(token_data: TokenData = Depends(get_token_data)) -> None:
+            _enforce(kind, f"user:{token_data.user_id}")
+
+        return user_dependency
+
+    def dependency(request: Request) -> None:
+        _enforce(kind, client_ip(request))
+
+    return dependency
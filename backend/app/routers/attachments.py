@@ -1,13 +1,46 @@
-from fastapi import APIRouter, Depends, HTTPException, Response, status
-from sqlalchemy.orm import Session
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import re
+from typing import Callable, Iterator
 from urllib.parse import quote
 
-from .. import models
-from ..crypto_utils import decrypt_payload, unwrap_aes_key
-from ..database import get_db
-from ..dependencies import get_current_private_key, get_current_user
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .. import key_cache, models, schemas
+from ..blob_store import BlobWriter, get_blob_store
+from ..config import get_settings
+from ..crypto_utils import (
+    AES_GCM_TAG_SIZE,
+    ATTACHMENT_FORMAT_SEGMENTED,
+    ATTACHMENT_SEGMENT_SIZE,
+    OP_RSA,
+    SegmentedEncryptor,
+    decrypt_payload,
+    decrypt_segment,
+    generate_aes_key,
+    get_crypto_executor,
+    segment_count,
+    segment_span,
+    sha256_digest,
+    wrap_aes_key_for_recipient,
+)
+from ..database import SessionLocal, get_db
+from ..dependencies import Principal, SessionKeys, get_current_user, get_session_keys
+from ..metrics import TimedRoute
+from ..rate_limiter import rate_limit
+
+router = APIRouter(prefix="/attachments", tags=["attachments"], route_class=TimedRoute)
+settings = get_settings()
 
-router = APIRouter(prefix="/attachments", tags=["attachments"])
+# Ile segmentów odczytujemy z bazy jednym zapytaniem podczas strumieniowania.
+_SEGMENTS_PER_READ = 16
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
 
 
 def build_disposition(filename: str) -> str:
@@ -16,20 +49,198 @@ def build_disposition(filename: str) -> str:
     return f'attachment; filename="{ascii_name}"; filename*=UTF-8\'\'{encoded}'
 
 
-@router.get("/{attachment_id}")
-def download_attachment(
+def parse_range(range_header: str | None, size: int) -> tuple[int, int] | None:
+    # Obsługujemy pojedynczy zakres; inne formy ignorujemy i zwracamy całość (RFC 9110 na to pozwala).
+    if not range_header:
+        return None
+    match = _RANGE_RE.match(range_header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Nieprawidłowy zakres",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def _read_ciphertext(db: Session, attachment_id: int, offset: int, length: int) -> bytes:
+    return db.query(func.substr(models.Attachment.data, offset + 1, length)).filter(
+        models.Attachment.id == attachment_id
+    ).scalar()
+
+
+@contextmanager
+def _open_ciphertext(attachment_id: int, blob_ref: str | None) -> Iterator[Callable[[int, int], bytes]]:
+    if blob_ref is not None:
+        with get_blob_store().open(blob_ref) as buffer:
+            yield lambda offset, length: buffer[offset : offset + length]
+        return
+    # Starsze wiersze trzymają szyfrogram w bazie; czytamy go kawałkami przez substr().
+    db = SessionLocal()
+    try:
+        yield lambda offset, length: _read_ciphertext(db, attachment_id, offset, length)
+    finally:
+        db.close()
+
+
+def _check_digest(actual: bytes, expected: bytes) -> None:
+    if actual != expected:
+        raise ValueError("attachment ciphertext does not match its signed digest")
+
+
+def _stream_segments(
     attachment_id: int,
-    current_user: models.User = Depends(get_current_user),
-    private_key=Depends(get_current_private_key),
-    db: Session = Depends(get_db),
-) -> Response:
+    blob_ref: str | None,
+    nonce_prefix: bytes,
+    size: int,
+    key: bytes,
+    start: int,
+    end: int,
+    expected_digest: bytes | None = None,
+) -> Iterator[bytes]:
+    first = start // ATTACHMENT_SEGMENT_SIZE
+    last = end // ATTACHMENT_SEGMENT_SIZE
+    final_index = segment_count(size) - 1
+    # Przy pobieraniu całości przy okazji sprawdzamy skrót z manifestu podpisu; ostatnią partię
+    # wysyłamy dopiero po porównaniu, więc niezgodny plik nigdy nie dociera do klienta w całości.
+    hasher = hashlib.sha256() if expected_digest is not None and first == 0 and last == final_index else None
+    with _open_ciphertext(attachment_id, blob_ref) as read:
+        for batch_start in range(first, last + 1, _SEGMENTS_PER_READ):
+            batch_end = min(batch_start + _SEGMENTS_PER_READ, last + 1)
+            batch_offset = segment_span(batch_start, size)[0]
+            last_offset, last_length = segment_span(batch_end - 1, size)
+            batch = read(batch_offset, last_offset + last_length - batch_offset)
+            if hasher is not None:
+                hasher.update(batch)
+                if batch_end == last + 1:
+                    _check_digest(hasher.digest(), expected_digest)
+            for index in range(batch_start, batch_end):
+                offset, length = segment_span(index, size)
+                segment = batch[offset - batch_offset : offset - batch_offset + length]
+                plain = decrypt_segment(segment, nonce_prefix, index, index == final_index, key)
+                base = index * ATTACHMENT_SEGMENT_SIZE
+                yield plain[max(start - base, 0) : end - base + 1]
+
+
+def _wrap_staged_key(file_key: bytes, user_id: int, public_key_pem: bytes) -> bytes:
+    return wrap_aes_key_for_recipient(file_key, key_cache.get_public_key(user_id, public_key_pem))
+
+
+def _store_staged_attachment(db: Session, attachment: models.Attachment) -> list[str]:
+    # Zapisuje załącznik i usuwa przeterminowane, nigdy niewysłane załączniki tego użytkownika;
+    # zwraca bloby do skasowania po zatwierdzeniu transakcji.
+    stale_before = datetime.utcnow() - timedelta(minutes=settings.attachment_staging_ttl_minutes)
+    stale = db.query(models.Attachment.id, models.Attachment.blob_ref).filter(
+        models.Attachment.uploader_id == attachment.uploader_id,
+        models.Attachment.message_id.is_(None),
+        models.Attachment.created_at < stale_before,
+    ).all()
+    if stale:
+        db.query(models.Attachment).filter(models.Attachment.id.in_([row.id for row in stale])).delete(
+            synchronize_session=False
+        )
+    db.add(attachment)
+    db.commit()
+    db.refresh(attachment)
+    return [row.blob_ref for row in stale if row.blob_ref is not None]
+
+
+def _encrypt_to_blob(writer: BlobWriter, encryptor: SegmentedEncryptor, data: bytes, final: bool) -> None:
+    writer.write(encryptor.update(data))
+    if final:
+        writer.write(encryptor.finalize())
+
+
+def _delete_blobs(blob_refs: list[str]) -> None:
+    for blob_ref in blob_refs:
+        get_blob_store().delete(blob_ref)
+
+
+@router.post(
+    "/uploads",
+    response_model=schemas.AttachmentMeta,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(rate_limit("upload"))],
+)
+async def upload_attachment(
+    request: Request,
+    filename: str = Query(min_length=1, max_length=255),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.AttachmentMeta:
+    # Treść przyjmujemy jako surowe ciało żądania i szyfrujemy ją segmentami w locie prosto do
+    # magazynu blobów, więc ani jawna treść, ani szyfrogram nie są buforowane w całości.
+    content_type = request.headers.get("content-type") or "application/octet-stream"
+    if len(content_type) > 255:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Nieprawidłowy typ treści")
+
+    file_key = generate_aes_key()
+    encryptor = SegmentedEncryptor(file_key)
+    with get_blob_store().writer() as writer:
+        # Kawałki ciała zbieramy do rozmiaru segmentu; szyfrowanie i zapis idą do puli wątków.
+        pending = bytearray()
+        async for chunk in request.stream():
+            if encryptor.size + len(pending) + len(chunk) > settings.attachment_max_bytes:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Załącznik jest za duży")
+            pending += chunk
+            if len(pending) >= ATTACHMENT_SEGMENT_SIZE:
+                await run_in_threadpool(_encrypt_to_blob, writer, encryptor, bytes(pending), False)
+                pending.clear()
+        await run_in_threadpool(_encrypt_to_blob, writer, encryptor, bytes(pending), True)
+
+        blob_ref = await run_in_threadpool(writer.commit)
+        public_key_pem = await db.scalar(select(models.User.public_key_pem).where(models.User.id == current_user.id))
+        staged_key_enc = await get_crypto_executor().run(
+            OP_RSA, _wrap_staged_key, file_key, current_user.id, public_key_pem
+        )
+        attachment = models.Attachment(
+            uploader_id=current_user.id,
+            filename=filename,
+            content_type=content_type,
+            blob_ref=blob_ref,
+            nonce=encryptor.nonce_prefix,
+            size=encryptor.size,
+            digest=encryptor.digest(),
+            format_version=ATTACHMENT_FORMAT_SEGMENTED,
+            staged_key_enc=staged_key_enc,
+        )
+        stale_blobs = await db.run_sync(_store_staged_attachment, attachment)
+    if stale_blobs:
+        await run_in_threadpool(_delete_blobs, stale_blobs)
+    return schemas.AttachmentMeta(
+        id=attachment.id, filename=attachment.filename, content_type=attachment.content_type, size=attachment.size
+    )
+
+
+def _load_download(db: Session, user_id: int, attachment_id: int):
     attachment = (
-        db.query(models.Attachment)
-        .join(models.Message)
-        .join(models.MessageRecipient)
+        db.query(
+            models.Attachment.filename,
+            models.Attachment.content_type,
+            models.Attachment.nonce,
+            models.Attachment.format_version,
+            models.Attachment.blob_ref,
+            models.Attachment.key_wrap,
+            models.Attachment.key_wrap_nonce,
+            models.Attachment.digest,
+            func.coalesce(models.Attachment.size, func.length(models.Attachment.data) - AES_GCM_TAG_SIZE).label("size"),
+            models.MessageRecipient.id.label("link_id"),
+            models.MessageRecipient.aes_key_enc,
+        )
+        .join(models.MessageRecipient, models.MessageRecipient.message_id == models.Attachment.message_id)
         .filter(
             models.Attachment.id == attachment_id,
-            models.MessageRecipient.recipient_id == current_user.id,
+            models.MessageRecipient.recipient_id == user_id,
             models.MessageRecipient.deleted_at.is_(None),
         )
         .first()
@@ -37,23 +248,66 @@ def download_attachment(
 
     if attachment is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Załącznik nie znaleziony")
+    return attachment
 
-    mr = (
-        db.query(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.message_id == attachment.message_id,
-            models.MessageRecipient.recipient_id == current_user.id,
-            models.MessageRecipient.deleted_at.is_(None),
-        )
-        .first()
-    )
-    if mr is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Załącznik nie znaleziony")
 
-    aes_key = unwrap_aes_key(mr.aes_key_enc, private_key)
-    data = decrypt_payload(attachment.data, attachment.nonce, aes_key)
+def _decrypt_single(
+    attachment_id: int, blob_ref: str | None, nonce: bytes, key: bytes, expected_digest: bytes | None
+) -> bytes:
+    # Starszy format: jeden blok AES-GCM, można go odszyfrować tylko w całości.
+    if blob_ref is not None:
+        ciphertext = get_blob_store().read(blob_ref)
+    else:
+        with SessionLocal() as db:
+            ciphertext = db.query(models.Attachment.data).filter(models.Attachment.id == attachment_id).scalar()
+    if expected_digest is not None:
+        _check_digest(sha256_digest(ciphertext), expected_digest)
+    return decrypt_payload(ciphertext, nonce, key)
+
+
+@router.get("/{attachment_id}", dependencies=[Depends(rate_limit("download"))])
+async def download_attachment(
+    attachment_id: int,
+    range_header: str | None = Header(None, alias="Range"),
+    current_user: Principal = Depends(get_current_user),
+    keys: SessionKeys = Depends(get_session_keys),
+    db: AsyncSession = Depends(get_db),
+) -> Response:
+    attachment = await db.run_sync(_load_download, current_user.id, attachment_id)
+
+    aes_key = await keys.message_key(attachment.link_id, attachment.aes_key_enc)
+    if attachment.key_wrap is not None:
+        aes_key = decrypt_payload(attachment.key_wrap, attachment.key_wrap_nonce, aes_key)
+    size = attachment.size
+    byte_range = parse_range(range_header, size)
+    start, end = byte_range if byte_range else (0, size - 1)
 
     headers = {
         "Content-Disposition": build_disposition(attachment.filename),
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1),
     }
-    return Response(content=data, media_type=attachment.content_type, headers=headers)
+    status_code = status.HTTP_200_OK
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+
+    expected_digest = attachment.digest if settings.attachment_verify_digest else None
+    if attachment.format_version != ATTACHMENT_FORMAT_SEGMENTED:
+        data = await run_in_threadpool(
+            _decrypt_single, attachment_id, attachment.blob_ref, attachment.nonce, aes_key, expected_digest
+        )
+        return Response(
+            content=data[start : end + 1], status_code=status_code, media_type=attachment.content_type, headers=headers
+        )
+
+    if size == 0:
+        return Response(content=b"", media_type=attachment.content_type, headers=headers)
+    return StreamingResponse(
+        _stream_segments(
+            attachment_id, attachment.blob_ref, attachment.nonce, size, aes_key, start, end, expected_digest
+        ),
+        status_code=status_code,
+        media_type=attachment.content_type,
+        headers=headers,
+    )
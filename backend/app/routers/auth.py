@@ -1,73 +1,126 @@
+import asyncio
 import time
 import uuid
 
 import pyotp
-from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from .. import models, schemas, session_store
 from ..config import get_settings
-from ..crypto_utils import decrypt_private_key, encrypt_private_key, generate_rsa_keypair
+from ..crypto_utils import (
+    KEY_SUITE_EC,
+    OP_KDF,
+    OP_PASSWORD,
+    OP_RSA,
+    decrypt_private_key_pem,
+    encrypt_private_key,
+    generate_ec_keypair,
+    get_crypto_executor,
+    load_private_key,
+)
 from ..database import get_db
-from ..rate_limiter import check_rate_limit
+from ..dependencies import TokenData, get_token_data
+from ..keypair_pool import get_keypair_pool
+from ..metrics import TimedRoute
+from ..rate_limiter import rate_limit
 from ..security import create_access_token, hash_password, verify_password
 
-router = APIRouter(prefix="/auth", tags=["auth"])
+router = APIRouter(prefix="/auth", tags=["auth"], route_class=TimedRoute)
 settings = get_settings()
 
 
-@router.post("/register", response_model=schemas.RegisterResponse, status_code=status.HTTP_201_CREATED)
-def register(payload: schemas.UserCreate, db: Session = Depends(get_db)) -> schemas.RegisterResponse:
-    existing = db.query(models.User).filter(models.User.email == payload.email.lower()).first()
+def _find_user(db: Session, email: str) -> models.User | None:
+    return db.query(models.User).filter(models.User.email == email).first()
+
+
+def _create_user(db: Session, user: models.User) -> models.User:
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    return user
+
+
+@router.post(
+    "/register",
+    response_model=schemas.RegisterResponse,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(rate_limit("register"))],
+)
+async def register(payload: schemas.UserCreate, db: AsyncSession = Depends(get_db)) -> schemas.RegisterResponse:
+    email = payload.email.lower()
+    existing = await db.run_sync(_find_user, email)
     if existing:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Użytkownik już istnieje")
 
-    private_pem, public_pem = generate_rsa_keypair()
-    private_enc, salt, nonce = encrypt_private_key(private_pem, payload.password)
+    crypto = get_crypto_executor()
+    key_suite = payload.key_suite or settings.default_key_suite
+    if key_suite == KEY_SUITE_EC:
+        # Generacja kluczy EC trwa mikrosekundy, więc nie potrzebuje puli.
+        private_pem, public_pem, signing_public_pem = generate_ec_keypair()
+    else:
+        private_pem, public_pem = await get_keypair_pool().acquire()
+        signing_public_pem = None
+    (private_enc, salt, nonce), password_hash = await asyncio.gather(
+        crypto.run(OP_KDF, encrypt_private_key, private_pem, payload.password),
+        crypto.run(OP_PASSWORD, hash_password, payload.password),
+    )
     totp_secret = pyotp.random_base32()
 
     user = models.User(
-        email=payload.email.lower(),
-        password_hash=hash_password(payload.password),
+        email=email,
+        password_hash=password_hash,
         totp_secret=totp_secret,
+        key_suite=key_suite,
         public_key_pem=public_pem,
+        signing_public_key_pem=signing_public_pem,
         private_key_enc=private_enc,
         private_key_salt=salt,
         private_key_nonce=nonce,
     )
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+    user = await db.run_sync(_create_user, user)
 
     totp_uri = pyotp.TOTP(totp_secret).provisioning_uri(name=user.email, issuer_name=settings.totp_issuer)
     return schemas.RegisterResponse(user=user, totp_uri=totp_uri)
 
 
-@router.post("/login", response_model=schemas.TokenResponse)
-def login(payload: schemas.LoginRequest, request: Request, db: Session = Depends(get_db)) -> schemas.TokenResponse:
-    client_ip = request.headers.get("x-forwarded-for", request.client.host if request.client else "unknown").split(",")[0].strip()
-    if not check_rate_limit("login", client_ip):
-        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, 
-                            detail="Zbyt wiele prób, spróbuj później")
-
-    user = db.query(models.User).filter(models.User.email == payload.email.lower()).first()
-    if not user or not verify_password(payload.password, user.password_hash):
+@router.post("/login", response_model=schemas.TokenResponse, dependencies=[Depends(rate_limit("login"))])
+async def login(payload: schemas.LoginRequest, db: AsyncSession = Depends(get_db)) -> schemas.TokenResponse:
+    crypto = get_crypto_executor()
+    user = await db.run_sync(_find_user, payload.email.lower())
+    if not user or not await crypto.run(OP_PASSWORD, verify_password, payload.password, user.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Nieprawidłowe dane logowania")
 
     totp = pyotp.TOTP(user.totp_secret)
     if not totp.verify(payload.totp_code, valid_window=1):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Nieprawidłowe dane logowania")
 
-    private_key = decrypt_private_key(
-        ciphertext=user.private_key_enc,
-        salt=user.private_key_salt,
-        nonce=user.private_key_nonce,
-        password=payload.password,
+    private_pem = await crypto.run(
+        OP_KDF,
+        decrypt_private_key_pem,
+        user.private_key_enc,
+        user.private_key_salt,
+        user.private_key_nonce,
+        payload.password,
     )
+    private_key = await crypto.run(OP_RSA, load_private_key, private_pem, user.key_suite)
 
     jti = uuid.uuid4().hex
     expires_at = time.time() + settings.access_token_expire_minutes * 60
-    session_store.store_private_key(jti, private_key, expires_at)
+    await run_in_threadpool(
+        session_store.store_private_key,
+        jti,
+        private_key,
+        expires_at,
+        session_store.Principal(id=user.id, email=user.email),
+    )
 
     token = create_access_token(subject=str(user.id), jti=jti)
     return schemas.TokenResponse(access_token=token)
+
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(token_data: TokenData = Depends(get_token_data)) -> None:
+    session_store.revoke_private_key(token_data.jti)
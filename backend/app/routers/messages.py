@@ -1,66 +1,297 @@
+import asyncio
 from datetime import datetime
 import base64
-from typing import List
-
-from fastapi import APIRouter, Depends, HTTPException, Response, status
-from sqlalchemy.orm import Session
-
-from .. import models, schemas
+import hashlib
+import json
+from typing import Any, List
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+
+from .. import key_cache, mailbox_stats, models, schemas, search_index, session_store
+from ..blob_store import get_blob_store
+from ..config import get_settings
 from ..crypto_utils import (
+    AES_GCM_TAG_SIZE,
+    ATTACHMENT_FORMAT_SEGMENTED,
+    MANIFEST_SIGNATURE_ALGOS,
+    OP_RSA,
+    SIGNATURE_ALGO_ED25519_MANIFEST,
+    SegmentedEncryptor,
+    build_signature_manifest,
     decrypt_payload,
+    derive_search_key,
     encrypt_payload,
     generate_aes_key,
+    get_crypto_executor,
+    key_fingerprint,
+    manifest_signature_algo,
     sign_payload,
-    unwrap_aes_key,
+    unwrap_aes_keys,
     verify_signature,
-    wrap_aes_key_for_recipient,
+    verify_signature_digest,
+)
+from ..database import SessionLocal, get_db
+from ..delivery import encrypt_delivery_key, get_delivery_queue, wrap_for_recipients
+from ..dependencies import (
+    Principal,
+    SessionKeys,
+    TokenData,
+    get_current_private_key,
+    get_current_user,
+    get_session_keys,
+    get_session_principal,
+    get_token_data,
 )
-from ..database import get_db
-from ..dependencies import get_current_private_key, get_current_user
+from ..metrics import TimedRoute
+from ..notifications import EVENT_MESSAGE, EVENT_STATE, get_notification_hub
+from ..rate_limiter import rate_limit
+
+router = APIRouter(prefix="/messages", tags=["messages"], route_class=TimedRoute)
+settings = get_settings()
+
+
+def _encode_cursor(created_at: datetime, message_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), message_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, message_id = json.loads(raw)
+        return schemas.naive_utc(datetime.fromisoformat(created_at)), int(message_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Nieprawidłowy kursor")
+
+
+def _query_inbox(
+    db: Session,
+    user_id: int,
+    cursor: str | None,
+    since: str | None,
+    unread: bool,
+    limit: int,
+    search_tokens: list[bytes] | None = None,
+) -> list:
+    query = (
+        db.query(
+            models.MessageRecipient.id.label("link_id"),
+            models.MessageRecipient.aes_key_enc,
+            models.MessageRecipient.read_at,
+            models.Message.id,
+            models.Message.subject_enc,
+            models.Message.subject_nonce,
+            models.Message.created_at,
+            models.User.email.label("sender_email"),
+        )
+        .join(models.Message, models.MessageRecipient.message_id == models.Message.id)
+        .join(models.User, models.Message.sender_id == models.User.id)
+        .filter(models.MessageRecipient.recipient_id == user_id, models.MessageRecipient.deleted_at.is_(None))
+    )
+    if unread:
+        query = query.filter(models.MessageRecipient.read_at.is_(None))
+    if search_tokens:
+        query = query.filter(models.MessageRecipient.id.in_(search_index.matching_links(user_id, search_tokens)))
+    if cursor:
+        created_at, message_id = _decode_cursor(cursor)
+        query = query.filter(
+            or_(
+                models.Message.created_at < created_at,
+                and_(models.Message.created_at == created_at, models.Message.id < message_id),
+            )
+        )
+    if since:
+        created_at, message_id = _decode_cursor(since)
+        query = query.filter(
+            or_(
+                models.Message.created_at > created_at,
+                and_(models.Message.created_at == created_at, models.Message.id > message_id),
+            )
+        )
+    return query.order_by(models.Message.created_at.desc(), models.Message.id.desc()).limit(limit).all()
+
+
+async def _event_stream(request: Request, jti: str, user_id: int):
+    # Zdarzenia SSE niosą tylko id wiadomości; treść klient pobiera zwykłymi endpointami.
+    # Komentarz-heartbeat podtrzymuje połączenie i co interwał sprawdza, czy sesja wciąż istnieje.
+    # Subskrypcja powstaje dopiero przy starcie strumienia, więc zawsze zwalnia ją finally.
+    subscription = get_notification_hub().subscribe(user_id)
+    if subscription is None:
+        return
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), timeout=settings.notify_heartbeat_seconds)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected() or await run_in_threadpool(session_store.get_principal, jti) is None:
+                    return
+                yield ": ping\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        get_notification_hub().unsubscribe(subscription)
+
+
+@router.get("/events")
+async def message_events(
+    request: Request,
+    current_user: Principal = Depends(get_session_principal),
+    token_data: TokenData = Depends(get_token_data),
+) -> StreamingResponse:
+    if not get_notification_hub().has_capacity(current_user.id):
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Zbyt wiele otwartych połączeń")
+    return StreamingResponse(
+        _event_stream(request, token_data.jti, current_user.id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-router = APIRouter(prefix="/messages", tags=["messages"])
 
+@router.get("/stats", response_model=schemas.MailboxStatsOut)
+async def get_mailbox_stats(
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.MailboxStatsOut:
+    stats = await db.get(models.MailboxStats, current_user.id)
+    return schemas.MailboxStatsOut.model_validate(stats) if stats else schemas.MailboxStatsOut()
 
-@router.get("", response_model=List[schemas.MessageListItem])
-def list_messages(
-    current_user: models.User = Depends(get_current_user),
-    private_key=Depends(get_current_private_key),
-    db: Session = Depends(get_db),
+
+async def _search_tokens(db: AsyncSession, user_id: int, keys: SessionKeys, q: str) -> list[bytes]:
+    enabled = await db.scalar(select(models.User.search_enabled).where(models.User.id == user_id))
+    if not enabled:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Wyszukiwanie nie jest włączone")
+    search_key = derive_search_key(keys.private_key)
+    tokens = search_index.query_tokens(search_key, q)
+    if not tokens or len(tokens) > search_index.MAX_QUERY_TOKENS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Zapytanie musi zawierać od 1 do {search_index.MAX_QUERY_TOKENS} słów",
+        )
+    # Poczta, która przyszła od ostatniego wyszukiwania, trafia do indeksu przed zapytaniem;
+    # większe zaległości dokańcza zadanie w tle.
+    batch = settings.search_index_batch_size
+    if await search_index.index_pending(db, user_id, keys, search_key, batch) >= batch:
+        search_index.start_backfill(user_id, keys, search_key)
+    return tokens
+
+
+async def _search_index_status(db: AsyncSession, user_id: int) -> schemas.SearchIndexStatus:
+    enabled = await db.scalar(select(models.User.search_enabled).where(models.User.id == user_id))
+    pending = await search_index.pending_count(db, user_id) if enabled else 0
+    return schemas.SearchIndexStatus(enabled=enabled, pending=pending)
+
+
+@router.get("/search-index", response_model=schemas.SearchIndexStatus)
+async def get_search_index(
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.SearchIndexStatus:
+    return await _search_index_status(db, current_user.id)
+
+
+@router.post("/search-index", response_model=schemas.SearchIndexStatus, status_code=status.HTTP_202_ACCEPTED)
+async def enable_search_index(
+    current_user: Principal = Depends(get_current_user),
+    keys: SessionKeys = Depends(get_session_keys),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.SearchIndexStatus:
+    # Istniejącą pocztę indeksuje zadanie w tle kluczem z bieżącej sesji.
+    await db.execute(update(models.User).where(models.User.id == current_user.id).values(search_enabled=True))
+    await db.commit()
+    search_index.start_backfill(current_user.id, keys, derive_search_key(keys.private_key))
+    return await _search_index_status(db, current_user.id)
+
+
+@router.delete("/search-index", status_code=status.HTTP_204_NO_CONTENT)
+async def disable_search_index(
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> Response:
+    search_index.cancel_backfill(current_user.id)
+    await db.execute(update(models.User).where(models.User.id == current_user.id).values(search_enabled=False))
+    await db.execute(delete(models.SearchToken).where(models.SearchToken.recipient_id == current_user.id))
+    await db.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.get("", response_model=schemas.MessagePage, dependencies=[Depends(rate_limit("list"))])
+async def list_messages(
+    cursor: str | None = None,
+    since: str | None = None,
+    unread: bool = False,
+    q: str | None = Query(None, max_length=200),
+    limit: int = Query(settings.inbox_page_size, ge=1, le=settings.inbox_page_size_max),
+    current_user: Principal = Depends(get_current_user),
+    keys: SessionKeys = Depends(get_session_keys),
+    db: AsyncSession = Depends(get_db),
 ):
-    rows = (
-        db.query(models.MessageRecipient)
-        .join(models.Message)
-        .join(models.User, models.Message.sender)
-        .filter(models.MessageRecipient.recipient_id == current_user.id, models.MessageRecipient.deleted_at.is_(None))
-        .order_by(models.Message.created_at.desc())
-        .all()
-    )
+    search_tokens = await _search_tokens(db, current_user.id, keys, q) if q else None
+    rows = await db.run_sync(_query_inbox, current_user.id, cursor, since, unread, limit + 1, search_tokens)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
 
+    aes_keys = await keys.message_keys((row.link_id, row.aes_key_enc) for row in rows)
     items: List[schemas.MessageListItem] = []
-    for mr in rows:
-        aes_key = unwrap_aes_key(mr.aes_key_enc, private_key)
-        subject = decrypt_payload(mr.message.subject_enc, mr.message.subject_nonce, aes_key).decode("utf-8")
+    for row in rows:
+        subject = decrypt_payload(row.subject_enc, row.subject_nonce, aes_keys[row.link_id]).decode("utf-8")
         items.append(
             schemas.MessageListItem(
-                id=mr.message.id,
+                id=row.id,
                 subject=subject,
-                sender_email=mr.message.sender.email,
-                created_at=mr.message.created_at,
-                read_at=mr.read_at,
+                sender_email=row.sender_email,
+                created_at=row.created_at,
+                read_at=row.read_at,
             )
         )
-    return items
 
+    next_cursor = _encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None
+    if rows and not cursor:
+        head_cursor = _encode_cursor(rows[0].created_at, rows[0].id)
+    else:
+        head_cursor = since
+    return schemas.MessagePage(items=items, next_cursor=next_cursor, head_cursor=head_cursor)
 
-@router.post("", response_model=schemas.MessageDetail, status_code=status.HTTP_201_CREATED)
-def send_message(
-    payload: schemas.MessageCreate,
-    current_user: models.User = Depends(get_current_user),
-    private_key=Depends(get_current_private_key),
-    db: Session = Depends(get_db),
-) -> schemas.MessageDetail:
+
+def _signing_key_pem(signature_algo: str, public_key_pem: bytes, signing_public_key_pem: bytes | None) -> bytes | None:
+    if signature_algo == SIGNATURE_ALGO_ED25519_MANIFEST:
+        return signing_public_key_pem
+    return public_key_pem
+
+
+def _cached_verification(mr) -> bool | None:
+    key_pem = _signing_key_pem(mr.signature_algo, mr.sender_public_key_pem, mr.sender_signing_public_key_pem)
+    if key_pem is None:
+        return False
+    if mr.signature_verified is not None and mr.signature_key_fingerprint == key_fingerprint(key_pem):
+        return mr.signature_verified
+    return None
+
+
+def _store_verification(db: Session, message_id: int, verified: bool, fingerprint: bytes) -> None:
+    db.query(models.Message).filter(models.Message.id == message_id).update(
+        {models.Message.signature_verified: verified, models.Message.signature_key_fingerprint: fingerprint},
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def _load_send_targets(db: Session, user_id: int, payload: schemas.MessageCreate) -> tuple[Any, list, list[models.Attachment]]:
+    sender_keys = (
+        db.query(models.User.public_key_pem, models.User.signing_public_key_pem).filter(models.User.id == user_id).one()
+    )
     requested_recipients = [email.lower() for email in payload.recipients]
-    recipients = db.query(models.User).filter(models.User.email.in_(requested_recipients)).all()
+    recipients = (
+        db.query(models.User.id, models.User.email, models.User.public_key_pem)
+        .filter(models.User.email.in_(requested_recipients))
+        .all()
+    )
 
     missing = sorted(set(requested_recipients) - {user.email for user in recipients})
     if missing:
@@ -69,62 +300,193 @@ def send_message(
             detail=f"Odbiorcy nie znalezieni: {', '.join(missing)}",
         )
 
-    aes_key = generate_aes_key()
-    subject_enc, subject_nonce = encrypt_payload(payload.subject.encode("utf-8"), aes_key)
-    body_enc, body_nonce = encrypt_payload(payload.body.encode("utf-8"), aes_key)
+    # Najpierw wcześniej przesłane załączniki (mają mniejsze id), potem nowe z treści żądania:
+    # kolejność manifestu musi odpowiadać kolejności id, w której czyta go get_message.
+    attachment_ids = sorted(set(payload.attachment_ids))
+    staged = (
+        db.query(models.Attachment)
+        .filter(
+            models.Attachment.id.in_(attachment_ids),
+            models.Attachment.uploader_id == user_id,
+            models.Attachment.message_id.is_(None),
+        )
+        .order_by(models.Attachment.id)
+        .all()
+    )
+    if len(staged) != len(attachment_ids):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Załączniki nie znalezione")
+    return sender_keys, recipients, staged
 
-    attachments_models: list[models.Attachment] = []
-    attachments_sizes: list[int] = []
-    attachment_ciphertexts: list[bytes] = []
-    for att in payload.attachments:
+
+def _store_inline_attachments(
+    user_id: int, attachments: List[schemas.AttachmentCreate], aes_key: bytes
+) -> list[models.Attachment]:
+    stored: list[models.Attachment] = []
+    for att in attachments:
         try:
             raw = base64.b64decode(att.data_base64, validate=True)
         except Exception:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
                                 detail=f"Nieprawidłowy base64 dla {att.filename}")
-        data_enc, data_nonce = encrypt_payload(raw, aes_key)
-        attachment_ciphertexts.append(data_enc)
-        attachments_sizes.append(len(raw))
-        attachments_models.append(
+        encryptor = SegmentedEncryptor(aes_key)
+        with get_blob_store().writer() as writer:
+            writer.write(encryptor.update(raw))
+            writer.write(encryptor.finalize())
+            blob_ref = writer.commit()
+        stored.append(
             models.Attachment(
+                uploader_id=user_id,
                 filename=att.filename,
                 content_type=att.content_type,
-                data=data_enc,
-                nonce=data_nonce,
+                blob_ref=blob_ref,
+                nonce=encryptor.nonce_prefix,
+                size=encryptor.size,
+                digest=encryptor.digest(),
+                format_version=ATTACHMENT_FORMAT_SEGMENTED,
             )
         )
+    return stored
+
+
+def _claim_staged(db: Session, message: models.Message, attachments_models: list[models.Attachment]) -> None:
+    # Przesłany załącznik może trafić tylko do jednej wiadomości; warunek message_id IS NULL w tym samym
+    # UPDATE rozstrzyga wyścig dwóch wysyłek, które wskazały te same attachment_ids.
+    staged_ids = [att.id for att in attachments_models if att.id is not None]
+    if not staged_ids:
+        return
+    claimed = db.execute(
+        update(models.Attachment)
+        .where(
+            models.Attachment.id.in_(staged_ids),
+            models.Attachment.uploader_id == message.sender_id,
+            models.Attachment.message_id.is_(None),
+        )
+        .values(message_id=message.id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if claimed != len(staged_ids):
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Załączniki zostały już wysłane")
+
+
+def _store_message(
+    db: Session,
+    message: models.Message,
+    recipients: list,
+    wrapped_keys: list[tuple[bytes, str]],
+    attachments_models: list[models.Attachment],
+) -> models.Message:
+    db.add(message)
+    db.flush()  # to get message.id before recipient rows
+    _claim_staged(db, message, attachments_models)
+
+    for recipient, (aes_key_enc, wrap_algo) in zip(recipients, wrapped_keys):
+        db.add(
+            models.MessageRecipient(
+                message_id=message.id, recipient_id=recipient.id, aes_key_enc=aes_key_enc, wrap_algo=wrap_algo
+            )
+        )
+
+    for att in attachments_models:
+        att.message_id = message.id
+        db.add(att)
+
+    size = len(message.subject_enc) + len(message.body_enc) + sum(att.size or 0 for att in attachments_models)
+    mailbox_stats.apply_deltas(db, {recipient.id: (1, 1, size) for recipient in recipients})
+    db.commit()
+    db.refresh(message)
+    return message
+
+
+def _store_deferred(
+    db: Session, message: models.Message, recipients: list, attachments_models: list[models.Attachment], aes_key: bytes
+) -> models.Delivery:
+    db.add(message)
+    db.flush()
+    _claim_staged(db, message, attachments_models)
+
+    for att in attachments_models:
+        att.message_id = message.id
+        db.add(att)
+
+    key_enc, key_nonce = encrypt_delivery_key(aes_key)
+    delivery = models.Delivery(
+        message_id=message.id,
+        sender_id=message.sender_id,
+        recipient_ids=json.dumps([user.id for user in recipients]),
+        total=len(recipients),
+        key_enc=key_enc,
+        key_nonce=key_nonce,
+    )
+    db.add(delivery)
+    db.commit()
+    db.refresh(delivery)
+    return delivery
 
-    signature_payload = subject_enc + body_enc + b"".join(attachment_ciphertexts)
-    signature = sign_payload(signature_payload, private_key)
 
+async def _seal_message(
+    payload: schemas.MessageCreate, user_id: int, private_key, db: AsyncSession
+) -> tuple[models.Message, list, list[models.Attachment], bytes]:
+    # Szyfruje i podpisuje wiadomość; zwraca niezapisany wiersz, odbiorców, załączniki i klucz AES wiadomości.
+    sender_keys, recipients, staged = await db.run_sync(_load_send_targets, user_id, payload)
+    crypto = get_crypto_executor()
+
+    aes_key = generate_aes_key()
+    subject_enc, subject_nonce = encrypt_payload(payload.subject.encode("utf-8"), aes_key)
+    body_enc, body_nonce = encrypt_payload(payload.body.encode("utf-8"), aes_key)
+
+    attachments_models: list[models.Attachment] = []
+    if staged:
+        file_keys = await crypto.run(OP_RSA, unwrap_aes_keys, [att.staged_key_enc for att in staged], private_key)
+        for att, file_key in zip(staged, file_keys):
+            att.key_wrap, att.key_wrap_nonce = encrypt_payload(file_key, aes_key)
+            att.staged_key_enc = None
+            attachments_models.append(att)
+
+    if payload.attachments:
+        attachments_models += await run_in_threadpool(_store_inline_attachments, user_id, payload.attachments, aes_key)
+
+    manifest = build_signature_manifest(subject_enc, body_enc, [att.digest for att in attachments_models])
+    signature = await crypto.run(OP_RSA, sign_payload, manifest, private_key)
+
+    signature_algo = manifest_signature_algo(private_key)
+    # Podpis złożyliśmy sami kluczem z sesji, więc od razu zapisujemy go jako zweryfikowany.
+    signing_key_pem = _signing_key_pem(signature_algo, sender_keys.public_key_pem, sender_keys.signing_public_key_pem)
     message = models.Message(
-        sender_id=current_user.id,
+        sender_id=user_id,
         subject_enc=subject_enc,
         subject_nonce=subject_nonce,
         body_enc=body_enc,
         body_nonce=body_nonce,
         signature=signature,
-        signature_algo="RSA-PSS-SHA256",
+        signature_algo=signature_algo,
+        signature_verified=True,
+        signature_key_fingerprint=key_fingerprint(signing_key_pem),
     )
-    db.add(message)
-    db.flush()  # to get message.id before recipient rows
+    return message, recipients, attachments_models, aes_key
 
-    for recipient in recipients:
-        aes_key_enc = wrap_aes_key_for_recipient(aes_key, recipient.public_key_pem)
-        db.add(models.MessageRecipient(message_id=message.id, recipient_id=recipient.id, aes_key_enc=aes_key_enc))
 
-    for att in attachments_models:
-        att.message_id = message.id
-        db.add(att)
-
-    db.commit()
-    db.refresh(message)
+@router.post(
+    "",
+    response_model=schemas.MessageDetail,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(rate_limit("send"))],
+)
+async def send_message(
+    payload: schemas.MessageCreate,
+    current_user: Principal = Depends(get_current_user),
+    private_key=Depends(get_current_private_key),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.MessageDetail:
+    message, recipients, attachments_models, aes_key = await _seal_message(payload, current_user.id, private_key, db)
+    wrapped_keys = await get_crypto_executor().run(OP_RSA, wrap_for_recipients, aes_key, recipients)
+    message = await db.run_sync(_store_message, message, recipients, wrapped_keys, attachments_models)
+    get_notification_hub().publish([user.id for user in recipients], {"type": EVENT_MESSAGE, "id": message.id})
 
-    attachments_meta = []
-    for att, size in zip(attachments_models, attachments_sizes):
-        attachments_meta.append(
-            schemas.AttachmentMeta(id=att.id, filename=att.filename, content_type=att.content_type, size=size)
-        )
+    attachments_meta = [
+        schemas.AttachmentMeta(id=att.id, filename=att.filename, content_type=att.content_type, size=att.size)
+        for att in attachments_models
+    ]
 
     return schemas.MessageDetail(
         id=message.id,
@@ -140,18 +502,89 @@ def send_message(
     )
 
 
-@router.get("/{message_id}", response_model=schemas.MessageDetail)
-def get_message(
-    message_id: int,
-    current_user: models.User = Depends(get_current_user),
+@router.post(
+    "/deliveries",
+    response_model=schemas.DeliveryStatus,
+    status_code=status.HTTP_202_ACCEPTED,
+    dependencies=[Depends(rate_limit("send"))],
+)
+async def send_message_deferred(
+    payload: schemas.MessageCreate,
+    current_user: Principal = Depends(get_current_user),
     private_key=Depends(get_current_private_key),
-    db: Session = Depends(get_db),
-) -> schemas.MessageDetail:
+    db: AsyncSession = Depends(get_db),
+) -> schemas.DeliveryStatus:
+    if not settings.deferred_delivery_enabled:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Doręczanie odroczone jest wyłączone")
+    # Wiadomość i szyfrogramy zapisujemy od razu; owijanie kluczy i wiersze odbiorców robi kolejka doręczeń.
+    message, recipients, attachments_models, aes_key = await _seal_message(payload, current_user.id, private_key, db)
+    delivery = await db.run_sync(_store_deferred, message, recipients, attachments_models, aes_key)
+    get_delivery_queue().enqueue(delivery.id)
+    return schemas.DeliveryStatus.model_validate(delivery)
+
+
+@router.get("/deliveries/{delivery_id}", response_model=schemas.DeliveryStatus)
+async def get_delivery(
+    delivery_id: int,
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.DeliveryStatus:
+    delivery = await db.scalar(
+        select(models.Delivery).where(models.Delivery.id == delivery_id, models.Delivery.sender_id == current_user.id)
+    )
+    if delivery is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Doręczenie nie znalezione")
+    return schemas.DeliveryStatus.model_validate(delivery)
+
+
+def _legacy_signed_digest(mr) -> bytes:
+    # Stary schemat podpisuje subject_enc + body_enc + szyfrogramy załączników; skrót liczymy przyrostowo,
+    # po jednym załączniku, zamiast sklejać wszystko w pamięci. Działa w wątku, więc ma własną sesję.
+    hasher = hashlib.sha256(mr.subject_enc)
+    hasher.update(mr.body_enc)
+    with SessionLocal() as db:
+        rows = (
+            db.query(models.Attachment.id, models.Attachment.blob_ref)
+            .filter(models.Attachment.message_id == mr.id)
+            .order_by(models.Attachment.id)
+            .all()
+        )
+        for row in rows:
+            if row.blob_ref is not None:
+                with get_blob_store().open(row.blob_ref) as buffer:
+                    hasher.update(buffer)
+            else:
+                hasher.update(db.query(models.Attachment.data).filter(models.Attachment.id == row.id).scalar())
+    return hasher.digest()
+
+
+def _load_message(db: Session, user_id: int, message_id: int) -> tuple[Any, list[str], list, bytes | None]:
+    sender = aliased(models.User)
     mr = (
-        db.query(models.MessageRecipient)
-        .join(models.Message)
+        db.query(
+            models.MessageRecipient.id.label("link_id"),
+            models.MessageRecipient.aes_key_enc,
+            models.MessageRecipient.read_at,
+            models.MessageRecipient.deleted_at,
+            models.Message.id,
+            models.Message.subject_enc,
+            models.Message.subject_nonce,
+            models.Message.body_enc,
+            models.Message.body_nonce,
+            models.Message.signature,
+            models.Message.signature_algo,
+            models.Message.signature_verified,
+            models.Message.signature_key_fingerprint,
+            models.Message.created_at,
+            sender.id.label("sender_id"),
+            sender.email.label("sender_email"),
+            sender.public_key_pem.label("sender_public_key_pem"),
+            sender.signing_public_key_pem.label("sender_signing_public_key_pem"),
+        )
+        .join(models.Message, models.MessageRecipient.message_id == models.Message.id)
+        .join(sender, models.Message.sender_id == sender.id)
         .filter(
-            models.MessageRecipient.recipient_id == current_user.id,
+            models.MessageRecipient.recipient_id == user_id,
             models.MessageRecipient.message_id == message_id,
         )
         .first()
@@ -160,37 +593,68 @@ def get_message(
     if mr is None or mr.deleted_at is not None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Wiadomość nie znaleziona")
 
-    recipients = [link.recipient.email for link in mr.message.recipients]
+    recipients = [
+        email
+        for (email,) in db.query(models.User.email)
+        .join(models.MessageRecipient, models.MessageRecipient.recipient_id == models.User.id)
+        .filter(models.MessageRecipient.message_id == mr.id)
+        .order_by(models.MessageRecipient.id)
+    ]
+    # Starsze załączniki nie mają zapisanego rozmiaru; szyfrogram AES-GCM jest dłuższy o sam tag.
+    attachments = (
+        db.query(
+            models.Attachment.id,
+            models.Attachment.filename,
+            models.Attachment.content_type,
+            func.coalesce(models.Attachment.size, func.length(models.Attachment.data) - AES_GCM_TAG_SIZE).label("size"),
+            models.Attachment.digest,
+        )
+        .filter(models.Attachment.message_id == mr.id)
+        .order_by(models.Attachment.id)
+        .all()
+    )
 
-    aes_key = unwrap_aes_key(mr.aes_key_enc, private_key)
-    subject = decrypt_payload(mr.message.subject_enc, mr.message.subject_nonce, aes_key).decode("utf-8")
-    body = decrypt_payload(mr.message.body_enc, mr.message.body_nonce, aes_key).decode("utf-8")
+    if _cached_verification(mr) is None and mr.signature_algo in MANIFEST_SIGNATURE_ALGOS:
+        signed_data = build_signature_manifest(mr.subject_enc, mr.body_enc, [att.digest for att in attachments])
+    else:
+        signed_data = None
+    return mr, recipients, attachments, signed_data
 
-    attachment_ciphertexts: list[bytes] = []
-    attachments_meta: list[schemas.AttachmentMeta] = []
-    for att in sorted(mr.message.attachments, key=lambda a: a.id):
-        attachment_ciphertexts.append(att.data)
-        plain = decrypt_payload(att.data, att.nonce, aes_key)
-        attachments_meta.append(
-            schemas.AttachmentMeta(
-                id=att.id,
-                filename=att.filename,
-                content_type=att.content_type,
-                size=len(plain),
-            )
-        )
 
-    verified = verify_signature(
-        mr.message.subject_enc + mr.message.body_enc + b"".join(attachment_ciphertexts),
-        mr.message.signature,
-        mr.message.sender.public_key_pem,
-    )
+@router.get("/{message_id}", response_model=schemas.MessageDetail)
+async def get_message(
+    message_id: int,
+    current_user: Principal = Depends(get_current_user),
+    keys: SessionKeys = Depends(get_session_keys),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.MessageDetail:
+    mr, recipients, attachments, signed_data = await db.run_sync(_load_message, current_user.id, message_id)
+
+    aes_key = await keys.message_key(mr.link_id, mr.aes_key_enc)
+    subject = decrypt_payload(mr.subject_enc, mr.subject_nonce, aes_key).decode("utf-8")
+    body = decrypt_payload(mr.body_enc, mr.body_nonce, aes_key).decode("utf-8")
+
+    attachments_meta = [
+        schemas.AttachmentMeta(id=att.id, filename=att.filename, content_type=att.content_type, size=att.size)
+        for att in attachments
+    ]
+
+    verified = _cached_verification(mr)
+    if verified is None:
+        # Pierwszy odczyt albo nadawca zmienił klucz: weryfikujemy i zapisujemy wynik dla kolejnych odczytów.
+        sender_key_pem = _signing_key_pem(mr.signature_algo, mr.sender_public_key_pem, mr.sender_signing_public_key_pem)
+        verify = verify_signature if mr.signature_algo in MANIFEST_SIGNATURE_ALGOS else verify_signature_digest
+        if signed_data is None:
+            signed_data = await run_in_threadpool(_legacy_signed_digest, mr)
+        sender_key = key_cache.get_public_key(mr.sender_id, sender_key_pem)
+        verified = await get_crypto_executor().run(OP_RSA, verify, signed_data, mr.signature, sender_key)
+        await db.run_sync(_store_verification, mr.id, verified, key_fingerprint(sender_key_pem))
     return schemas.MessageDetail(
-        id=mr.message.id,
+        id=mr.id,
         subject=subject,
         body=body,
-        sender_email=mr.message.sender.email,
-        created_at=mr.message.created_at,
+        sender_email=mr.sender_email,
+        created_at=mr.created_at,
         recipients=recipients,
         verified=verified,
         read_at=mr.read_at,
@@ -199,74 +663,158 @@ def get_message(
     )
 
 
-@router.post("/{message_id}/read", response_model=schemas.MarkReadResponse)
-def mark_as_read(
-    message_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
-) -> schemas.MarkReadResponse:
-    mr = (
-        db.query(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.recipient_id == current_user.id,
+def _action_state(action: str):
+    # Warunek na wiersze, które akcja faktycznie zmienia; tylko takie trafiają do liczników skrzynki.
+    link = models.MessageRecipient
+    if action == "read":
+        return link.read_at.is_(None)
+    if action == "unread":
+        return link.read_at.is_not(None)
+    return link.deleted_at.is_(None)
+
+
+def _action_values(action: str, now: datetime) -> dict:
+    link = models.MessageRecipient
+    if action == "read":
+        return {link.read_at: now}
+    if action == "unread":
+        return {link.read_at: None}
+    return {link.deleted_at: now}
+
+
+async def _apply_action(db: AsyncSession, user_id: int, action: str, conditions: list) -> list[int]:
+    # Jedno UPDATE ... WHERE recipient_id = :me dla wybranych wiadomości, a w tej samej transakcji
+    # korekta liczników skrzynki; zwraca id faktycznie zmienionych wiadomości.
+    link = models.MessageRecipient
+    result = await db.execute(
+        update(link)
+        .where(link.recipient_id == user_id, link.deleted_at.is_(None), _action_state(action), *conditions)
+        .values(_action_values(action, datetime.utcnow()))
+        .returning(link.message_id, link.read_at)
+        .execution_options(synchronize_session=False)
+    )
+    rows = result.all()
+    if not rows:
+        return []
+    changed = [row.message_id for row in rows]
+    if action == "read":
+        delta = (0, -len(rows), 0)
+    elif action == "unread":
+        delta = (0, len(rows), 0)
+    else:
+        size = await db.scalar(
+            select(func.coalesce(func.sum(mailbox_stats.message_bytes()), 0)).where(models.Message.id.in_(changed))
+        )
+        delta = (-len(rows), -sum(1 for row in rows if row.read_at is None), -size)
+    await db.run_sync(mailbox_stats.apply_deltas, {user_id: delta})
+    return changed
+
+
+def _publish_state(user_id: int, action: str, message_ids) -> None:
+    if message_ids:
+        get_notification_hub().publish([user_id], {"type": EVENT_STATE, "action": action, "ids": sorted(message_ids)})
+
+
+@router.post("/bulk", response_model=schemas.BulkMailboxResponse)
+async def bulk_update_messages(
+    payload: schemas.BulkMailboxRequest,
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.BulkMailboxResponse:
+    link = models.MessageRecipient
+    if payload.ids is not None:
+        ids = list(dict.fromkeys(payload.ids))
+        if len(ids) > settings.mailbox_bulk_max:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Maksymalnie {settings.mailbox_bulk_max} wiadomości w jednym żądaniu",
+            )
+        updated = set(await _apply_action(db, current_user.id, payload.action, [link.message_id.in_(ids)]))
+        found = set(updated)
+        if payload.action != "delete" and len(found) < len(ids):
+            # Wiadomości już w docelowym stanie też są wynikiem "ok".
+            found.update(
+                await db.scalars(
+                    select(link.message_id).where(
+                        link.recipient_id == current_user.id, link.deleted_at.is_(None), link.message_id.in_(ids)
+                    )
+                )
+            )
+        results = [
+            schemas.BulkMailboxResult(id=message_id, status="ok" if message_id in found else "not_found")
+            for message_id in ids
+        ]
+        has_more = False
+    else:
+        # Filtr obejmuje tylko wiadomości, które akcja faktycznie zmieni, więc kolejne partie
+        # (has_more) posuwają się naprzód aż do wyczerpania dopasowań.
+        selected = [link.recipient_id == current_user.id, link.deleted_at.is_(None), _action_state(payload.action)]
+        if payload.filter.unread:
+            selected.append(link.read_at.is_(None))
+        if payload.filter.before is not None:
+            selected.append(
+                link.message_id.in_(select(models.Message.id).where(models.Message.created_at < payload.filter.before))
+            )
+        batch = select(link.id).where(*selected).order_by(link.id).limit(settings.mailbox_bulk_max)
+        updated = set(await _apply_action(db, current_user.id, payload.action, [link.id.in_(batch)]))
+        results = [schemas.BulkMailboxResult(id=message_id, status="ok") for message_id in sorted(updated)]
+        has_more = len(updated) >= settings.mailbox_bulk_max
+    await db.commit()
+    _publish_state(current_user.id, payload.action, updated)
+    return schemas.BulkMailboxResponse(action=payload.action, updated=len(updated), results=results, has_more=has_more)
+
+
+async def _find_link(db: AsyncSession, user_id: int, message_id: int) -> None:
+    exists = await db.scalar(
+        select(models.MessageRecipient.id).where(
+            models.MessageRecipient.recipient_id == user_id,
             models.MessageRecipient.message_id == message_id,
+            models.MessageRecipient.deleted_at.is_(None),
         )
-        .first()
     )
 
-    if mr is None or mr.deleted_at is not None:
+    if exists is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Wiadomość nie znaleziona")
 
-    if mr.read_at is None:
-        mr.read_at = datetime.utcnow()
-        db.commit()
+
+@router.post("/{message_id}/read", response_model=schemas.MarkReadResponse)
+async def mark_as_read(
+    message_id: int,
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.MarkReadResponse:
+    if await _apply_action(db, current_user.id, "read", [models.MessageRecipient.message_id == message_id]):
+        await db.commit()
+        _publish_state(current_user.id, "read", [message_id])
+    else:
+        await _find_link(db, current_user.id, message_id)
 
     return schemas.MarkReadResponse(status="read")
 
 
 @router.post("/{message_id}/unread", response_model=schemas.MarkReadResponse)
-def mark_as_unread(
+async def mark_as_unread(
     message_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
 ) -> schemas.MarkReadResponse:
-    mr = (
-        db.query(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.recipient_id == current_user.id,
-            models.MessageRecipient.message_id == message_id,
-        )
-        .first()
-    )
-
-    if mr is None or mr.deleted_at is not None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Wiadomość nie znaleziona")
-
-    if mr.read_at is not None:
-        mr.read_at = None
-        db.commit()
+    if await _apply_action(db, current_user.id, "unread", [models.MessageRecipient.message_id == message_id]):
+        await db.commit()
+        _publish_state(current_user.id, "unread", [message_id])
+    else:
+        await _find_link(db, current_user.id, message_id)
 
     return schemas.MarkReadResponse(status="unread")
 
 
 @router.delete("/{message_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_message(
+async def delete_message(
     message_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
 ) -> Response:
-    mr = (
-        db.query(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.recipient_id == current_user.id,
-            models.MessageRecipient.message_id == message_id,
-        )
-        .first()
-    )
-
-    if mr is None or mr.deleted_at is not None:
+    if not await _apply_action(db, current_user.id, "delete", [models.MessageRecipient.message_id == message_id]):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Wiadomość nie znaleziona")
-
-    mr.deleted_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
+    _publish_state(current_user.id, "delete", [message_id])
     return Response(status_code=status.HTTP_204_NO_CONTENT)
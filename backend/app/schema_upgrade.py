@@ -0,0 +1,120 @@
+import argparse
+
+from sqlalchemy import Table, UniqueConstraint, inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from . import models
+from .database import engine
+
+# create_all tworzy tylko brakujące tabele; kolumny, indeksy i ograniczenia unikalności dodane do istniejących
+# tabel oraz zdjęte NOT NULL uzupełnia upgrade_schema. Każdy krok sprawdza bieżący schemat, więc można go
+# uruchamiać wielokrotnie.
+
+# Ograniczenia na danych pochodnych (tokeny da się wyliczyć ponownie): duplikaty usuwamy przed ich dodaniem.
+_DEDUPLICATE = {"uix_search_token"}
+
+
+def _quote(conn: Connection, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _column_ddl(conn: Connection, column) -> str:
+    ddl = f"{_quote(conn, column.name)} {column.type.compile(dialect=conn.dialect)}"
+    if column.server_default is not None:
+        default = column.server_default.arg
+        if isinstance(default, str):
+            default = "'" + default.replace("'", "''") + "'"
+        else:
+            default = str(default.compile(dialect=conn.dialect))
+        ddl += f" DEFAULT {default}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    for foreign_key in column.foreign_keys:
+        target = foreign_key.column
+        ddl += f" REFERENCES {_quote(conn, target.table.name)} ({_quote(conn, target.name)})"
+    return ddl
+
+
+def _rebuild_sqlite_table(conn: Connection, table: Table, columns: list[str]) -> None:
+    # SQLite nie zmienia definicji kolumn, więc tabelę tworzymy od nowa i przepisujemy wiersze.
+    old = f"_{table.name}_old"
+    for index in inspect(conn).get_indexes(table.name):
+        conn.execute(text(f"DROP INDEX {_quote(conn, index['name'])}"))
+    conn.execute(text(f"ALTER TABLE {_quote(conn, table.name)} RENAME TO {_quote(conn, old)}"))
+    table.create(conn)
+    names = ", ".join(_quote(conn, name) for name in columns)
+    conn.execute(text(f"INSERT INTO {_quote(conn, table.name)} ({names}) SELECT {names} FROM {_quote(conn, old)}"))
+    conn.execute(text(f"DROP TABLE {_quote(conn, old)}"))
+
+
+def _upgrade_table(conn: Connection, table: Table) -> list[str]:
+    existing = {column["name"]: column for column in inspect(conn).get_columns(table.name)}
+    changes = []
+    for column in table.columns:
+        if column.name not in existing:
+            conn.execute(text(f"ALTER TABLE {_quote(conn, table.name)} ADD COLUMN {_column_ddl(conn, column)}"))
+            changes.append(f"{table.name}.{column.name}: dodana")
+    relaxed = [
+        column.name
+        for column in table.columns
+        if column.name in existing and column.nullable and not existing[column.name]["nullable"]
+    ]
+    if relaxed:
+        if conn.dialect.name == "sqlite":
+            _rebuild_sqlite_table(conn, table, [column.name for column in table.columns])
+        else:
+            for name in relaxed:
+                conn.execute(text(f"ALTER TABLE {_quote(conn, table.name)} ALTER COLUMN {_quote(conn, name)} DROP NOT NULL"))
+        changes.extend(f"{table.name}.{name}: dopuszcza NULL" for name in relaxed)
+    return changes + _upgrade_indexes(conn, table)
+
+
+def _upgrade_indexes(conn: Connection, table: Table) -> list[str]:
+    inspector = inspect(conn)
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    existing.update(constraint["name"] for constraint in inspector.get_unique_constraints(table.name))
+    changes = []
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+            changes.append(f"{table.name}: indeks {index.name}")
+    for constraint in table.constraints:
+        if not isinstance(constraint, UniqueConstraint) or constraint.name in existing:
+            continue
+        columns = ", ".join(_quote(conn, column.name) for column in constraint.columns)
+        if constraint.name in _DEDUPLICATE:
+            conn.execute(
+                text(
+                    f"DELETE FROM {_quote(conn, table.name)} WHERE id NOT IN "
+                    f"(SELECT MIN(id) FROM {_quote(conn, table.name)} GROUP BY {columns})"
+                )
+            )
+        conn.execute(
+            text(f"CREATE UNIQUE INDEX {_quote(conn, constraint.name)} ON {_quote(conn, table.name)} ({columns})")
+        )
+        changes.append(f"{table.name}: unikalność {constraint.name}")
+    return changes
+
+
+def upgrade_schema(bind: Engine = engine) -> list[str]:
+    # Zwraca opis wprowadzonych zmian (pusty, gdy schemat jest aktualny).
+    models.Base.metadata.create_all(bind=bind)
+    changes = []
+    with bind.begin() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            changes += _upgrade_table(conn, table)
+    return changes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Aktualizacja schematu bazy SecureMail")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("upgrade", help="dodaje brakujące kolumny, indeksy i ograniczenia oraz zdejmuje nieaktualne NOT NULL")
+    args = parser.parse_args()
+    if args.command == "upgrade":
+        for change in upgrade_schema():
+            print(change)
+
+
+if __name__ == "__main__":
+    main()
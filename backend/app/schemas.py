@@ -1,13 +1,23 @@
-from datetime import datetime
+from datetime import datetime, timezone
 import re
-from typing import List
+from typing import List, Literal
 
-from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator, model_validator
+
+from .config import KeySuite
+
+
+def naive_utc(value: datetime) -> datetime:
+    # Kolumny DateTime przechowują czas UTC bez strefy; czas ze strefą sprowadzamy do tej postaci.
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
 
 
 class UserCreate(BaseModel):
     email: EmailStr
     password: str = Field(min_length=8, max_length=128)
+    key_suite: KeySuite | None = None
 
     @field_validator("password")
     @classmethod
@@ -26,6 +36,7 @@ class UserCreate(BaseModel):
 class UserOut(BaseModel):
     id: int
     email: EmailStr
+    key_suite: str
     created_at: datetime
 
     model_config = ConfigDict(from_attributes=True)
@@ -67,6 +78,7 @@ class MessageCreate(BaseModel):
     body: str
     recipients: List[EmailStr] = Field(min_length=1)
     attachments: List[AttachmentCreate] = []
+    attachment_ids: List[int] = []
 
 
 class MessageListItem(BaseModel):
@@ -79,6 +91,12 @@ class MessageListItem(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+class MessagePage(BaseModel):
+    items: List[MessageListItem]
+    next_cursor: str | None = None
+    head_cursor: str | None = None
+
+
 class MessageDetail(BaseModel):
     id: int
     subject: str
@@ -94,5 +112,65 @@ class MessageDetail(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+class DeliveryStatus(BaseModel):
+    id: int
+    message_id: int
+    status: str
+    total: int
+    delivered: int
+    error: str | None = None
+    created_at: datetime
+    updated_at: datetime | None = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
 class MarkReadResponse(BaseModel):
     status: str
+
+
+class MailboxStatsOut(BaseModel):
+    total: int = 0
+    unread: int = 0
+    storage_bytes: int = 0
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class BulkMailboxFilter(BaseModel):
+    unread: bool = False
+    before: datetime | None = None
+
+    @field_validator("before")
+    @classmethod
+    def before_utc(cls, value: datetime | None) -> datetime | None:
+        return naive_utc(value) if value is not None else None
+
+
+class BulkMailboxRequest(BaseModel):
+    action: Literal["read", "unread", "delete"]
+    ids: List[int] | None = Field(default=None, min_length=1)
+    filter: BulkMailboxFilter | None = None
+
+    @model_validator(mode="after")
+    def ids_or_filter(self) -> "BulkMailboxRequest":
+        if (self.ids is None) == (self.filter is None):
+            raise ValueError("Podaj listę ids albo filtr")
+        return self
+
+
+class BulkMailboxResult(BaseModel):
+    id: int
+    status: Literal["ok", "not_found"]
+
+
+class BulkMailboxResponse(BaseModel):
+    action: str
+    updated: int
+    results: List[BulkMailboxResult]
+    has_more: bool = False
+
+
+class SearchIndexStatus(BaseModel):
+    enabled: bool
+    pending: int
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import re
+import unicodedata
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import exists, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, session_store
+from .config import get_settings
+from .crypto_utils import decrypt_payload
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+TOKEN_SIZE = 16
+MAX_QUERY_TOKENS = 8
+# Ile słów tematu jednej wiadomości trafia do indeksu.
+_MAX_SUBJECT_WORDS = 32
+_WORD = re.compile(r"\w+")
+_SUBJECT = b"s:"
+_SENDER = b"f:"
+# Litery bez rozkładu NFKD, które i tak chcemy porównywać bez znaków diakrytycznych.
+_FOLD = str.maketrans({"ł": "l", "ø": "o", "đ": "d", "ħ": "h", "ı": "i", "æ": "ae", "œ": "oe"})
+
+_backfills: dict[int, asyncio.Task] = {}
+
+
+def normalize_words(text: str) -> list[str]:
+    # Małe litery bez znaków diakrytycznych, słowa od dwóch znaków, bez powtórzeń.
+    text = unicodedata.normalize("NFKD", text.casefold().translate(_FOLD))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return list(dict.fromkeys(word for word in _WORD.findall(text) if len(word) >= 2))
+
+
+def _token(search_key: bytes, kind: bytes, value: str) -> bytes:
+    return hmac.new(search_key, kind + value.encode("utf-8"), hashlib.sha256).digest()[:TOKEN_SIZE]
+
+
+def message_tokens(search_key: bytes, subject: str, sender_email: str) -> list[bytes]:
+    tokens = [_token(search_key, _SUBJECT, word) for word in normalize_words(subject)[:_MAX_SUBJECT_WORDS]]
+    tokens.append(_token(search_key, _SENDER, sender_email.lower()))
+    return tokens
+
+
+def query_tokens(search_key: bytes, q: str) -> list[bytes]:
+    # Wyrazy z "@" to adres nadawcy, pozostałe to słowa tematu; wiadomość musi pasować do wszystkich.
+    tokens: list[bytes] = []
+    for term in q.split():
+        if "@" in term:
+            tokens.append(_token(search_key, _SENDER, term.lower()))
+        else:
+            tokens.extend(_token(search_key, _SUBJECT, word) for word in normalize_words(term))
+    return list(dict.fromkeys(tokens))
+
+
+def matching_links(user_id: int, tokens: list[bytes]):
+    token = models.SearchToken
+    return (
+        select(token.link_id)
+        .where(token.recipient_id == user_id, token.token.in_(tokens))
+        .group_by(token.link_id)
+        .having(func.count(func.distinct(token.token)) == len(tokens))
+    )
+
+
+def _unindexed(user_id: int):
+    link = models.MessageRecipient
+    return (
+        link.recipient_id == user_id,
+        link.deleted_at.is_(None),
+        ~exists().where(models.SearchToken.link_id == link.id),
+    )
+
+
+async def pending_count(db: AsyncSession, user_id: int) -> int:
+    return await db.scalar(select(func.count(models.MessageRecipient.id)).where(*_unindexed(user_id)))
+
+
+async def index_pending(db: AsyncSession, user_id: int, keys, search_key: bytes, limit: int) -> int:
+    # Indeksuje do limit nieindeksowanych wiadomości skrzynki; zwraca ich liczbę.
+    link = models.MessageRecipient
+    rows = (
+        await db.execute(
+            select(
+                link.id.label("link_id"),
+                link.aes_key_enc,
+                models.Message.subject_enc,
+                models.Message.subject_nonce,
+                models.User.email.label("sender_email"),
+            )
+            .join(models.Message, link.message_id == models.Message.id)
+            .join(models.User, models.Message.sender_id == models.User.id)
+            .where(*_unindexed(user_id))
+            .order_by(link.id)
+            .limit(limit)
+        )
+    ).all()
+    if not rows:
+        return 0
+
+    aes_keys = await keys.message_keys((row.link_id, row.aes_key_enc) for row in rows)
+    values = []
+    for row in rows:
+        subject = decrypt_payload(row.subject_enc, row.subject_nonce, aes_keys[row.link_id]).decode("utf-8")
+        values.extend(
+            {"recipient_id": user_id, "link_id": row.link_id, "token": token}
+            for token in message_tokens(search_key, subject, row.sender_email)
+        )
+    await db.execute(_insert_tokens(db.get_bind().dialect.name), values)
+    await db.commit()
+    return len(rows)
+
+
+def _insert_tokens(dialect: str):
+    # Wyszukiwanie i backfill mogą równolegle indeksować te same wiadomości; uix_search_token odrzuca duplikaty.
+    if dialect == "postgresql":
+        return postgresql.insert(models.SearchToken).on_conflict_do_nothing(index_elements=["link_id", "token"])
+    if dialect == "sqlite":
+        return sqlite.insert(models.SearchToken).on_conflict_do_nothing(index_elements=["link_id", "token"])
+    return insert(models.SearchToken)
+
+
+async def _backfill(user_id: int, keys, search_key: bytes) -> None:
+    # Przerywamy, gdy użytkownik wyłączy indeks albo wygaśnie sesja, której kluczem liczymy tokeny.
+    try:
+        async with AsyncSessionLocal() as db:
+            while await run_in_threadpool(session_store.get_principal, keys.jti) is not None:
+                enabled = await db.scalar(select(models.User.search_enabled).where(models.User.id == user_id))
+                if not enabled:
+                    return
+                if not await index_pending(db, user_id, keys, search_key, settings.search_index_batch_size):
+                    return
+    except Exception:
+        logger.exception("search index backfill for user %s failed", user_id)
+    finally:
+        if _backfills.get(user_id) is asyncio.current_task():
+            del _backfills[user_id]
+
+
+def start_backfill(user_id: int, keys, search_key: bytes) -> None:
+    if user_id not in _backfills:
+        _backfills[user_id] = asyncio.create_task(_backfill(user_id, keys, search_key))
+
+
+def cancel_backfill(user_id: int) -> None:
+    task = _backfills.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+
+
+async def stop_backfills() -> None:
+    tasks = list(_backfills.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
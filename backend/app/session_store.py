@@ -1,30 +1,441 @@
+import argparse
+import heapq
+import os
 import threading
 import time
-from typing import Optional, Any
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from multiprocessing.connection import AuthenticationError, Client, Connection, Listener
+from typing import Optional, Any, Callable, Iterable
 
-# Prosty magazyn w pamięci na odszyfrowane klucze prywatne powiązane z jti tokenu.
-_store: dict[str, tuple[Any, float]] = {}
-_lock = threading.Lock()
+from .config import get_settings
+from .crypto_utils import derive_server_key, load_private_key, serialize_private_key
 
+settings = get_settings()
 
-def store_private_key(jti: str, private_key: Any, expires_at: float) -> None:
-    with _lock:
-        _store[jti] = (private_key, expires_at)
+# Przybliżony koszt jednego wpisu w pamięci (klucz krotki, 32 bajty klucza, węzeł słownika).
+_MESSAGE_KEY_ENTRY_BYTES = 320
+# Ile sparsowanych kluczy prywatnych trzyma klient pomocnika sesji w każdym procesie.
+_PARSED_KEYS_MAX = 1024
+_AUTHKEY_PURPOSE = b"securemail-session-store-v1"
 
 
-def get_private_key(jti: str) -> Optional[Any]:
-    now = time.time()
-    with _lock:
-        entry = _store.get(jti)
-        if not entry:
+@dataclass(frozen=True)
+class Principal:
+    # Zalogowany użytkownik w zakresie potrzebnym większości endpointów; pełny wiersz User ładuje się osobno.
+    id: int
+    email: str
+
+
+class SessionBackend(ABC):
+    @abstractmethod
+    def store_private_key(self, jti: str, private_key: Any, expires_at: float, principal: Principal) -> None: ...
+
+    @abstractmethod
+    def get_private_key(self, jti: str) -> Optional[Any]: ...
+
+    @abstractmethod
+    def get_principal(self, jti: str) -> Optional[Principal]: ...
+
+    @abstractmethod
+    def revoke_private_key(self, jti: str) -> None: ...
+
+    # Odpakowane klucze AES wiadomości dla sesji, kluczowane MessageRecipient.id; zwraca tylko trafienia.
+    @abstractmethod
+    def get_message_keys(self, jti: str, link_ids: Iterable[int]) -> dict[int, bytes]: ...
+
+    @abstractmethod
+    def store_message_keys(self, jti: str, keys: dict[int, bytes]) -> None: ...
+
+    @abstractmethod
+    def session_count(self) -> int: ...
+
+    # Zadania w tle backendu (np. usuwanie wygasłych sesji).
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+class _Shard:
+    def __init__(self, max_message_keys: int):
+        self.lock = threading.Lock()
+        self.sessions: dict[str, tuple[Any, float, Principal]] = {}
+        self.message_keys: "OrderedDict[tuple[str, int], bytes]" = OrderedDict()
+        self.message_keys_by_jti: dict[str, set[int]] = {}
+        self.max_message_keys = max_message_keys
+
+    def drop(self, jti: str) -> None:
+        self.sessions.pop(jti, None)
+        for link_id in self.message_keys_by_jti.pop(jti, ()):
+            self.message_keys.pop((jti, link_id), None)
+
+    def active(self, jti: str, now: float) -> Optional[tuple[Any, float, Principal]]:
+        # Wygasłe wpisy tylko pomijamy; usuwa je sweep() na podstawie indeksu wygaśnięć.
+        entry = self.sessions.get(jti)
+        if entry is None or entry[1] < now:
             return None
-        key, expires_at = entry
-        if expires_at < now:
-            _store.pop(jti, None)
+        return entry
+
+
+class MemorySessionBackend(SessionBackend):
+    # Magazyn w pamięci procesu: odszyfrowane klucze prywatne powiązane z jti tokenu
+    # i odpakowane klucze AES wiadomości (LRU), kluczowane (jti, MessageRecipient.id).
+    # Odczyty blokują tylko swój shard; indeks (kopiec wygaśnięć, kolejność utworzenia, sesje
+    # użytkowników) ma osobną blokadę, zawsze brana przed blokadą shardu.
+    def __init__(
+        self,
+        message_key_cache_bytes: int,
+        shards: int = 16,
+        max_sessions: int = 0,
+        max_sessions_per_user: int = 0,
+        sweep_interval: float = 30.0,
+    ):
+        shards = max(shards, 1)
+        max_message_keys = max(message_key_cache_bytes // _MESSAGE_KEY_ENTRY_BYTES, 0)
+        per_shard = -(-max_message_keys // shards)
+        self._shards = [_Shard(per_shard) for _ in range(shards)]
+        self._index_lock = threading.Lock()
+        self._expiry: list[tuple[float, str]] = []
+        self._order: "OrderedDict[str, int]" = OrderedDict()
+        self._by_user: dict[int, "OrderedDict[str, None]"] = {}
+        self._max_sessions = max_sessions
+        self._max_sessions_per_user = max_sessions_per_user
+        self._sweep_interval = sweep_interval
+        self._sweeper: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    def _shard(self, jti: str) -> _Shard:
+        return self._shards[hash(jti) % len(self._shards)]
+
+    def _drop_locked(self, jti: str) -> None:
+        # Wymaga _index_lock.
+        user_id = self._order.pop(jti, None)
+        if user_id is not None:
+            user_sessions = self._by_user.get(user_id)
+            if user_sessions is not None:
+                user_sessions.pop(jti, None)
+                if not user_sessions:
+                    self._by_user.pop(user_id, None)
+        shard = self._shard(jti)
+        with shard.lock:
+            shard.drop(jti)
+
+    def store_private_key(self, jti: str, private_key: Any, expires_at: float, principal: Principal) -> None:
+        user_id = principal.id
+        shard = self._shard(jti)
+        with self._index_lock:
+            if jti in self._order:
+                self._drop_locked(jti)
+            user_sessions = self._by_user.get(user_id)
+            if self._max_sessions_per_user > 0 and user_sessions:
+                while len(user_sessions) >= self._max_sessions_per_user:
+                    self._drop_locked(next(iter(user_sessions)))
+            if self._max_sessions > 0:
+                while len(self._order) >= self._max_sessions:
+                    self._drop_locked(next(iter(self._order)))
+            self._order[jti] = user_id
+            self._by_user.setdefault(user_id, OrderedDict())[jti] = None
+            heapq.heappush(self._expiry, (expires_at, jti))
+            with shard.lock:
+                shard.sessions[jti] = (private_key, expires_at, principal)
+
+    def get_private_key(self, jti: str) -> Optional[Any]:
+        now = time.time()
+        shard = self._shard(jti)
+        with shard.lock:
+            entry = shard.active(jti, now)
+            return entry[0] if entry else None
+
+    def get_principal(self, jti: str) -> Optional[Principal]:
+        now = time.time()
+        shard = self._shard(jti)
+        with shard.lock:
+            entry = shard.active(jti, now)
+            return entry[2] if entry else None
+
+    def revoke_private_key(self, jti: str) -> None:
+        with self._index_lock:
+            self._drop_locked(jti)
+
+    def get_message_keys(self, jti: str, link_ids: Iterable[int]) -> dict[int, bytes]:
+        now = time.time()
+        found: dict[int, bytes] = {}
+        shard = self._shard(jti)
+        with shard.lock:
+            if shard.active(jti, now) is None:
+                return found
+            for link_id in link_ids:
+                key = shard.message_keys.get((jti, link_id))
+                if key is not None:
+                    shard.message_keys.move_to_end((jti, link_id))
+                    found[link_id] = key
+        return found
+
+    def store_message_keys(self, jti: str, keys: dict[int, bytes]) -> None:
+        now = time.time()
+        shard = self._shard(jti)
+        with shard.lock:
+            if shard.max_message_keys == 0 or shard.active(jti, now) is None:
+                return
+            links = shard.message_keys_by_jti.setdefault(jti, set())
+            for link_id, aes_key in keys.items():
+                shard.message_keys[(jti, link_id)] = aes_key
+                shard.message_keys.move_to_end((jti, link_id))
+                links.add(link_id)
+            while len(shard.message_keys) > shard.max_message_keys:
+                (old_jti, old_link_id), _ = shard.message_keys.popitem(last=False)
+                old_links = shard.message_keys_by_jti.get(old_jti)
+                if old_links is not None:
+                    old_links.discard(old_link_id)
+                    if not old_links:
+                        shard.message_keys_by_jti.pop(old_jti, None)
+
+    def sweep(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        removed = 0
+        with self._index_lock:
+            while self._expiry and self._expiry[0][0] < now:
+                expires_at, jti = heapq.heappop(self._expiry)
+                # Wpis w kopcu mógł się zdezaktualizować (unieważnienie, ponowny zapis tego samego jti).
+                shard = self._shard(jti)
+                with shard.lock:
+                    entry = shard.sessions.get(jti)
+                if entry is not None and entry[1] == expires_at:
+                    self._drop_locked(jti)
+                    removed += 1
+        return removed
+
+    def session_count(self) -> int:
+        with self._index_lock:
+            return len(self._order)
+
+    def _sweep_loop(self) -> None:
+        while not self._stopped.wait(self._sweep_interval):
+            self.sweep()
+
+    def start(self) -> None:
+        if self._sweeper is None and self._sweep_interval > 0:
+            self._stopped.clear()
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+
+class SocketClient:
+    # Połączenie z pomocnikiem sesji (serve_sessions) na gnieździe Unix, osobne dla każdego wątku.
+    def __init__(self, address: str, authkey: bytes, timeout: float):
+        self._address = address
+        self._authkey = authkey
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def _close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def _connection(self) -> Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self._address, family="AF_UNIX", authkey=self._authkey)
+        return conn
+
+    def call(self, op: str, *args: Any) -> Any:
+        # Jedno ponowienie po zerwanym połączeniu (np. restart pomocnika).
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send((op, args))
+                if not conn.poll(self._timeout):
+                    # Spóźniona odpowiedź trafiłaby do następnego wywołania, więc porzucamy połączenie.
+                    self._close()
+                    raise TimeoutError(f"session store did not answer {op!r} within {self._timeout}s")
+                return conn.recv()
+            except TimeoutError:
+                raise
+            except (EOFError, OSError):
+                self._close()
+                if attempt:
+                    raise
+
+
+class SocketSessionBackend(SessionBackend):
+    # Sesje trzymane przez pomocnika sesji, współdzielonego przez workery jednego hosta.
+    # Pomocnik trzyma materiał kluczy wyłącznie w pamięci; klucze przesyłane są jako bajty,
+    # a sparsowane obiekty każdy proces trzyma lokalnie, dopóki pomocnik zwraca ten sam materiał.
+    def __init__(self, client: SocketClient):
+        self._call = client.call
+        self._parsed: "OrderedDict[str, tuple[tuple[bytes, str], Any]]" = OrderedDict()
+        self._parsed_lock = threading.Lock()
+
+    def _forget_parsed(self, jti: str) -> None:
+        with self._parsed_lock:
+            self._parsed.pop(jti, None)
+
+    def store_private_key(self, jti: str, private_key: Any, expires_at: float, principal: Principal) -> None:
+        material = serialize_private_key(private_key)
+        self._call("store_private_key", jti, material, expires_at, principal)
+        with self._parsed_lock:
+            self._parsed[jti] = (material, private_key)
+            while len(self._parsed) > _PARSED_KEYS_MAX:
+                self._parsed.popitem(last=False)
+
+    def get_private_key(self, jti: str) -> Optional[Any]:
+        material = self._call("get_private_key", jti)
+        if material is None:
+            self._forget_parsed(jti)
             return None
-        return key
+        with self._parsed_lock:
+            cached = self._parsed.get(jti)
+            if cached is not None and cached[0] == material:
+                self._parsed.move_to_end(jti)
+                return cached[1]
+        private_pem, key_suite = material
+        private_key = load_private_key(private_pem, key_suite)
+        with self._parsed_lock:
+            self._parsed[jti] = (material, private_key)
+            while len(self._parsed) > _PARSED_KEYS_MAX:
+                self._parsed.popitem(last=False)
+        return private_key
+
+    def get_principal(self, jti: str) -> Optional[Principal]:
+        return self._call("get_principal", jti)
+
+    def revoke_private_key(self, jti: str) -> None:
+        self._call("revoke_private_key", jti)
+        self._forget_parsed(jti)
+
+    def get_message_keys(self, jti: str, link_ids: Iterable[int]) -> dict[int, bytes]:
+        return self._call("get_message_keys", jti, list(link_ids))
+
+    def store_message_keys(self, jti: str, keys: dict[int, bytes]) -> None:
+        self._call("store_message_keys", jti, keys)
+
+    def session_count(self) -> int:
+        return self._call("session_count")
+
+
+_SESSION_OPS = (
+    "store_private_key",
+    "get_private_key",
+    "get_principal",
+    "revoke_private_key",
+    "get_message_keys",
+    "store_message_keys",
+    "session_count",
+)
+
+
+def _session_authkey() -> bytes:
+    return derive_server_key(settings.secret_key, _AUTHKEY_PURPOSE)
+
+
+def _serve_connection(handlers: dict[str, Callable[..., Any]], conn: Connection) -> None:
+    with conn:
+        while True:
+            try:
+                op, args = conn.recv()
+            except (EOFError, OSError):
+                return
+            handler = handlers.get(op)
+            if handler is None:
+                return
+            conn.send(handler(*args))
+
+
+def serve_sessions(address: str) -> None:
+    # Gniazdo tylko dla właściciela; połączenia uwierzytelnia authkey wyprowadzony z secret_key,
+    # zanim cokolwiek zostanie odebrane. Materiał kluczy nigdy nie jest zapisywany na dysk.
+    os.umask(0o077)
+    if os.path.exists(address):
+        os.unlink(address)
+    # Pomocnik trzyma też liczniki limitów żądań, żeby limity obowiązywały łącznie dla wszystkich workerów.
+    from .rate_limiter import RateLimiter
+
+    backend = _memory_backend()
+    backend.start()
+    handlers = {op: getattr(backend, op) for op in _SESSION_OPS}
+    rate_limiter = RateLimiter(settings.rate_limit_max_keys)
+    handlers["rate_limit_hit"] = rate_limiter.hit
+    handlers["rate_limit_key_count"] = rate_limiter.__len__
+    with Listener(address, family="AF_UNIX", authkey=_session_authkey()) as listener:
+        print(f"pomocnik sesji nasłuchuje na {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError):
+                continue
+            threading.Thread(target=_serve_connection, args=(handlers, conn), daemon=True).start()
+
+
+def _memory_backend() -> MemorySessionBackend:
+    return MemorySessionBackend(
+        settings.message_key_cache_bytes,
+        shards=settings.session_store_shards,
+        max_sessions=settings.session_max_count,
+        max_sessions_per_user=settings.session_max_per_user,
+        sweep_interval=settings.session_sweep_interval_seconds,
+    )
+
+
+@lru_cache
+def get_shared_client() -> SocketClient:
+    return SocketClient(settings.session_store_socket, _session_authkey(), settings.session_store_timeout_seconds)
+
+
+@lru_cache
+def get_backend() -> SessionBackend:
+    if settings.session_store_backend == "memory":
+        return _memory_backend()
+    if settings.session_store_backend == "socket":
+        return SocketSessionBackend(get_shared_client())
+    raise ValueError(f"Unknown session store backend: {settings.session_store_backend}")
+
+
+def store_private_key(jti: str, private_key: Any, expires_at: float, principal: Principal) -> None:
+    get_backend().store_private_key(jti, private_key, expires_at, principal)
+
+
+def get_private_key(jti: str) -> Optional[Any]:
+    return get_backend().get_private_key(jti)
+
+
+def get_principal(jti: str) -> Optional[Principal]:
+    return get_backend().get_principal(jti)
 
 
 def revoke_private_key(jti: str) -> None:
-    with _lock:
-        _store.pop(jti, None)
+    get_backend().revoke_private_key(jti)
+
+
+def get_message_keys(jti: str, link_ids: Iterable[int]) -> dict[int, bytes]:
+    return get_backend().get_message_keys(jti, link_ids)
+
+
+def store_message_keys(jti: str, keys: dict[int, bytes]) -> None:
+    if keys:
+        get_backend().store_message_keys(jti, keys)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pomocnik sesji SecureMail")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="udostępnia sesje workerom tego hosta przez gniazdo Unix")
+    serve.add_argument("--socket", default=settings.session_store_socket)
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve_sessions(args.socket)
+
+
+if __name__ == "__main__":
+    main()
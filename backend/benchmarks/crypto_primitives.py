@@ -0,0 +1,152 @@
+import argparse
+import os
+import timeit
+from typing import Callable
+
+from app.crypto_utils import (
+    AES_GCM_TAG_SIZE,
+    ATTACHMENT_SEGMENT_SIZE,
+    KEY_SUITE_EC,
+    KEY_SUITE_RSA,
+    SegmentedEncryptor,
+    build_signature_manifest,
+    decrypt_payload,
+    decrypt_private_key_pem,
+    decrypt_segment,
+    derive_key,
+    derive_search_key,
+    derive_server_key,
+    encrypt_payload,
+    encrypt_private_key,
+    generate_aes_key,
+    generate_ec_keypair,
+    generate_rsa_keypair,
+    key_fingerprint,
+    load_private_key,
+    load_public_key,
+    serialize_private_key,
+    sha256_digest,
+    sign_payload,
+    unwrap_aes_key,
+    unwrap_aes_keys,
+    verify_signature,
+    verify_signature_digest,
+    wrap_aes_key,
+)
+from app.security import hash_password, verify_password
+
+from .report import emit, environment, summarize
+
+_PASSWORD = "Benchmark-Passw0rd!"
+# Tyle kluczy odpakowuje jedna strona skrzynki przy domyślnym inbox_page_size.
+_PAGE_KEYS = 50
+
+
+def _samples_ms(fn: Callable[[], object], repeat: int, number: int) -> list[float]:
+    return [total / number * 1000 for total in timeit.repeat(fn, repeat=repeat, number=number)]
+
+
+def _seal(data: bytes, key: bytes) -> bytes:
+    encryptor = SegmentedEncryptor(key)
+    return encryptor.update(data) + encryptor.finalize()
+
+
+def _suite_ops(suite: str, private_material: bytes, public_pem: bytes, signing_pem: bytes) -> dict[str, Callable]:
+    private_key = load_private_key(private_material, suite)
+    aes_key = generate_aes_key()
+    wrapped, _ = wrap_aes_key(aes_key, public_pem)
+    manifest = build_signature_manifest(os.urandom(64), os.urandom(1024), [os.urandom(32)] * 2)
+    signature = sign_payload(manifest, private_key)
+    ops = {
+        "load_private_key": lambda: load_private_key(private_material, suite),
+        "serialize_private_key": lambda: serialize_private_key(private_key),
+        "derive_search_key": lambda: derive_search_key(private_key),
+        "load_public_key": lambda: load_public_key(public_pem),
+        "wrap_aes_key": lambda: wrap_aes_key(aes_key, public_pem),
+        "unwrap_aes_key": lambda: unwrap_aes_key(wrapped, private_key),
+        f"unwrap_aes_keys x{_PAGE_KEYS}": lambda: unwrap_aes_keys([wrapped] * _PAGE_KEYS, private_key),
+        "sign_payload": lambda: sign_payload(manifest, private_key),
+        "verify_signature": lambda: verify_signature(manifest, signature, signing_pem),
+    }
+    if suite == KEY_SUITE_RSA:
+        digest = sha256_digest(manifest)
+        ops["verify_signature_digest"] = lambda: verify_signature_digest(digest, signature, signing_pem)
+    return {f"{suite}/{name}": fn for name, fn in ops.items()}
+
+
+def _kdf_ops() -> dict[str, Callable]:
+    salt = os.urandom(16)
+    private_pem = os.urandom(3200)
+    sealed_pem = encrypt_private_key(private_pem, _PASSWORD)
+    return {
+        "derive_key": lambda: derive_key(_PASSWORD, salt),
+        "encrypt_private_key": lambda: encrypt_private_key(private_pem, _PASSWORD),
+        "decrypt_private_key_pem": lambda: decrypt_private_key_pem(*sealed_pem, _PASSWORD),
+    }
+
+
+def _symmetric_ops(sizes: list[int]) -> dict[str, Callable]:
+    aes_key = generate_aes_key()
+    public_pem = os.urandom(800)
+    ops: dict[str, Callable] = {
+        "generate_aes_key": generate_aes_key,
+        "derive_server_key": lambda: derive_server_key("x" * 32, b"benchmark"),
+        "key_fingerprint": lambda: key_fingerprint(public_pem),
+    }
+    for size in sizes:
+        data = os.urandom(size)
+        ciphertext, nonce = encrypt_payload(data, aes_key)
+        ops[f"encrypt_payload {size}B"] = lambda data=data: encrypt_payload(data, aes_key)
+        ops[f"decrypt_payload {size}B"] = lambda c=ciphertext, n=nonce: decrypt_payload(c, n, aes_key)
+        ops[f"sha256_digest {size}B"] = lambda data=data: sha256_digest(data)
+        ops[f"segmented_encrypt {size}B"] = lambda data=data: _seal(data, aes_key)
+        if size > ATTACHMENT_SEGMENT_SIZE:
+            # Pierwszy (niekońcowy) segment: tyle odszyfrowuje pobieranie zakresu na segment.
+            encryptor = SegmentedEncryptor(aes_key)
+            segment = encryptor.update(data)[: ATTACHMENT_SEGMENT_SIZE + AES_GCM_TAG_SIZE]
+            ops["decrypt_segment"] = lambda s=segment, p=encryptor.nonce_prefix: decrypt_segment(s, p, 0, False, aes_key)
+    return ops
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mikrobenchmarki prymitywów app.crypto_utils (wynik w JSON)")
+    parser.add_argument("--number", type=int, default=20, help="operacji w jednym pomiarze")
+    parser.add_argument("--repeat", type=int, default=7, help="liczba pomiarów (próbek) na operację")
+    parser.add_argument("--slow-number", type=int, default=1, help="operacji w pomiarze dla generacji kluczy RSA, KDF i haseł")
+    parser.add_argument("--sizes", default="1024,1048576", help="rozmiary danych symetrycznych w bajtach")
+    parser.add_argument("--filter", default="", help="tylko pomiary zawierające ten tekst")
+    parser.add_argument("--output", help="plik wyników (domyślnie stdout)")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    rsa_private, rsa_public = generate_rsa_keypair()
+    ec_private, ec_public, ec_signing = generate_ec_keypair()
+    password_hash = hash_password(_PASSWORD)
+
+    # Operacje trwające dziesiątki i setki milisekund mierzymy pojedynczo, żeby cały zestaw kończył się
+    # w rozsądnym czasie.
+    slow = {
+        f"{KEY_SUITE_RSA}/generate_keypair": generate_rsa_keypair,
+        **_kdf_ops(),
+        "security/hash_password": lambda: hash_password(_PASSWORD),
+        "security/verify_password": lambda: verify_password(_PASSWORD, password_hash),
+    }
+    fast = {
+        f"{KEY_SUITE_EC}/generate_keypair": generate_ec_keypair,
+        **_suite_ops(KEY_SUITE_RSA, rsa_private, rsa_public, rsa_public),
+        **_suite_ops(KEY_SUITE_EC, ec_private, ec_public, ec_signing),
+        **_symmetric_ops(sizes),
+    }
+
+    results = {}
+    for ops, number in ((slow, args.slow_number), (fast, args.number)):
+        for name, fn in ops.items():
+            if args.filter in name:
+                results[name] = summarize(_samples_ms(fn, args.repeat, number))
+
+    meta = environment(number=args.number, repeat=args.repeat, slow_number=args.slow_number, sizes=sizes)
+    emit("crypto_primitives", meta, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
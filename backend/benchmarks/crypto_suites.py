@@ -0,0 +1,72 @@
+import argparse
+import os
+import timeit
+from typing import Callable
+
+from app.crypto_utils import (
+    KEY_SUITE_EC,
+    generate_aes_key,
+    generate_ec_keypair,
+    generate_rsa_keypair,
+    load_private_key,
+    sign_payload,
+    unwrap_aes_key,
+    verify_signature,
+    wrap_aes_key,
+)
+
+
+def _per_op_ms(fn: Callable[[], object], repeat: int, number: int) -> float:
+    # Najlepszy z kilku pomiarów: najmniej zaszumiony szacunek czasu jednej operacji.
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number * 1000
+
+
+def _suite_ops(private_material: bytes, public_pem: bytes, signing_pem: bytes, key_suite: str) -> dict:
+    private_key = load_private_key(private_material, key_suite)
+    aes_key = generate_aes_key()
+    wrapped, _ = wrap_aes_key(aes_key, public_pem)
+    manifest = os.urandom(23 + 32 * 4)
+    signature = sign_payload(manifest, private_key)
+    return {
+        "wrap": lambda: wrap_aes_key(aes_key, public_pem),
+        "unwrap": lambda: unwrap_aes_key(wrapped, private_key),
+        "sign": lambda: sign_payload(manifest, private_key),
+        "verify": lambda: verify_signature(manifest, signature, signing_pem),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Porównanie zestawów RSA-4096 i X25519/Ed25519")
+    parser.add_argument("--number", type=int, default=50, help="operacji w jednym pomiarze")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keygen-number", type=int, default=3, help="generacji kluczy RSA w jednym pomiarze")
+    args = parser.parse_args()
+
+    rsa_private, rsa_public = generate_rsa_keypair()
+    ec_private, ec_public, ec_signing = generate_ec_keypair()
+    rsa_ops = _suite_ops(rsa_private, rsa_public, rsa_public, "rsa")
+    ec_ops = _suite_ops(ec_private, ec_public, ec_signing, KEY_SUITE_EC)
+
+    results = [
+        (
+            "keygen",
+            _per_op_ms(generate_rsa_keypair, args.repeat, args.keygen_number),
+            _per_op_ms(generate_ec_keypair, args.repeat, args.number),
+        )
+    ]
+    for name in rsa_ops:
+        results.append(
+            (
+                name,
+                _per_op_ms(rsa_ops[name], args.repeat, args.number),
+                _per_op_ms(ec_ops[name], args.repeat, args.number),
+            )
+        )
+
+    print(f"{'operacja':<10}{'RSA-4096 [ms]':>16}{'X25519/Ed25519 [ms]':>22}{'przyspieszenie':>16}")
+    for name, rsa_ms, ec_ms in results:
+        print(f"{name:<10}{rsa_ms:>16.3f}{ec_ms:>22.3f}{rsa_ms / ec_ms:>15.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Wersja formatu pliku wyników; zmieniamy ją, gdy zmienia się znaczenie istniejących pól.
+FORMAT_VERSION = 1
+
+
+def summarize(samples_ms: list[float]) -> dict:
+    ordered = sorted(samples_ms)
+    return {
+        "unit": "ms",
+        "n": len(ordered),
+        "min": round(ordered[0], 4),
+        "median": round(statistics.median(ordered), 4),
+        "p95": round(ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))], 4),
+        "mean": round(statistics.fmean(ordered), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment(**extra) -> dict:
+    return {
+        "format": FORMAT_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        **extra,
+    }
+
+
+def emit(suite: str, meta: dict, results: dict, output: str | None) -> None:
+    # Klucze sortowane, więc pliki z dwóch uruchomień można porównać zwykłym diffem.
+    report = {"suite": suite, "meta": meta, "results": results}
+    text = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False) + "\n"
+    if output:
+        with open(output, "w", encoding="utf-8") as fh:
+            fh.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+def _format(value: float | None) -> str:
+    return "-" if value is None else f"{value:.3f}"
+
+
+def compare(base: dict, new: dict, metric: str, threshold: float) -> list[str]:
+    # Wypisuje porównanie dwóch raportów; zwraca nazwy pomiarów wolniejszych niż threshold.
+    regressions = []
+    print(f"{'pomiar':<48}{'przed [ms]':>14}{'po [ms]':>14}{'zmiana':>10}")
+    for name in sorted(set(base["results"]) | set(new["results"])):
+        before = base["results"].get(name, {}).get(metric)
+        after = new["results"].get(name, {}).get(metric)
+        if before is None or after is None:
+            print(f"{name:<48}{_format(before):>14}{_format(after):>14}")
+            continue
+        ratio = after / before if before else float("inf")
+        flag = " !" if ratio > threshold else ""
+        print(f"{name:<48}{before:>14.3f}{after:>14.3f}{ratio:>9.2f}x{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Porównanie wyników benchmarków SecureMail")
+    sub = parser.add_subparsers(dest="command", required=True)
+    diff = sub.add_parser("compare", help="porównuje dwa pliki wyników")
+    diff.add_argument("base")
+    diff.add_argument("new")
+    diff.add_argument("--metric", default="median", choices=("min", "median", "p95", "mean", "max"))
+    diff.add_argument("--threshold", type=float, default=1.2, help="próg spowolnienia (po/przed) dla kodu wyjścia 1")
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.base, encoding="utf-8") as fh:
+            base = json.load(fh)
+        with open(args.new, encoding="utf-8") as fh:
+            new = json.load(fh)
+        if base.get("suite") != new.get("suite"):
+            parser.error(f"różne zestawy: {base.get('suite')} i {new.get('suite')}")
+        if compare(base, new, args.metric, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
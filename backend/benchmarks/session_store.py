@@ -0,0 +1,86 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from app import session_store
+from app.config import get_settings
+from app.crypto_utils import generate_rsa_keypair, load_private_key
+
+_LINKS_PER_PAGE = 50
+
+
+def _wait_for_socket(path: str, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise RuntimeError("pomocnik sesji nie wystartował")
+        time.sleep(0.05)
+
+
+def _measure(backend: session_store.SessionBackend, private_key, number: int, repeat: int) -> dict[str, float]:
+    jti = os.urandom(16).hex()
+    backend.store_private_key(jti, private_key, time.time() + 3600, session_store.Principal(1, "bench@example.com"))
+    link_ids = list(range(_LINKS_PER_PAGE))
+    backend.store_message_keys(jti, {link_id: os.urandom(32) for link_id in link_ids})
+
+    def per_op_us(fn) -> float:
+        return min(timeit.repeat(fn, repeat=repeat, number=number)) / number * 1e6
+
+    stored = iter(range(2, 2 + number * repeat))
+
+    def store_new() -> None:
+        user_id = next(stored)
+        principal = session_store.Principal(user_id, f"bench-{user_id}@example.com")
+        backend.store_private_key(f"bench-{user_id}", private_key, time.time() + 3600, principal)
+
+    return {
+        "store_private_key": per_op_us(store_new),
+        "get_private_key": per_op_us(lambda: backend.get_private_key(jti)),
+        f"get_message_keys x{_LINKS_PER_PAGE}": per_op_us(lambda: backend.get_message_keys(jti, link_ids)),
+        "get_private_key (brak)": per_op_us(lambda: backend.get_private_key("missing")),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Opóźnienie odczytu sesji: pamięć procesu vs pomocnik na gnieździe Unix")
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    private_key = load_private_key(generate_rsa_keypair()[0])
+    memory = _measure(
+        session_store.MemorySessionBackend(get_settings().message_key_cache_bytes), private_key, args.number, args.repeat
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = os.path.join(tmp, "sessions.sock")
+        # Pomocnik musi wyprowadzić ten sam authkey, także gdy secret_key jest losowany przy starcie.
+        env = {**os.environ, "SECUREMAIL_SECRET_KEY": get_settings().secret_key}
+        helper = subprocess.Popen(
+            [sys.executable, "-m", "app.session_store", "serve", "--socket", socket_path],
+            stdout=subprocess.DEVNULL,
+            env=env,
+        )
+        try:
+            _wait_for_socket(socket_path)
+            backend = session_store.SocketSessionBackend(
+                session_store.SocketClient(
+                    socket_path, session_store._session_authkey(), get_settings().session_store_timeout_seconds
+                )
+            )
+            shared = _measure(backend, private_key, args.number, args.repeat)
+        finally:
+            helper.terminate()
+            helper.wait()
+
+    print(f"{'operacja':<26}{'pamięć [µs]':>14}{'gniazdo [µs]':>15}")
+    for name, memory_us in memory.items():
+        print(f"{name:<26}{memory_us:>14.2f}{shared[name]:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+# Ustawienia czytane są przy pierwszym imporcie app, więc środowisko testów ustawiamy przed nim.
+_tmp = tempfile.mkdtemp(prefix="securemail-tests-")
+os.environ["SECUREMAIL_DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+os.environ["SECUREMAIL_BLOB_STORE_PATH"] = os.path.join(_tmp, "blobs")
+os.environ["SECUREMAIL_SECRET_KEY"] = "test-secret-" + "x" * 32
+os.environ["SECUREMAIL_KEYPAIR_POOL_HIGH"] = "0"
+os.environ["SECUREMAIL_SESSION_STORE_BACKEND"] = "memory"
+
+import pyotp  # noqa: E402
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+_PASSWORD = "Test-Passw0rd!"
+
+
+@pytest.fixture(scope="session")
+def client():
+    from app.main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limiter():
+    # Wszystkie żądania TestClient mają ten sam adres, więc limity logowania nie mogą przechodzić między testami.
+    from app.rate_limiter import get_rate_limiter
+
+    get_rate_limiter.cache_clear()
+
+
+@pytest.fixture(scope="session")
+def make_user(client):
+    def make_user(email: str) -> dict:
+        r = client.post("/auth/register", json={"email": email, "password": _PASSWORD, "key_suite": "x25519-ed25519"})
+        assert r.status_code == 201, r.text
+        totp = pyotp.TOTP(pyotp.parse_uri(r.json()["totp_uri"]).secret)
+        r = client.post("/auth/login", json={"email": email, "password": _PASSWORD, "totp_code": totp.now()})
+        assert r.status_code == 200, r.text
+        return {"email": email, "headers": {"Authorization": f"Bearer {r.json()['access_token']}"}}
+
+    return make_user
@@ -0,0 +1,31 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+from app.schemas import BulkMailboxFilter
+
+
+def test_bulk_filter_before_is_normalized_to_naive_utc():
+    assert BulkMailboxFilter(before="2024-05-01T12:00:00+02:00").before == datetime(2024, 5, 1, 10, 0)
+    assert BulkMailboxFilter(before="2024-05-01T12:00:00Z").before == datetime(2024, 5, 1, 12, 0)
+    assert BulkMailboxFilter(before="2024-05-01T12:00:00").before == datetime(2024, 5, 1, 12, 0)
+
+
+def test_offset_aware_parameters_match_naive_ones(client, make_user):
+    owner = make_user("tz-owner@example.com")
+    r = client.post("/messages", json={"subject": "s", "body": "x", "recipients": [owner["email"]]}, headers=owner["headers"])
+    assert r.status_code == 201, r.text
+
+    future = (datetime.utcnow() + timedelta(hours=1)).replace(microsecond=0)
+    # Ta sama chwila zapisana w strefie +02:00.
+    aware = (future + timedelta(hours=2)).isoformat() + "+02:00"
+    cursor = base64.urlsafe_b64encode(json.dumps([aware, 10**9]).encode()).decode().rstrip("=")
+    r = client.get("/messages", params={"cursor": cursor}, headers=owner["headers"])
+    assert r.status_code == 200, r.text
+    assert [item["subject"] for item in r.json()["items"]] == ["s"]
+
+    r = client.post(
+        "/messages/bulk", json={"action": "read", "filter": {"before": aware}}, headers=owner["headers"]
+    )
+    assert r.status_code == 200, r.text
+    assert r.json()["updated"] == 1
@@ -0,0 +1,121 @@
+import base64
+import os
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event, insert
+
+from app import mailbox_stats, metrics, models
+from app.database import SessionLocal, async_engine, engine
+
+SMALL_INBOX = 3
+LARGE_INBOX = 300
+
+
+@contextmanager
+def count_statements():
+    # Liczymy tylko zapytania żądań (z kontekstem metryk), bez wątków w tle (dostarczanie, pula kluczy).
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if metrics.current_timings() is not None:
+            statements.append(statement)
+
+    targets = (engine, async_engine.sync_engine)
+    for target in targets:
+        event.listen(target, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for target in targets:
+            event.remove(target, "before_cursor_execute", before_cursor_execute)
+
+
+def _seed_inbox(email: str, total: int) -> None:
+    # Powiela jedyną wiadomość skrzynki do total wierszy, jak benchmarks/api.py.
+    columns = (
+        "sender_id",
+        "subject_enc",
+        "subject_nonce",
+        "body_enc",
+        "body_nonce",
+        "signature",
+        "signature_algo",
+        "signature_verified",
+        "signature_key_fingerprint",
+    )
+    with SessionLocal() as db:
+        user_id = db.query(models.User.id).filter(models.User.email == email).scalar()
+        link = db.query(models.MessageRecipient).filter(models.MessageRecipient.recipient_id == user_id).one()
+        message = db.get(models.Message, link.message_id)
+        row = {column: getattr(message, column) for column in columns}
+        count = total - 1
+        message_ids = db.scalars(insert(models.Message).returning(models.Message.id), [row] * count).all()
+        db.execute(
+            insert(models.MessageRecipient),
+            [
+                {"message_id": message_id, "recipient_id": user_id, "aes_key_enc": link.aes_key_enc, "wrap_algo": link.wrap_algo}
+                for message_id in message_ids
+            ],
+        )
+        size = len(message.subject_enc) + len(message.body_enc)
+        mailbox_stats.apply_deltas(db, {user_id: (count, count, count * size)})
+        db.commit()
+
+
+@pytest.fixture(scope="module")
+def mailboxes(client, make_user):
+    sender = make_user("counts-sender@example.com")
+    result = {}
+    for name, total in (("small", SMALL_INBOX), ("large", LARGE_INBOX)):
+        owner = make_user(f"counts-{name}@example.com")
+        payload = {
+            "subject": f"Skrzynka {name}",
+            "body": "treść",
+            "recipients": [owner["email"]],
+            "attachments": [
+                {
+                    "filename": "a.bin",
+                    "content_type": "application/octet-stream",
+                    "data_base64": base64.b64encode(os.urandom(4096)).decode("ascii"),
+                }
+            ],
+        }
+        r = client.post("/messages", json=payload, headers=sender["headers"])
+        assert r.status_code == 201, r.text
+        _seed_inbox(owner["email"], total)
+        result[name] = {**owner, "message_id": r.json()["id"]}
+    return result
+
+
+def _statement_count(client, url: str, headers: dict) -> int:
+    # Pierwsze wywołanie rozgrzewa pamięci podręczne (klucze sesji, weryfikacja podpisu).
+    assert client.get(url, headers=headers).status_code == 200
+    with count_statements() as statements:
+        r = client.get(url, headers=headers)
+    assert r.status_code == 200, r.text
+    return len(statements)
+
+
+def test_inbox_page_statement_count_does_not_depend_on_mailbox_size(client, mailboxes):
+    counts = {
+        name: _statement_count(client, "/messages?limit=2", box["headers"]) for name, box in mailboxes.items()
+    }
+    assert 0 < counts["small"] == counts["large"]
+
+
+def test_message_detail_statement_count_does_not_depend_on_mailbox_size(client, mailboxes):
+    counts = {
+        name: _statement_count(client, f"/messages/{box['message_id']}", box["headers"])
+        for name, box in mailboxes.items()
+    }
+    assert 0 < counts["small"] == counts["large"]
+
+
+def test_download_statement_count_does_not_depend_on_mailbox_size(client, mailboxes):
+    counts = {}
+    for name, box in mailboxes.items():
+        detail = client.get(f"/messages/{box['message_id']}", headers=box["headers"])
+        attachment_id = detail.json()["attachments"][0]["id"]
+        counts[name] = _statement_count(client, f"/attachments/{attachment_id}", box["headers"])
+    assert 0 < counts["small"] == counts["large"]
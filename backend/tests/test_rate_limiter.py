@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app import rate_limiter
+from app.dependencies import TokenData
+from app.rate_limiter import RateLimiter, client_ip, rate_limit
+
+
+def _request(peer: str, forwarded: str | None = None):
+    headers = {"x-forwarded-for": forwarded} if forwarded is not None else {}
+    return SimpleNamespace(client=SimpleNamespace(host=peer), headers=headers)
+
+
+def test_client_ip_ignores_forwarded_for_without_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(rate_limiter.settings, "trusted_proxy_count", 0)
+    assert client_ip(_request("203.0.113.7", "198.51.100.1")) == "203.0.113.7"
+
+
+def test_client_ip_uses_entry_appended_by_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(rate_limiter.settings, "trusted_proxy_count", 1)
+    # Pierwszy wpis podaje klient; ostatni dopisało nasze proxy.
+    assert client_ip(_request("10.0.0.2", "1.2.3.4, 198.51.100.1")) == "198.51.100.1"
+    assert client_ip(_request("10.0.0.2")) == "10.0.0.2"
+
+
+def test_idle_keys_expire_behind_keys_of_longer_policy(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(rate_limiter.time, "time", lambda: clock.now)
+    limiter = RateLimiter(max_keys=100)
+    limiter.hit("register", "a")  # okno godzinne
+    limiter.hit("login", "b")  # okno minutowe
+    clock.now += 121
+    limiter.hit("register", "c")
+    # Wygasły klucz logowania jest usuwany, choć przed nim stoi jeszcze ważny klucz rejestracji.
+    assert len(limiter) == 2
+
+
+def test_key_cap_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(rate_limiter.time, "time", lambda: 1000.0)
+    limiter = RateLimiter(max_keys=2)
+    for key in ("a", "b", "c"):
+        limiter.hit("login", key)
+    assert len(limiter) == 2
+
+
+def test_authenticated_policies_are_keyed_by_user(monkeypatch):
+    monkeypatch.setitem(rate_limiter.RateLimitConfig, "send", {"limit": 2, "window": 60, "per": "user"})
+    check = rate_limit("send")
+    for _ in range(2):
+        check(TokenData(user_id=1, jti="a"))
+    with pytest.raises(HTTPException) as exc:
+        check(TokenData(user_id=1, jti="a"))
+    assert exc.value.status_code == 429
+    # Inny użytkownik z tego samego adresu ma własny limit.
+    check(TokenData(user_id=2, jti="b"))
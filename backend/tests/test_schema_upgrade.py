@@ -0,0 +1,107 @@
+from sqlalchemy import create_engine, inspect, text
+
+from app.schema_upgrade import upgrade_schema
+
+# Schemat z pierwszego wydania, zanim tabele dostały nowe kolumny.
+_BASELINE = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY, email VARCHAR NOT NULL UNIQUE, password_hash VARCHAR NOT NULL,
+    totp_secret VARCHAR NOT NULL, public_key_pem BLOB NOT NULL, private_key_enc BLOB NOT NULL,
+    private_key_salt BLOB NOT NULL, private_key_nonce BLOB NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL REFERENCES users (id), subject_enc BLOB NOT NULL,
+    subject_nonce BLOB NOT NULL, body_enc BLOB NOT NULL, body_nonce BLOB NOT NULL, signature BLOB NOT NULL,
+    signature_algo VARCHAR NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE TABLE message_recipients (
+    id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL REFERENCES messages (id),
+    recipient_id INTEGER NOT NULL REFERENCES users (id), aes_key_enc BLOB NOT NULL,
+    read_at DATETIME, deleted_at DATETIME,
+    CONSTRAINT uix_message_recipient UNIQUE (message_id, recipient_id)
+);
+CREATE TABLE attachments (
+    id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL REFERENCES messages (id), filename VARCHAR NOT NULL,
+    content_type VARCHAR NOT NULL, data BLOB NOT NULL, nonce BLOB NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE INDEX ix_attachments_id ON attachments (id);
+"""
+
+
+def _baseline_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/legacy.db")
+    with engine.begin() as conn:
+        for statement in _BASELINE.split(";"):
+            if statement.strip():
+                conn.execute(text(statement))
+        conn.execute(
+            text(
+                "INSERT INTO users VALUES (1, 'a@example.com', 'h', 't', x'01', x'02', x'03', x'04', CURRENT_TIMESTAMP);"
+            )
+        )
+        conn.execute(
+            text("INSERT INTO messages VALUES (1, 1, x'01', x'02', x'03', x'04', x'05', 'RSA-PSS', CURRENT_TIMESTAMP)")
+        )
+        conn.execute(
+            text("INSERT INTO attachments VALUES (1, 1, 'a.txt', 'text/plain', x'0a0b', x'0c', CURRENT_TIMESTAMP)")
+        )
+    return engine
+
+
+def test_upgrade_adds_attachment_columns_and_keeps_rows(tmp_path):
+    engine = _baseline_engine(tmp_path)
+    assert upgrade_schema(engine)
+
+    columns = {column["name"]: column for column in inspect(engine).get_columns("attachments")}
+    for name in ("uploader_id", "blob_ref", "size", "digest", "format_version", "staged_key_enc", "key_wrap"):
+        assert name in columns
+    assert columns["data"]["nullable"] and columns["message_id"]["nullable"]
+    with engine.connect() as conn:
+        row = conn.execute(text("SELECT message_id, data, format_version FROM attachments")).one()
+    assert tuple(row) == (1, b"\x0a\x0b", 1)
+
+
+def test_upgrade_adds_columns_and_indexes_of_other_tables(tmp_path):
+    engine = _baseline_engine(tmp_path)
+    upgrade_schema(engine)
+
+    inspector = inspect(engine)
+    expected = {
+        "users": {"key_suite", "signing_public_key_pem", "search_enabled"},
+        "messages": {"signature_verified", "signature_key_fingerprint"},
+        "message_recipients": {"wrap_algo"},
+    }
+    for table, names in expected.items():
+        assert names <= {column["name"] for column in inspector.get_columns(table)}
+    assert "ix_messages_created_at" in {index["name"] for index in inspector.get_indexes("messages")}
+    assert "ix_message_recipients_inbox" in {index["name"] for index in inspector.get_indexes("message_recipients")}
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT key_suite, search_enabled FROM users")).one() == ("rsa", False)
+
+
+def test_upgrade_deduplicates_search_tokens(tmp_path):
+    engine = _baseline_engine(tmp_path)
+    upgrade_schema(engine)
+    with engine.begin() as conn:
+        # Tabela z pierwszej wersji indeksu, bez unikalności (link_id, token).
+        conn.execute(text("DROP TABLE search_tokens"))
+        conn.execute(
+            text(
+                "CREATE TABLE search_tokens (id INTEGER PRIMARY KEY, recipient_id INTEGER NOT NULL, "
+                "link_id INTEGER NOT NULL, token BLOB NOT NULL)"
+            )
+        )
+        conn.execute(text("CREATE INDEX ix_search_tokens_lookup ON search_tokens (recipient_id, token, link_id)"))
+        for _ in range(2):
+            conn.execute(text("INSERT INTO search_tokens (recipient_id, link_id, token) VALUES (1, 1, x'aa')"))
+    assert upgrade_schema(engine) == ["search_tokens: unikalność uix_search_token"]
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM search_tokens")).scalar() == 1
+
+
+def test_upgrade_is_idempotent(tmp_path):
+    engine = _baseline_engine(tmp_path)
+    upgrade_schema(engine)
+    assert upgrade_schema(engine) == []
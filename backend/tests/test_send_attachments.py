@@ -0,0 +1,55 @@
+import os
+
+from sqlalchemy import update
+
+from app import models
+from app.database import SessionLocal
+from app.routers import messages
+
+
+def _upload(client, headers: dict) -> int:
+    r = client.post(
+        "/attachments/uploads?filename=a.bin",
+        content=os.urandom(1024),
+        headers={**headers, "content-type": "application/octet-stream"},
+    )
+    assert r.status_code == 201, r.text
+    return r.json()["id"]
+
+
+def test_staged_attachment_claimed_by_concurrent_send_is_rejected(client, make_user, monkeypatch):
+    sender = make_user("claim-sender@example.com")
+    attachment_id = _upload(client, sender["headers"])
+    first = client.post(
+        "/messages", json={"subject": "pierwsza", "body": "x", "recipients": [sender["email"]]}, headers=sender["headers"]
+    )
+    store_message = messages._store_message
+
+    def store_after_concurrent_claim(db, message, *args):
+        # Inna wysyłka przejmuje załącznik między sprawdzeniem a zapisem tej wiadomości.
+        with SessionLocal() as other:
+            other.execute(
+                update(models.Attachment)
+                .where(models.Attachment.id == attachment_id)
+                .values(message_id=first.json()["id"])
+            )
+            other.commit()
+        return store_message(db, message, *args)
+
+    monkeypatch.setattr(messages, "_store_message", store_after_concurrent_claim)
+    r = client.post(
+        "/messages",
+        json={"subject": "druga", "body": "x", "recipients": [sender["email"]], "attachment_ids": [attachment_id]},
+        headers=sender["headers"],
+    )
+    assert r.status_code == 409, r.text
+    with SessionLocal() as db:
+        assert db.get(models.Attachment, attachment_id).message_id == first.json()["id"]
+
+
+def test_staged_attachment_is_attached_once(client, make_user):
+    sender = make_user("claim-once@example.com")
+    attachment_id = _upload(client, sender["headers"])
+    payload = {"subject": "s", "body": "x", "recipients": [sender["email"]], "attachment_ids": [attachment_id]}
+    assert client.post("/messages", json=payload, headers=sender["headers"]).status_code == 201
+    assert client.post("/messages", json=payload, headers=sender["headers"]).status_code == 404
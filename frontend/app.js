@@ -30,6 +30,12 @@ const mailboxTabs = document.querySelectorAll("[data-mailbox-tab]");
 
 let authToken = null;
 let currentMessage = null;
+let inboxCursor = null;
+// Kursor najnowszej wiadomości na liście; zdarzenia SSE dociągają tylko nowsze od niego.
+let inboxHead = null;
+let inboxFullReload = false;
+let eventsAbort = null;
+let inboxReloadTimer = null;
 const STORAGE_KEY = "securemail_token";
 const STATUS_DOT_CLASSES = [
   "status-block__icon--checking",
@@ -124,7 +130,10 @@ function setAuthToken(token) {
     setSendState("zalogowany");
     updateMessageVisibility(true);
     logoutBtn?.classList.remove("hidden");
+    startEvents();
   } else {
+    stopEvents();
+    inboxHead = null;
     sessionStorage.removeItem(STORAGE_KEY);
     setSendState("wymaga zalogowania");
     updateMessageVisibility(false);
@@ -200,6 +209,60 @@ function setAttachmentsEmpty() {
   detailAttachments.appendChild(note);
 }
 
+function scheduleInboxReload(full) {
+  inboxFullReload = inboxFullReload || full;
+  clearTimeout(inboxReloadTimer);
+  inboxReloadTimer = setTimeout(() => {
+    const reload = inboxFullReload ? loadInbox : loadNewInbox;
+    inboxFullReload = false;
+    reload();
+  }, 300);
+}
+
+async function startEvents() {
+  stopEvents();
+  const controller = new AbortController();
+  eventsAbort = controller;
+  let reconnect = false;
+  while (!controller.signal.aborted && authToken) {
+    try {
+      const res = await fetch("/api/messages/events", {
+        headers: { Authorization: `Bearer ${authToken}` },
+        signal: controller.signal,
+      });
+      if (res.status === 401) return;
+      if (res.ok && res.body) {
+        // Zdarzeń z czasu przerwy nie odtworzymy, więc po ponownym połączeniu odświeżamy całą listę.
+        if (reconnect) scheduleInboxReload(true);
+        reconnect = true;
+        const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = "";
+        for (;;) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += value;
+          let end;
+          while ((end = buffer.indexOf("\n\n")) >= 0) {
+            const block = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            const eventLine = block.split("\n").find((line) => line.startsWith("event:"));
+            // Nowa wiadomość tylko dochodzi na górę listy; zmiany stanu i resync wymagają pełnego odświeżenia.
+            if (eventLine) scheduleInboxReload(eventLine.slice(6).trim() !== "message");
+          }
+        }
+      }
+    } catch (err) {
+      if (controller.signal.aborted) return;
+    }
+    await new Promise((resolve) => setTimeout(resolve, 5000));
+  }
+}
+
+function stopEvents() {
+  eventsAbort?.abort();
+  eventsAbort = null;
+}
+
 async function markRead(id) {
   const res = await fetch(`/api/messages/${id}/read`, {
     method: "POST",
@@ -286,26 +349,29 @@ loginForm?.addEventListener("submit", async (e) => {
   }
 });
 
-let attachmentBase64 = null;
 let attachmentFile = null;
 
 messageForm?.file?.addEventListener("change", (e) => {
   const file = e.target.files?.[0];
-  attachmentBase64 = null;
   attachmentFile = file || null;
-  if (!file) {
-    fileName.textContent = "";
-    return;
-  }
-  const reader = new FileReader();
-  reader.onload = () => {
-    const base64 = reader.result.split(",")[1];
-    attachmentBase64 = base64;
-    fileName.textContent = `${file.name} (${Math.round(file.size / 1024)} kB)`;
-  };
-  reader.readAsDataURL(file);
+  fileName.textContent = file ? `${file.name} (${Math.round(file.size / 1024)} kB)` : "";
 });
 
+async function uploadAttachment(file) {
+  const params = new URLSearchParams({ filename: file.name });
+  const res = await fetch(`/api/attachments/uploads?${params}`, {
+    method: "POST",
+    headers: {
+      "Content-Type": file.type || "application/octet-stream",
+      Authorization: `Bearer ${authToken}`,
+    },
+    body: file,
+  });
+  const data = await res.json();
+  if (!res.ok) throw new Error(parseDetail(data.detail) || "Błąd przesyłania załącznika");
+  return data.id;
+}
+
 messageForm?.addEventListener("submit", async (e) => {
   e.preventDefault();
   if (!authToken) {
@@ -319,21 +385,17 @@ messageForm?.addEventListener("submit", async (e) => {
     messageResult.textContent = "Podaj co najmniej jednego odbiorce.";
     return;
   }
-  const attachments = [];
-  if (attachmentBase64 && attachmentFile) {
-    attachments.push({
-      filename: attachmentFile.name,
-      content_type: attachmentFile.type || "application/octet-stream",
-      data_base64: attachmentBase64,
-    });
-  }
-  const payload = {
-    recipients,
-    subject: formData.get("subject"),
-    body: formData.get("body"),
-    attachments,
-  };
   try {
+    const attachmentIds = [];
+    if (attachmentFile) {
+      attachmentIds.push(await uploadAttachment(attachmentFile));
+    }
+    const payload = {
+      recipients,
+      subject: formData.get("subject"),
+      body: formData.get("body"),
+      attachment_ids: attachmentIds,
+    };
     const res = await fetch("/api/messages", {
       method: "POST",
       headers: {
@@ -345,7 +407,6 @@ messageForm?.addEventListener("submit", async (e) => {
     const data = await res.json();
     if (!res.ok) throw new Error(data.detail || "Błąd wysyłki");
     messageResult.textContent = "Wyslano.";
-    attachmentBase64 = null;
     attachmentFile = null;
     fileName.textContent = "";
     messageForm.reset();
@@ -365,20 +426,62 @@ function updateMessageVisibility(isLoggedIn) {
   }
 }
 
+async function fetchInboxPage(cursor, since = null) {
+  const params = new URLSearchParams();
+  if (cursor) params.set("cursor", cursor);
+  if (since) params.set("since", since);
+  const query = params.toString();
+  const res = await fetch(`/api/messages${query ? `?${query}` : ""}`, {
+    headers: { Authorization: `Bearer ${authToken}` },
+  });
+  if (res.status === 401) {
+    setAuthToken(null);
+    throw new Error("Sesja wygasla. Zaloguj sie ponownie.");
+  }
+  const data = await res.json();
+  if (!res.ok) throw new Error(data.detail || "Błąd pobierania wiadomości");
+  return data;
+}
+
 async function loadInbox() {
   if (!authToken || !inboxList) return;
   setInboxStatus("Ładowanie...");
   try {
-    const res = await fetch("/api/messages", {
-      headers: { Authorization: `Bearer ${authToken}` },
-    });
-    if (res.status === 401) {
-      setAuthToken(null);
-      throw new Error("Sesja wygasla. Zaloguj sie ponownie.");
+    const data = await fetchInboxPage(null);
+    inboxCursor = data.next_cursor;
+    inboxHead = data.head_cursor;
+    renderInbox(data.items);
+  } catch (err) {
+    setInboxStatus(err.message || "Błąd pobierania");
+  }
+}
+
+async function loadNewInbox() {
+  if (!authToken || !inboxList) return;
+  if (!inboxHead || !inboxList.querySelector(".inbox__item")) {
+    await loadInbox();
+    return;
+  }
+  try {
+    const data = await fetchInboxPage(null, inboxHead);
+    // Pełna strona nowszych oznacza lukę między nią a listą, więc wczytujemy listę od nowa.
+    if (data.next_cursor) {
+      await loadInbox();
+      return;
     }
-    const data = await res.json();
-    if (!res.ok) throw new Error(data.detail || "Błąd pobierania wiadomości");
-    renderInbox(data);
+    inboxHead = data.head_cursor;
+    inboxList.prepend(...data.items.map(buildInboxItem));
+  } catch (err) {
+    setInboxStatus(err.message || "Błąd pobierania");
+  }
+}
+
+async function loadMoreInbox() {
+  if (!authToken || !inboxList || !inboxCursor) return;
+  try {
+    const data = await fetchInboxPage(inboxCursor);
+    inboxCursor = data.next_cursor;
+    appendInboxItems(data.items);
   } catch (err) {
     setInboxStatus(err.message || "Błąd pobierania");
   }
@@ -393,22 +496,40 @@ function renderInbox(items) {
     return;
   }
   inboxList.textContent = "";
-  items.forEach((item) => {
+  appendInboxItems(items);
+}
+
+function buildInboxItem(item) {
+  const li = document.createElement("li");
+  const isUnread = !item.read_at;
+  li.className = `inbox__item${isUnread ? " inbox__item--unread" : ""}`;
+  const title = document.createElement("p");
+  title.className = "inbox__title";
+  title.textContent = item.subject || "";
+  const meta = document.createElement("p");
+  meta.className = "inbox__meta";
+  const sender = item.sender_email || "";
+  const createdAt = item.created_at ? new Date(item.created_at).toLocaleString() : "";
+  meta.textContent = `Od: ${sender} - ${createdAt}`;
+  li.append(title, meta);
+  li.addEventListener("click", () => selectMessage(item.id));
+  return li;
+}
+
+function appendInboxItems(items) {
+  inboxList.querySelector(".inbox__more")?.remove();
+  items.forEach((item) => inboxList.appendChild(buildInboxItem(item)));
+  if (inboxCursor) {
     const li = document.createElement("li");
-    const isUnread = !item.read_at;
-    li.className = `inbox__item${isUnread ? " inbox__item--unread" : ""}`;
-    const title = document.createElement("p");
-    title.className = "inbox__title";
-    title.textContent = item.subject || "";
-    const meta = document.createElement("p");
-    meta.className = "inbox__meta";
-    const sender = item.sender_email || "";
-    const createdAt = item.created_at ? new Date(item.created_at).toLocaleString() : "";
-    meta.textContent = `Od: ${sender} - ${createdAt}`;
-    li.append(title, meta);
-    li.addEventListener("click", () => selectMessage(item.id));
+    li.className = "inbox__more";
+    const btn = document.createElement("button");
+    btn.type = "button";
+    btn.className = "button subtle";
+    btn.textContent = "Wczytaj starsze";
+    btn.addEventListener("click", loadMoreInbox);
+    li.appendChild(btn);
     inboxList.appendChild(li);
-  });
+  }
 }
 
 async function selectMessage(id) {